@@ -2,9 +2,15 @@ import tkinter as tk
 from tkinter import ttk # 追加
 from PIL import Image, ImageTk, ImageChops
 import requests
+import numpy as np
+import importlib.util
 import io
 import time
 import os
+import queue
+import sys
+import threading
+from types import SimpleNamespace
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 
@@ -21,13 +27,109 @@ SEAL_IMAGE_PATH = "kiku.png"
 CHANGE_THRESHOLD = 8.0
 # チェック間隔（ミリ秒）
 CHECK_INTERVAL_MS = 1000
+# 差分率に変化がない間は、チェック間隔をこの秒数まで広げる
+MAX_CHECK_INTERVAL_SEC = 10.0
+# True にすると、同じマシンで動いている 荒らし検知tool がデコードしたタイルを共有キャッシュから読む
+SHARED_TILE_CACHE = False
+# ワーカースレッドの結果を取り出す間隔（ミリ秒）
+RESULT_POLL_MS = 100
+
+# 接続を使い回すためのセッションと、条件付きGET用の前回レスポンス情報
+_session = requests.Session()
+_last_responses = {} # url -> (ETag, Last-Modified, 画像)
+
+TOOL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "荒らし検知tool")
+TOOL_PACKAGE = "wplace_tool" # 荒らし検知tool のモジュールを sys.modules に登録するときの名前の接頭辞
+
+def load_tool_module(name, deps=()):
+    """
+    荒らし検知tool のモジュールをファイルから直接読み込み、"wplace_tool.<name>" として登録する。
+    sys.path に荒らし検知tool を加えたり元の名前で登録したりすると、engine や history などの一般的な名前が
+    プロセス全体で他のパッケージと衝突するため、必要なモジュールだけをこの関数で読み込む。
+    deps には、そのモジュールが import する 荒らし検知tool のモジュールを指定する。
+    読み込み中だけ元の名前で参照できるようにし、終わったら sys.modules を元に戻す。
+    読み込みに失敗した場合は、原因にかかわらず ImportError を送出する。
+    """
+    key = f"{TOOL_PACKAGE}.{name}"
+    module = sys.modules.get(key)
+    if module is not None:
+        return module
+    path = os.path.join(TOOL_DIR, name + ".py")
+    if not os.path.exists(path):
+        raise ImportError(f"{path} が見つかりません")
+    aliases = {dep: load_tool_module(dep) for dep in deps}
+    spec = importlib.util.spec_from_file_location(key, path)
+    module = importlib.util.module_from_spec(spec)
+    saved = {dep: sys.modules.get(dep) for dep in aliases}
+    sys.modules[key] = module
+    sys.modules.update(aliases)
+    try:
+        spec.loader.exec_module(module)
+    except Exception as e:
+        del sys.modules[key]
+        raise ImportError(f"{path} を読み込めません: {e}") from e
+    finally:
+        for dep, previous in saved.items():
+            if previous is None:
+                sys.modules.pop(dep, None)
+            else:
+                sys.modules[dep] = previous
+    return module
+
+# 差分の履歴 (事前確保のリングバッファ) とチェック間隔の調整は 荒らし検知tool と同じ実装を使う (読み込めなければ起動しない)
+try:
+    History = load_tool_module("history").History
+    AdaptiveInterval = load_tool_module("polling").AdaptiveInterval
+except ImportError as e:
+    sys.exit(f"荒らし検知tool のモジュールを読み込めません: {e}")
+
+# 共有キャッシュ (SHARED_TILE_CACHE が True のときだけ。使えない環境では読まない)
+_shared_cache = None
+if SHARED_TILE_CACHE:
+    try:
+        _palette = load_tool_module("palette")
+        _shared_tile_cache = load_tool_module("shared_tile_cache", deps=["palette"])
+        DEFAULT_MAX_AGE_SEC = _shared_tile_cache.DEFAULT_MAX_AGE_SEC
+        _shared_cache = _shared_tile_cache.SharedTileCache()
+        _shared_palette = _palette.Palette()
+    except (ImportError, OSError) as e:
+        print(f"共有キャッシュを使えません: {e}")
+
+def get_shared_image(url):
+    """他のプロセスが直前に取得したタイルが共有キャッシュにあれば、デコードせずに画像として返す"""
+    if _shared_cache is None:
+        return None
+    try:
+        base_url, tx, ty = url[:-len(".png")].rsplit("/", 2)
+        shared = _shared_cache.read((int(tx), int(ty)), _shared_palette, base_url)
+    except ValueError:
+        return None
+    if shared is None or not 0 <= time.time() - shared.fetched_at <= DEFAULT_MAX_AGE_SEC:
+        return None
+    return Image.fromarray(_shared_palette.rgba[shared.tile, :3], "RGB")
 
 def get_image_from_url(url):
     """URLから画像をダウンロードし、PillowのImageオブジェクトとして返す"""
+    shared = get_shared_image(url)
+    if shared is not None:
+        return shared
     try:
-        response = requests.get(url, timeout=10)
+        headers = {}
+        cached = _last_responses.get(url)
+        if cached:
+            etag, last_modified, _ = cached
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+
+        response = _session.get(url, headers=headers, timeout=10)
+        if response.status_code == 304 and cached:
+            return cached[2] # 変化なし: 前回デコードした画像を再利用
         response.raise_for_status()
-        return Image.open(io.BytesIO(response.content)).convert("RGB")
+        image = Image.open(io.BytesIO(response.content)).convert("RGB")
+        _last_responses[url] = (response.headers.get("ETag"), response.headers.get("Last-Modified"), image)
+        return image
     except requests.exceptions.RequestException as e:
         print(f"画像のダウンロード中にエラーが発生しました: {e}")
         return None
@@ -45,11 +147,9 @@ def compare_images(img1, img2):
     if diff.getbbox() is None:
         return 0.0, diff
 
-    diff_non_zero = 0
-    for pixel in diff.getdata():
-        if pixel != (0, 0, 0):
-            diff_non_zero += 1
-            
+    # 差分のあるピクセル数を配列演算でカウント
+    diff_non_zero = int(np.count_nonzero(np.asarray(diff).any(axis=2)))
+
     total_pixels = img1.width * img1.height
     if total_pixels == 0:
         return 0.0, diff
@@ -109,8 +209,7 @@ class VandalismDetectorApp:
         self.start_time = time.time() # 稼働時間計算用
 
         # グラフ用の設定
-        self.diff_history = []
-        self.time_history = []
+        self.history = History()
         self.fig, self.ax = plt.subplots(figsize=(5, 3), dpi=100)
         self.ax.set_title("差分パーセンテージの推移")
         self.ax.set_xlabel("時間 (秒)")
@@ -132,7 +231,13 @@ class VandalismDetectorApp:
         self.status_var.set("初期化中...")
 
         self.setup_gui() # GUIのセットアップを呼び出す
-        self.perform_check() # 最初のチェックを開始
+
+        # 画像の取得と比較はワーカースレッドで行い、結果をキューで受け取る
+        self.results = queue.Queue()
+        self.current_threshold = CHANGE_THRESHOLD
+        self.check_interval_sec = CHECK_INTERVAL_MS / 1000
+        threading.Thread(target=self.check_worker, daemon=True).start()
+        self.perform_check() # 結果の取り出しを開始
         self.update_uptime_display() # 稼働時間表示の更新を開始
 
     def setup_gui(self):
@@ -275,28 +380,62 @@ class VandalismDetectorApp:
     def update_interval_label(self, value):
         self.interval_label.config(text=f"{int(float(value))}")
 
-    def perform_check(self):
-        """画像の取得、比較、GUIの更新を行う"""
-        # スライダーから現在のしきい値とチェック間隔を取得
-        current_threshold = float(self.change_threshold_var.get())
-        current_check_interval_ms = int(float(self.check_interval_var.get())) * 1000 # 秒をミリ秒に変換
-
-        current_tile_image = get_image_from_url(TILE_URL)
-        if not current_tile_image:
-            self.status_var.set("エラー: タイル画像取得失敗")
-            self.root.after(current_check_interval_ms, self.perform_check)
-            return
-
-        monitoring_area_coords = (0, 391, 73, 464)
-        current_monitored_area = current_tile_image.crop(monitoring_area_coords)
-        
-        diff_percentage, diff_image = compare_images(self.seal_image, current_monitored_area)
-
-        # 画像をリサイズしてからTkinter用に変換
-        # Image.LANCZOS は高品質なリサイズアルゴリズム
-        resized_realtime_image = current_monitored_area.resize(self.DISPLAY_IMAGE_SIZE, Image.LANCZOS)
-        resized_diff_image = diff_image.resize(self.DISPLAY_IMAGE_SIZE, Image.LANCZOS)
+    def check_worker(self):
+        """バックグラウンドで画像の取得と比較を行い、結果をキューに入れる (GUIには触らない)"""
+        interval = AdaptiveInterval(self.check_interval_sec, MAX_CHECK_INTERVAL_SEC)
+        while True:
+            if interval.min_interval != self.check_interval_sec:
+                interval.set_min_interval(self.check_interval_sec) # 入力欄で間隔が変えられた
+            started = time.time()
+            current_tile_image = get_image_from_url(TILE_URL)
+            if not current_tile_image:
+                self.results.put(None)
+                diff_percentage = None
+            else:
+                monitoring_area_coords = (0, 391, 73, 464)
+                current_monitored_area = current_tile_image.crop(monitoring_area_coords)
+
+                diff_percentage, diff_image = compare_images(self.seal_image, current_monitored_area)
+
+                # 画像をリサイズしてから渡す (Tkinter用の変換はGUIスレッドで行う)
+                # Image.LANCZOS は高品質なリサイズアルゴリズム
+                resized_realtime_image = current_monitored_area.resize(self.DISPLAY_IMAGE_SIZE, Image.LANCZOS)
+                resized_diff_image = diff_image.resize(self.DISPLAY_IMAGE_SIZE, Image.LANCZOS)
+                self.results.put((diff_percentage, resized_realtime_image, resized_diff_image))
+
+            # 差分率が変わったら設定の間隔に戻し、変わらなければ間隔を広げる
+            wait_sec = interval.observe(SimpleNamespace(diff_pct=diff_percentage))
+
+            # 次のチェックまで待機
+            time.sleep(max(0.0, wait_sec - (time.time() - started)))
 
+    def perform_check(self):
+        """ワーカーから届いた結果を取り出し、GUIの更新を行う"""
+        # 入力欄から現在のしきい値とチェック間隔を取得 (入力途中の値は無視する)
+        try:
+            self.current_threshold = float(self.change_threshold_var.get())
+        except ValueError:
+            pass
+        try:
+            self.check_interval_sec = int(float(self.check_interval_var.get()))
+        except ValueError:
+            pass
+
+        while True:
+            try:
+                result = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if result is None:
+                self.status_var.set("エラー: タイル画像取得失敗")
+            else:
+                self.show_result(*result)
+
+        self.root.after(RESULT_POLL_MS, self.perform_check)
+
+    def show_result(self, diff_percentage, resized_realtime_image, resized_diff_image):
+        """比較結果をGUIに反映する"""
+        current_threshold = self.current_threshold
         realtime_tk = ImageTk.PhotoImage(resized_realtime_image)
         diff_tk = ImageTk.PhotoImage(resized_diff_image)
 
@@ -316,16 +455,14 @@ class VandalismDetectorApp:
 
         # グラフデータを更新
         current_time = time.time() - self.start_time
-        self.time_history.append(current_time)
-        self.diff_history.append(diff_percentage)
+        self.history.append(current_time, diff_percentage)
 
-        # 過去60秒間のデータのみ表示
+        # 過去60秒間のデータのみ表示 (リングバッファのビューを切り出すだけでコピーしない)
         window_start_time = current_time - 60
-        self.time_history = [t for t in self.time_history if t >= window_start_time]
-        self.diff_history = self.diff_history[-len(self.time_history):] # time_historyと同期
+        times, values = self.history.since(window_start_time)
 
         self.ax.clear()
-        self.ax.plot(self.time_history, self.diff_history, color='green')
+        self.ax.plot(times, values, color='green')
         self.ax.set_title("差分パーセンテージの推移", color='white')
         self.ax.set_xlabel("時間 (秒)", color='white')
         self.ax.set_ylabel("差分 (%)", color='white')
@@ -339,9 +476,6 @@ class VandalismDetectorApp:
         self.ax.spines['left'].set_color('white')
         self.canvas.draw()
 
-        # 次のチェックを予約
-        self.root.after(int(current_check_interval_ms), self.perform_check)
-
     def update_uptime_display(self):
         # 稼働時間を更新して表示
         elapsed_time = int(time.time() - self.start_time)
@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+取得 → クロップ → 比較 → 描画 の各処理のベンチマーク。
+1000x1000 (TILE_SIZE) の合成タイルと、1・2・4タイルにまたがる大きさの違う参照画像を使い、
+各処理を単独で計測して結果をJSONで書き出します。取得はローカルのHTTPスタブに対して行います。
+
+使い方:
+    python bench.py --output before.json
+    python bench.py --output after.json --compare before.json   # 前回の結果と比べて表示
+    python bench.py --only compare,decode --quick
+描画 (_update_images_display / _update_graph) はディスプレイがない環境では skipped になります。
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from PIL import Image
+
+from diff_engine import CompiledReference, IncrementalDiff, compare_images, compare_live
+from engine import DetectionEngine
+from palette import DEFAULT_PALETTE, WPLACE_COLORS
+from tile_client import TILE_SIZE, TileFetcher, decode_tile
+
+SCHEMA_VERSION = 1
+SEED = 20240801
+
+# (名前, 参照画像の幅, 高さ, タイル内の開始位置x, y) / 名前の末尾は参照がまたがるタイル数
+TEMPLATES = [
+    ("small-1tile", 106, 140, 100, 100),
+    ("medium-1tile", 400, 400, 300, 300),
+    ("medium-2tiles", 400, 400, 800, 300),
+    ("medium-4tiles", 400, 400, 800, 800),
+    ("large-4tiles", 1000, 1000, 500, 500),
+]
+
+
+# --- 合成データ ---
+
+def _palette_rgba(count=None):
+    colors = np.array([c + (255,) for c in WPLACE_COLORS], dtype=np.uint8)
+    return colors[:count] if count else colors
+
+
+def synthetic_tile(rng, fill=0.6):
+    """wplaceの色で塗られた部分と透明な部分が混ざった 1000x1000 のRGBA配列を作ります。"""
+    colors = _palette_rgba()
+    tile = colors[rng.integers(0, len(colors), (TILE_SIZE, TILE_SIZE))]
+    tile[rng.random((TILE_SIZE, TILE_SIZE)) > fill] = 0
+    return tile
+
+
+def encode_png(rgba, paletted=True):
+    """RGBA配列をPNGにします。paletted=True ならwplaceと同じくパレット形式 (P) で保存します。"""
+    image = Image.fromarray(rgba, "RGBA")
+    buffer = io.BytesIO()
+    if paletted:
+        image.quantize(colors=len(WPLACE_COLORS) + 1, method=Image.Quantize.FASTOCTREE).save(buffer, "PNG")
+    else:
+        image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def synthetic_template(rng, width, height):
+    """不透明な図柄と透明な背景からなる参照画像を作ります。"""
+    colors = _palette_rgba(16)
+    template = colors[rng.integers(0, len(colors), (height, width))]
+    yy, xx = np.mgrid[0:height, 0:width]
+    outside = ((xx - width / 2) / (width / 2)) ** 2 + ((yy - height / 2) / (height / 2)) ** 2 > 1
+    template[outside] = 0
+    return Image.fromarray(template, "RGBA")
+
+
+def vandalize(image, rng, fraction=0.05):
+    """画像の一部のピクセルを別の色に塗り替えたコピーを返します。"""
+    rgba = np.array(image)
+    count = int(rgba.shape[0] * rgba.shape[1] * fraction)
+    ys = rng.integers(0, rgba.shape[0], count)
+    xs = rng.integers(0, rgba.shape[1], count)
+    rgba[ys, xs] = _palette_rgba()[rng.integers(0, len(WPLACE_COLORS), count)]
+    return Image.fromarray(rgba, "RGBA")
+
+
+# --- ローカルのタイル配信スタブ ---
+
+class _TileHandler(BaseHTTPRequestHandler):
+    tiles = {} # (tx, ty) -> PNGのバイト列
+
+    def do_GET(self):
+        try:
+            tx, ty = self.path.rstrip("/").split("/")[-2:]
+            body = self.tiles[(int(tx), int(ty.split(".")[0]))]
+        except (KeyError, ValueError):
+            self.send_response(404)
+            self.end_headers()
+            return
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_tile_server(tiles):
+    """tiles を配信するスタブを別スレッドで起動し、(サーバー, ベースURL) を返します。"""
+    handler = type("TileHandler", (_TileHandler,), {"tiles": tiles})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, name="bench-tile-server", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/tiles"
+
+
+# --- 計測 ---
+
+def measure(func, repeat, warmup=1, setup=None):
+    """func を repeat 回計測し、統計値 (ミリ秒) を返します。setup は毎回の計測の直前に呼ばれ、計測には含めません。"""
+    for _ in range(warmup):
+        if setup:
+            setup()
+        func()
+    samples = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return {
+        "n": len(samples),
+        "mean_ms": statistics.fmean(samples),
+        "median_ms": statistics.median(samples),
+        "min_ms": samples[0],
+        "max_ms": samples[-1],
+        "p95_ms": samples[min(len(samples) - 1, int(round(0.95 * (len(samples) - 1))))],
+        "stdev_ms": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+    }
+
+
+class Bench:
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.results = []
+
+    def record(self, name, params, func, repeat=None, **kwargs):
+        stats = measure(func, repeat or self.repeat, **kwargs)
+        self.results.append({"name": name, "params": params, **stats})
+        print(f"  {name:<32} {json.dumps(params, ensure_ascii=False):<48} "
+              f"median {stats['median_ms']:9.3f} ms", file=sys.stderr)
+
+    def skip(self, name, reason):
+        self.results.append({"name": name, "params": {}, "skipped": reason})
+        print(f"  {name:<32} skipped: {reason}", file=sys.stderr)
+
+
+def bench_decode(bench, rng):
+    tile = synthetic_tile(rng)
+    for paletted in (True, False):
+        data = encode_png(tile, paletted)
+        params = {"png": "P" if paletted else "RGBA", "bytes": len(data)}
+        bench.record("decode/decode_tile", params, lambda: decode_tile(data))
+        bench.record("decode/pillow_rgba", params, lambda: Image.open(io.BytesIO(data)).convert("RGBA"))
+
+
+def bench_compare(bench, rng):
+    for name, width, height, _, _ in TEMPLATES:
+        template = synthetic_template(rng, width, height)
+        live = vandalize(template, rng)
+        reference = CompiledReference(template)
+        live_indices = DEFAULT_PALETTE.index_image(live)
+        params = {"template": name, "size": f"{width}x{height}"}
+
+        bench.record("compare/compare_images", params, lambda: compare_images(template, live))
+        bench.record("compare/compare_live", params, lambda: compare_live(reference, live_indices))
+        bench.record("compare/compare_live_novisual", params,
+                     lambda: compare_live(reference, live_indices, visual=False))
+
+        # 1ティックで面積の0.1%ほどの1か所が塗り替えられる場合の差分更新
+        incremental = IncrementalDiff(reference)
+        incremental.update(live_indices)
+        frames = []
+        frame = live_indices
+        side = max(1, int((width * height / 1000) ** 0.5))
+        for _ in range(bench.repeat + 1):
+            frame = frame.copy()
+            y, x = rng.integers(0, height - side + 1), rng.integers(0, width - side + 1)
+            frame[y:y + side, x:x + side] = rng.integers(1, 64)
+            frames.append(frame)
+        feed = iter(frames)
+        bench.record("compare/incremental_update", {**params, "changed": f"{side}x{side}"},
+                     lambda: incremental.update(next(feed)))
+
+
+def bench_fetch(bench, rng):
+    tiles = {}
+    for tx in range(2):
+        for ty in range(2):
+            tiles[(tx, ty)] = encode_png(synthetic_tile(rng))
+    server, base_url = start_tile_server(tiles)
+    try:
+        for name, width, height, x_in_tile, y_in_tile in TEMPLATES:
+            reference = CompiledReference(synthetic_template(rng, width, height))
+            params = {"template": name, "size": f"{width}x{height}"}
+            state = {"fetcher": TileFetcher(base_url)}
+            engine = DetectionEngine(reference, (0, 0, x_in_tile, y_in_tile), fetcher=state["fetcher"],
+                                     keep_images=False)
+            params["tiles"] = len(engine.tile_coords())
+
+            def cold_setup():
+                # キャッシュも検証子もない状態: 全タイルを200で取得してデコードする
+                state["fetcher"].close()
+                state["fetcher"] = engine.fetcher = TileFetcher(base_url)
+                engine.last_crop_key = None
+
+            bench.record("fetch/fetch_region_cold", params, lambda: engine.fetch_region(), setup=cold_setup)
+
+            def warm_setup():
+                # タイルは取得済み: 304で返り、監視領域の組み立てだけをやり直す
+                engine.last_crop_key = None
+
+            bench.record("fetch/fetch_region_304", params, lambda: engine.fetch_region(), setup=warm_setup)
+            state["fetcher"].close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def bench_render(bench, rng):
+    try:
+        import tkinter as tk
+        root = tk.Tk()
+    except Exception as e:
+        bench.skip("render/_update_images_display", f"Tkを起動できません: {e}")
+        bench.skip("render/_update_graph", f"Tkを起動できません: {e}")
+        return
+
+    import importlib
+    app_module = importlib.import_module("最新版")
+
+    class _IdleWorker(app_module.DetectionWorker):
+        def start(self):
+            pass # 計測中にネットワークへ取りに行かない
+
+    tmpdir = tempfile.mkdtemp(prefix="wplace-bench-")
+    app_module.DetectionWorker = _IdleWorker
+    app_module.HISTORY_DB_PATH = os.path.join(tmpdir, "history.sqlite3")
+    app_module.SNAPSHOT_DIR = os.path.join(tmpdir, "snapshots")
+    app_module.HEATMAP_DIR = os.path.join(tmpdir, "heatmaps")
+    try:
+        app = app_module.VandalismDetectorApp(root)
+        root.update()
+
+        def new_frame():
+            # 同じフレーム・同じ表示サイズなら描き直しを省くので、毎回新しいフレームとして描かせる
+            app.frame_serial += 1
+            app.display_key = None
+            app.masked_frame = None
+
+        for name, width, height, _, _ in TEMPLATES:
+            template = synthetic_template(rng, width, height)
+            app.reference = CompiledReference(template)
+            app.current_cropped_image = vandalize(template, rng)
+            app.current_diff_image = compare_live(app.reference, app.current_cropped_image).diff_visual
+            bench.record("render/_update_images_display", {"template": name, "size": f"{width}x{height}"},
+                         app._update_images_display, setup=new_frame)
+
+        values = iter(rng.uniform(0, 50, 10 * bench.repeat + 10).tolist())
+        bench.record("render/_update_graph", {"points": app.max_history_points},
+                     lambda: app._update_graph(next(values)), repeat=10 * bench.repeat, warmup=5)
+        app._on_close()
+    finally:
+        try:
+            root.destroy()
+        except tk.TclError:
+            pass
+
+
+SUITES = {
+    "decode": bench_decode,
+    "compare": bench_compare,
+    "fetch": bench_fetch,
+    "render": bench_render,
+}
+
+
+def environment():
+    import PIL
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "pillow": PIL.__version__,
+    }
+
+
+def compare_runs(base, current):
+    """2回分の結果を名前とパラメータで突き合わせ、中央値の比を表示します。"""
+    def key(entry):
+        return entry["name"], json.dumps(entry.get("params", {}), sort_keys=True, ensure_ascii=False)
+
+    baseline = {key(e): e for e in base["results"] if "median_ms" in e}
+    print(f"{'benchmark':<60} {'base ms':>10} {'now ms':>10} {'ratio':>7}")
+    for entry in current["results"]:
+        if "median_ms" not in entry or key(entry) not in baseline:
+            continue
+        before = baseline[key(entry)]["median_ms"]
+        after = entry["median_ms"]
+        label = f"{entry['name']} {key(entry)[1]}"
+        print(f"{label[:60]:<60} {before:10.3f} {after:10.3f} {after / before if before else float('inf'):7.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="wplace 荒らし検出のベンチマーク")
+    parser.add_argument("--output", default="-", help="結果のJSONの出力先 ('-' で標準出力)")
+    parser.add_argument("--only", default=",".join(SUITES), help=f"実行する項目 (カンマ区切り: {', '.join(SUITES)})")
+    parser.add_argument("--repeat", type=int, default=20, help="1項目あたりの計測回数")
+    parser.add_argument("--quick", action="store_true", help="計測回数を減らして短時間で終える")
+    parser.add_argument("--compare", default=None, help="比較対象とする過去の結果のJSON")
+    args = parser.parse_args(argv)
+
+    names = [n.strip() for n in args.only.split(",") if n.strip()]
+    unknown = [n for n in names if n not in SUITES]
+    if unknown:
+        parser.error(f"不明な項目です: {', '.join(unknown)}")
+
+    bench = Bench(3 if args.quick else max(1, args.repeat))
+    rng = np.random.default_rng(SEED)
+    for name in names:
+        print(f"[{name}]", file=sys.stderr)
+        SUITES[name](bench, rng)
+
+    report = {
+        "schema": SCHEMA_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "environment": environment(),
+        "repeat": bench.repeat,
+        "results": bench.results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output == "-":
+        print(text)
+    else:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare_runs(json.load(f), report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+"""
+NumPy配列ベースの差分エンジン。
+Pillowの getdata() をPythonでループする代わりに、配列演算で
+差分ピクセル数・差分率・差分画像をまとめて計算します。
+参照画像とリアルタイム画像はパレットのインデックス配列 (palette.py) で扱い、
+差分の判定はインデックスの一致比較だけで行います。
+半透明のピクセルと、パレット外の色 (UNKNOWN) の参照ピクセルだけは、参照画像のRGBと直接比べます。
+"""
+from collections import namedtuple
+
+import numpy as np
+from PIL import Image
+
+from palette import DEFAULT_PALETTE, UNKNOWN
+
+# changed: 差分のあるピクセル数 / opaque: 監視対象（透過していない）ピクセル数
+DiffResult = namedtuple("DiffResult", ["changed", "opaque", "diff_pct", "diff_visual"])
+
+
+def _muldiv255(values, alpha):
+    """Pillowの Image.composite と同じ丸めで values * alpha / 255 を計算します。"""
+    tmp = values.astype(np.uint32) * alpha.astype(np.uint32) + 128
+    return (((tmp >> 8) + tmp) >> 8).astype(np.uint8)
+
+
+def _rgb_mismatch(ref_rgb, live, alpha, palette):
+    """
+    参照のRGB (int16, (N, 3)) とリアルタイムのインデックス (N,) を、アルファで減衰させたRGBの差で比べます。
+    色の分からない (UNKNOWN の) リアルタイムのピクセルは常に不一致とします。
+    """
+    live_rgb = palette.rgba[live, :3].astype(np.int16)
+    return _muldiv255(np.abs(ref_rgb - live_rgb), alpha[:, None]).any(axis=1) | (live == UNKNOWN)
+
+
+def _to_array(img, mode):
+    if img.mode != mode:
+        img = img.convert(mode)
+    return np.asarray(img)
+
+
+def diff_images(img1, img2):
+    """
+    透過ピクセルを無視して画像を比較し、DiffResult を返します。
+    img1: 参照画像 (透過情報あり, RGBA)
+    img2: リアルタイム画像 (透過情報あり, RGBA)
+    """
+    if img1.size != img2.size:
+        w = min(img1.width, img2.width)
+        h = min(img1.height, img2.height)
+        img1 = img1.crop((0, 0, w, h))
+        img2 = img2.crop((0, 0, w, h))
+
+    ref = _to_array(img1, "RGBA")
+    live = _to_array(img2, "RGB")
+    alpha = ref[..., 3]
+
+    opaque = int(np.count_nonzero(alpha))
+    if opaque == 0:
+        return DiffResult(0, 0, 0.0, Image.new("RGB", img1.size, (0, 0, 0)))
+
+    # RGBチャンネルのみの絶対差分 (ImageChops.difference と同じ)
+    diff = np.abs(ref[..., :3].astype(np.int16) - live.astype(np.int16)).astype(np.uint8)
+
+    # 透過部分（アルファ値が0）は黒に、半透明部分はアルファ値で減衰させる
+    visual = _muldiv255(diff, alpha[..., None])
+
+    changed = int(np.count_nonzero(visual.any(axis=2)))
+    diff_pct = (changed / opaque) * 100
+    return DiffResult(changed, opaque, diff_pct, Image.fromarray(visual, "RGB"))
+
+
+class CompiledReference:
+    """
+    参照画像から比較に必要な情報（アルファマスク、監視対象ピクセルの位置、
+    パレットのインデックス配列、外接矩形）を読み込み時に一度だけ計算して保持します。
+    半透明のピクセルとパレット外の色のピクセルは、判定時だけアルファで減衰させたRGBの差で比較します。
+    パレット外の色は共有のパレットに追加せず UNKNOWN にするので、どんな画像でも読み込めます。
+    """
+
+    def __init__(self, image, palette=None):
+        if image.mode != "RGBA":
+            image = image.convert("RGBA")
+        self.image = image
+        self.size = image.size
+        self.palette = palette if palette is not None else DEFAULT_PALETTE
+
+        rgba = np.asarray(image)
+        self.alpha = rgba[..., 3]
+        self.indices = self.palette.index_rgba(rgba, grow=False)
+        # 表示用の L モードマスク (paste の mask 引数にそのまま渡せる)
+        self.mask = image.getchannel("A")
+        self.bbox = self.mask.getbbox()
+
+        # 監視対象（透過していない）ピクセルの平坦化インデックス
+        self.opaque_index = np.flatnonzero(self.alpha)
+        self.opaque_count = int(self.opaque_index.size)
+        self.total_pixels = image.width * image.height
+
+        opaque_indices = self.indices.reshape(-1)[self.opaque_index]
+        self._opaque_canonical = self.palette.canonical[opaque_indices]
+        self._opaque_rgb = rgba[..., :3].reshape(-1, 3)[self.opaque_index].astype(np.int16)
+        self._opaque_alpha = self.alpha.reshape(-1)[self.opaque_index][:, None]
+        # 半透明またはパレット外の色のピクセル (監視対象の中での位置)。ここだけはRGBの差で判定する
+        self._by_rgb = np.flatnonzero((self._opaque_alpha[:, 0] < 255) | (opaque_indices == UNKNOWN))
+
+        # wplaceのパレットにない色のピクセル (読み込み時の警告用)
+        off_palette = ~self.palette.is_known(opaque_indices)
+        self.off_palette_count = int(np.count_nonzero(off_palette))
+        self.off_palette_colors = _unique_colors(self._opaque_rgb[off_palette])
+
+    def off_palette_message(self):
+        """パレット外の色があれば、その内容を説明する文字列を返します (なければ None)。"""
+        return _off_palette_message(self.off_palette_count, self.off_palette_colors)
+
+
+def _unique_colors(rgb):
+    """(N, 3) のRGB配列に含まれる色を、タプルの並べ替えたリストで返します。"""
+    return sorted(tuple(c) for c in np.unique(rgb.reshape(-1, 3), axis=0).tolist())
+
+
+def _off_palette_message(count, colors):
+    if not count:
+        return None
+    listed = ", ".join(str(c) for c in colors[:8])
+    more = " ほか" if len(colors) > 8 else ""
+    return (f"参照画像の {count} ピクセルが wplace のパレットにない色です "
+            f"({len(colors)}色: {listed}{more})。この部分は常に差分として検出されます。")
+
+
+STRIP_ROWS = 1000 # TiledReference が参照画像を変換するときの1回あたりの行数
+
+
+class TiledReference:
+    """
+    何十枚ものタイルにまたがる大きな参照画像を、矩形ごとに比較するための参照。
+    CompiledReference と違い、監視対象ピクセルの位置や色の配列を画像全体では持たず、
+    インデックス配列とアルファ (1ピクセル2バイト) だけを保持します。
+    パレット外の色がある場合に限り、その色を比べるためのRGB配列 (rgb) も持ちます。
+    変換は STRIP_ROWS 行ずつ行うので、読み込み時に画像全体のRGBA配列を作ることはありません。
+    """
+
+    def __init__(self, image, palette=None):
+        self.size = image.size
+        self.palette = palette if palette is not None else DEFAULT_PALETTE
+        w, h = image.size
+        self.indices = np.empty((h, w), dtype=np.uint8)
+        self.alpha = np.empty((h, w), dtype=np.uint8)
+        self.rgb = None # パレット外の色 (UNKNOWN) のピクセルのRGB。なければ作らない
+        off_palette_colors = set()
+        self.off_palette_count = 0
+        for y0 in range(0, h, STRIP_ROWS):
+            strip = np.asarray(image.crop((0, y0, w, min(y0 + STRIP_ROWS, h))).convert("RGBA"))
+            area = slice(y0, y0 + strip.shape[0])
+            indices = self.indices[area] = self.palette.index_rgba(strip, grow=False)
+            self.alpha[area] = strip[..., 3]
+            opaque = strip[..., 3] > 0
+            unknown = opaque & (indices == UNKNOWN)
+            if unknown.any():
+                if self.rgb is None:
+                    self.rgb = np.zeros((h, w, 3), dtype=np.uint8)
+                self.rgb[area][unknown] = strip[..., :3][unknown]
+            off_palette = opaque & ~self.palette.is_known(indices)
+            self.off_palette_count += int(np.count_nonzero(off_palette))
+            off_palette_colors.update(_unique_colors(strip[..., :3][off_palette]))
+        self.opaque_count = int(np.count_nonzero(self.alpha))
+        self.total_pixels = w * h
+        self.off_palette_colors = sorted(off_palette_colors)
+
+    def off_palette_message(self):
+        """パレット外の色があれば、その内容を説明する文字列を返します (なければ None)。"""
+        return _off_palette_message(self.off_palette_count, self.off_palette_colors)
+
+    def compare_rect(self, x0, y0, live):
+        """
+        参照の (x0, y0) から live と同じ大きさの矩形を live (インデックス配列) と比較します。
+        判定は compare_live と同じなので、重なりなく全体を覆う矩形ごとの結果を合計すると
+        画像全体を一度に比べた結果と一致します。戻り値: (差分ピクセル数, 監視対象ピクセル数)
+        """
+        h, w = live.shape
+        area = (slice(y0, y0 + h), slice(x0, x0 + w))
+        alpha = self.alpha[area]
+        opaque = alpha > 0
+        ref_opaque = self.indices[area][opaque]
+        live_opaque = live[opaque]
+        palette = self.palette
+        changed_mask = palette.canonical[live_opaque] != palette.canonical[ref_opaque]
+        alpha_opaque = alpha[opaque]
+        by_rgb = np.flatnonzero((alpha_opaque < 255) | (ref_opaque == UNKNOWN))
+        if by_rgb.size:
+            ref_rgb = palette.rgba[ref_opaque[by_rgb], :3].astype(np.int16)
+            if self.rgb is not None:
+                unknown = ref_opaque[by_rgb] == UNKNOWN
+                ref_rgb[unknown] = self.rgb[area][opaque][by_rgb][unknown]
+            changed_mask[by_rgb] = _rgb_mismatch(ref_rgb, live_opaque[by_rgb], alpha_opaque[by_rgb], palette)
+        return int(np.count_nonzero(changed_mask)), int(ref_opaque.size)
+
+
+def _opaque_mismatch(reference, live_opaque):
+    """監視対象ピクセル (reference.opaque_index の順) のうち、参照と一致しないものを真偽値配列で返します。"""
+    palette = reference.palette
+    changed_mask = palette.canonical[live_opaque] != reference._opaque_canonical
+    if reference._by_rgb.size:
+        by_rgb = reference._by_rgb
+        changed_mask[by_rgb] = _rgb_mismatch(reference._opaque_rgb[by_rgb], live_opaque[by_rgb],
+                                             reference._opaque_alpha[by_rgb, 0], palette)
+    return changed_mask
+
+
+def mismatch_mask(reference, live):
+    """
+    参照と一致しない監視対象ピクセルを (高さ, 幅) の真偽値配列で返します。live はインデックス配列です。
+    ヒートマップを数えるために、比較を別プロセスで行う場合 (parallel.py) に使います。
+    """
+    w, h = reference.size
+    mask = np.zeros(h * w, dtype=bool)
+    if reference.opaque_count:
+        mask[reference.opaque_index] = _opaque_mismatch(reference, live.reshape(-1)[reference.opaque_index])
+    return mask.reshape(h, w)
+
+
+def compare_live(reference, live, visual=True):
+    """
+    事前計算済みの参照 (CompiledReference) とリアルタイム画像を比較し、DiffResult を返します。
+    live にはパレットのインデックス配列 (uint8) か Pillow画像を渡せます。
+    監視対象ピクセルのインデックスを比べるだけなので、参照の準備処理も色の変換も毎回は行いません。
+    visual=False の場合は差分画像を作らず、diff_visual は None になります。
+    """
+    w, h = reference.size
+    if isinstance(live, Image.Image):
+        if live.size != reference.size:
+            result = diff_images(reference.image, live)
+            return result if visual else result._replace(diff_visual=None)
+        live = reference.palette.index_image(live)
+
+    if reference.opaque_count == 0:
+        return DiffResult(0, 0, 0.0, Image.new("RGB", (w, h), (0, 0, 0)) if visual else None)
+
+    palette = reference.palette
+    live_opaque = live.reshape(-1)[reference.opaque_index]
+    changed_mask = _opaque_mismatch(reference, live_opaque)
+    changed = int(np.count_nonzero(changed_mask))
+    diff_pct = (changed / reference.opaque_count) * 100
+    if not visual:
+        return DiffResult(changed, reference.opaque_count, diff_pct, None)
+
+    # 差分画像は従来どおりRGBの絶対差分をアルファで減衰させて作る
+    live_rgb = palette.rgba[live_opaque, :3].astype(np.int16)
+    visual_opaque = _muldiv255(np.abs(reference._opaque_rgb - live_rgb), reference._opaque_alpha)
+    visual_img = np.zeros((h * w, 3), dtype=np.uint8)
+    visual_img[reference.opaque_index] = visual_opaque
+    return DiffResult(changed, reference.opaque_count, diff_pct,
+                      Image.fromarray(visual_img.reshape(h, w, 3), "RGB"))
+
+
+def compare_images(img1, img2):
+    """
+    透過ピクセルを無視して画像を比較し、透過部分を黒く塗りつぶした差分画像を返します。
+    戻り値: (差分率 %, 差分画像)
+    """
+    result = diff_images(img1, img2)
+    return result.diff_pct, result.diff_visual
+
+
+DIRTY_BLOCK = 64 # 差分を更新する単位となるブロックの一辺 (ピクセル)
+
+
+def dirty_rects(changed, block=DIRTY_BLOCK, offset=(0, 0)):
+    """
+    変化したピクセルの真偽値配列から、変化を含む block 四方のブロックを矩形のリストで返します。
+    横に隣り合うブロックは1つの矩形にまとめます。矩形は (x0, y0, x1, y1) で、offset だけずらして返します。
+    """
+    h, w = changed.shape
+    if h == 0 or w == 0:
+        return []
+    rows = np.logical_or.reduceat(changed, np.arange(0, h, block), axis=0)
+    blocks = np.logical_or.reduceat(rows, np.arange(0, w, block), axis=1)
+    ox, oy = offset
+    rects = []
+    for by in np.flatnonzero(blocks.any(axis=1)).tolist():
+        row = blocks[by]
+        # 連続した True の区間を [start, end) として取り出す
+        edges = np.flatnonzero(np.diff(np.concatenate(([False], row, [False])).astype(np.int8)))
+        y0, y1 = by * block, min((by + 1) * block, h)
+        for start, end in zip(edges[::2].tolist(), edges[1::2].tolist()):
+            rects.append((ox + start * block, oy + y0, ox + min(end * block, w), oy + y1))
+    return rects
+
+
+class IncrementalDiff:
+    """
+    前回のリアルタイム画像と差分の状態を保持し、前回から変わったピクセルを含むブロックだけを比較し直します。
+    1回あたりの計算量は監視領域の面積ではなく、前回からの変化の量に比例します。
+    変化の検出そのものはインデックス配列の一致比較 (1ピクセル1バイト) だけで行います。
+    """
+
+    def __init__(self, reference, visual=True):
+        self.reference = reference
+        self.visual = visual
+        h, w = reference.size[1], reference.size[0]
+        palette = reference.palette
+        self._ref_canonical = palette.canonical[reference.indices]
+        self._ref_rgb = np.asarray(reference.image)[..., :3].astype(np.int16)
+        self._alpha = reference.alpha
+        self._opaque = reference.alpha > 0
+        # 半透明またはパレット外の色のピクセル。ここだけはRGBの差で判定する
+        self._by_rgb = self._opaque & ((reference.alpha < 255) | (reference.indices == UNKNOWN))
+        self.live = None
+        self.mismatch = np.zeros((h, w), dtype=bool)
+        self.visual_array = np.zeros((h, w, 3), dtype=np.uint8) if visual else None
+        self.changed = 0
+
+    def reset(self):
+        """保持している状態を捨て、次の update() で全体を比較し直します。"""
+        self.live = None
+
+    def _compare_rect(self, live, x0, y0, x1, y1, heatmap=None):
+        """矩形内の差分を計算し直し、差分ピクセル数の増減を返します。heatmap には新たに不一致になったピクセルを数えます。"""
+        area = (slice(y0, y1), slice(x0, x1))
+        palette = self.reference.palette
+        sub_live = live[area]
+        if self.visual:
+            live_rgb = palette.rgba[sub_live, :3].astype(np.int16)
+            visual = _muldiv255(np.abs(self._ref_rgb[area] - live_rgb), self._alpha[area][..., None])
+            self.visual_array[area] = visual
+            mismatch = visual.any(axis=2) | ((sub_live == UNKNOWN) & self._opaque[area])
+        else:
+            mismatch = (palette.canonical[sub_live] != self._ref_canonical[area]) & self._opaque[area]
+            by_rgb = self._by_rgb[area]
+            if by_rgb.any():
+                mismatch[by_rgb] = _rgb_mismatch(self._ref_rgb[area][by_rgb], sub_live[by_rgb],
+                                                 self._alpha[area][by_rgb], palette)
+        delta = int(np.count_nonzero(mismatch)) - int(np.count_nonzero(self.mismatch[area]))
+        if heatmap is not None:
+            heatmap.add(area, mismatch & ~self.mismatch[area])
+        self.mismatch[area] = mismatch
+        return delta
+
+    def update(self, live, hints=None, heatmap=None):
+        """
+        新しいリアルタイム画像 (インデックス配列) で差分を更新します。
+        hints に (x0, y0, x1, y1) の矩形のリストを渡すと、変化の検出をその範囲だけで行います
+        (内容が変わったタイルの範囲など。None なら全体を調べます)。
+        heatmap (heatmap.ChangeHeatmap) を渡すと、前回から新たに不一致になったピクセルを数えます。
+        最初の比較は前回がないので数えません。
+        戻り値: (DiffResult, 比較し直した矩形のリスト)
+        """
+        w, h = self.reference.size
+        if self.live is None or self.live.shape != live.shape:
+            rects = [(0, 0, w, h)]
+            heatmap = None
+            self.changed = 0
+            self.mismatch[:] = False
+        else:
+            rects = []
+            for x0, y0, x1, y1 in (hints if hints is not None else [(0, 0, w, h)]):
+                x0, y0, x1, y1 = max(x0, 0), max(y0, 0), min(x1, w), min(y1, h)
+                if x0 < x1 and y0 < y1:
+                    changed = live[y0:y1, x0:x1] != self.live[y0:y1, x0:x1]
+                    rects.extend(dirty_rects(changed, offset=(x0, y0)))
+
+        for rect in rects:
+            self.changed += self._compare_rect(live, *rect, heatmap=heatmap)
+        self.live = live.copy()
+
+        opaque = self.reference.opaque_count
+        diff_pct = (self.changed / opaque) * 100 if opaque else 0.0
+        visual = Image.fromarray(self.visual_array, "RGB") if self.visual else None
+        return DiffResult(self.changed, opaque, diff_pct, visual), rects
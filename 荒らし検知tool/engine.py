@@ -0,0 +1,599 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+GUIに依存しない荒らし検知エンジン。
+タイル取得 → 監視領域のクロップ → 参照画像との比較 → 荒らしレベルの判定 を行います。
+Tkinter / matplotlib を読み込まないため、ディスプレイのないサーバーでも動作します。
+
+使い方 (結果は1行1件のJSONで出力されます):
+    python engine.py --ref-pixel "1818, 806, 989, 359" --reference kiku.png --output result.jsonl
+    python engine.py --watchlist watchlist.json   # 複数領域をまとめて監視
+    python engine.py --record rec/ ...             # 取得したタイルを記録 (replay.py で再生)
+    python engine.py --streaming --reference mural.png ...  # 何十枚ものタイルにまたがる巨大な参照画像
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from collections import namedtuple
+
+from PIL import Image
+
+from diff_engine import CompiledReference, IncrementalDiff, TiledReference
+from heatmap import HeatmapStore
+from history_store import HistoryStore
+from metrics import METRICS, start_metrics_server
+from polling import DEFAULT_MAX_INTERVAL_SEC, AdaptiveInterval, RateBudget, jittered
+from replay import TileRecorder
+from shared_tile_cache import DEFAULT_SHARED_CACHE_DIR, SharedTileCache
+from snapshot_archive import SnapshotArchiver
+from tile_cache import DEFAULT_CACHE_BYTES, TileCache
+from tile_client import (DEFAULT_MAX_WORKERS, TILE_SIZE, TileFetcher, TILE_BASE_URL, assemble_region, region_tiles,
+                         tile_overlap)
+
+# --- 定数設定 ---
+# 監視開始位置: (タイルのx, タイルのy, タイル内のx, タイル内のy)
+DEFAULT_REF_PIXEL = (1818, 806, 989, 359)
+DEFAULT_SEAL_IMAGE_PATH = "kiku.png"
+DEFAULT_INTERVAL_MS = 1000
+STREAM_BATCH_TILES = 4 # ストリーミング比較で一度に取得・保持するタイルの枚数
+
+# 荒らしレベルと色の定義 (しきい値は変数で管理)
+LEVELS_DATA = [
+    {"label": "超大規模荒らし", "color": "#ff4d4f", "graph_color": "#c0392b", "default_limit": 36.0},
+    {"label": "大規模荒らし", "color": "#ff7a45", "graph_color": "#d35400", "default_limit": 27.0},
+    {"label": "中規模荒らし", "color": "#ffa940", "graph_color": "#f39c12", "default_limit": 15.0},
+    {"label": "小規模荒らし", "color": "#40c057", "graph_color": "#27ae60", "default_limit": 6.1},
+]
+
+# 監視領域や参照画像が設定されていないときのエラーメッセージ
+SETTINGS_ERROR = "設定を確認してください"
+
+# 1回のチェック結果
+# level: 該当した LEVELS_DATA の要素 (該当なしは None)
+# updated: 比較をやり直したかどうか (タイルに変化がなければ False で前回の値を再利用)
+# error / tile_errors: 失敗時の理由とタイルごとの取得エラー
+# heatmap_image: ピクセルごとの被害回数の画像 (DetectionEngine.show_heatmap が True のときだけ)
+CheckResult = namedtuple("CheckResult", [
+    "timestamp", "diff_pct", "changed_pixels", "opaque_pixels", "level", "updated",
+    "live_image", "diff_image", "error", "tile_errors", "heatmap_image",
+], defaults=(None,))
+
+
+def safe_int_quad(text, default):
+    """カンマ区切りの4つの整数をパースし、不正な場合は'error'を返します。"""
+    try:
+        parts = [int(v.strip()) for v in text.split(",")]
+        return tuple(parts) if len(parts) == 4 else "error"
+    except (ValueError, TypeError):
+        return "error"
+
+
+def default_thresholds():
+    return [data["default_limit"] for data in LEVELS_DATA]
+
+
+def sorted_levels(thresholds):
+    """(しきい値, レベル情報) のリストを、しきい値の大きい順に返します。"""
+    return sorted(zip(thresholds, LEVELS_DATA), key=lambda x: x[0], reverse=True)
+
+
+def classify(diff_pct, thresholds):
+    """差分率がどの荒らしレベルに該当するかを返します。該当なしは None。"""
+    for limit, data in sorted_levels(thresholds):
+        if diff_pct >= limit:
+            return data
+    return None
+
+
+def resolve_path(path):
+    """相対パスは、カレントディレクトリになければスクリプトのフォルダを基準に解決します。"""
+    if os.path.isabs(path) or os.path.exists(path):
+        return path
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(script_dir, path)
+
+
+def load_reference(path, streaming=False):
+    """
+    参照画像をトリミングせずに読み込み、比較用に事前計算します。失敗時は例外を送出します。
+    streaming=True の場合は、タイルごとに比較する TiledReference として読み込みます。
+    wplaceのパレットにない色が含まれている場合は標準エラー出力に警告を出します。
+    """
+    abs_path = resolve_path(path)
+    if not os.path.exists(abs_path):
+        raise FileNotFoundError(f"{abs_path} が見つかりません")
+    if streaming:
+        with Image.open(abs_path) as image:
+            reference = TiledReference(image)
+    else:
+        reference = CompiledReference(Image.open(abs_path).convert("RGBA"))
+    warning = reference.off_palette_message()
+    if warning:
+        print(f"警告: {path}: {warning}", file=sys.stderr)
+    return reference
+
+
+class DetectionEngine:
+    """
+    1つの監視領域について、取得・比較・判定を行います。
+    参照が TiledReference の場合はストリーミング比較になり、監視領域を組み立てずに
+    STREAM_BATCH_TILES 枚ずつタイルを取得して比較します (リアルタイム画像と差分画像は作りません)。
+    """
+
+    def __init__(self, reference=None, ref_pixel=DEFAULT_REF_PIXEL, thresholds=None,
+                 fetcher=None, keep_images=True, metrics=None, heatmaps=None):
+        self.reference = reference
+        self.ref_pixel = ref_pixel
+        self.thresholds = thresholds if thresholds is not None else default_thresholds()
+        self.fetcher = fetcher if fetcher is not None else TileFetcher()
+        # False の場合は差分画像を作らない (ヘッドレス実行時のメモリ・CPU節約)
+        # リアルタイム画像は監視領域の大きさしかないので、アーカイブ用に常に結果へ含める
+        self.keep_images = keep_images
+        self.metrics = metrics if metrics is not None else METRICS
+        self.last_crop_key = None
+        self.last_crop = None
+        # 前回のクロップから内容が変わりうる範囲 (変化したタイルの矩形)。None は全体
+        self.last_crop_hints = None
+        self._incremental = None
+        # 比較を別の場所で行う関数 comparer(engine, live) -> DiffResult (parallel.ProcessPool が設定)。
+        # None ならこのスレッドで IncrementalDiff により比較する
+        self.comparer = None
+        # 監視領域ごとの被害回数を数える先 (heatmap.HeatmapStore)。ストリーミング比較では数えない
+        self.heatmaps = heatmaps
+        self._heatmap_mismatch = None # comparer で比較したときの前回の不一致のマスク
+        self.show_heatmap = False
+        # ストリーミング比較でのタイルごとの (差分ピクセル数, 監視対象ピクセル数)
+        self._tile_counts = {}
+        self.last_result = None
+
+    @property
+    def streaming(self):
+        return isinstance(self.reference, TiledReference)
+
+    def set_reference(self, reference):
+        self.reference = reference
+        # 参照が変わったら次のチェックは必ず比較し直す
+        self.last_crop_key = None
+        self.last_result = None
+        self._incremental = None
+        self._heatmap_mismatch = None
+        self._tile_counts = {}
+
+    def count_heatmap(self, mismatch):
+        """
+        comparer で比較したときに、不一致のピクセル (真偽値配列) からヒートマップを数えます。
+        IncrementalDiff と同じく、前回から新たに不一致になったピクセルだけを数え、最初の比較は数えません。
+        """
+        previous, self._heatmap_mismatch = self._heatmap_mismatch, mismatch
+        if self.heatmaps is None or previous is None or previous.shape != mismatch.shape:
+            return
+        self.heatmaps.get(self.ref_pixel, self.reference.size).add((slice(None), slice(None)), mismatch & ~previous)
+
+    def tile_coords(self):
+        """監視領域がカバーするタイル座標のリストを返します。"""
+        tile_x, tile_y, x_in_tile, y_in_tile = self.ref_pixel
+        width, height = self.reference.size
+        _, _, start_tile_x, start_tile_y, end_tile_x, end_tile_y = region_tiles(
+            tile_x, tile_y, x_in_tile, y_in_tile, width, height)
+        return [(tx, ty) for tx in range(start_tile_x, end_tile_x + 1)
+                for ty in range(start_tile_y, end_tile_y + 1)]
+
+    def fetch_region(self, batch=None):
+        """
+        指定されたタイル座標とタイル内座標、参照画像のサイズに基づいて
+        必要なタイルから監視領域と重なる部分だけを切り出して組み立て、返します。
+        batch を渡した場合は取得を行わず、その中から必要なタイルだけを使います。
+        戻り値: (クロップしたインデックス配列, 前回から変化したかどうか, タイルごとのエラー)
+        タイルの内容も監視領域も前回と同じ場合は、組み立てを省いて前回の画像を返します。
+        """
+        tile_x, tile_y, x_in_tile, y_in_tile = self.ref_pixel
+        width, height = self.reference.size
+
+        # 監視領域のグローバル座標を計算
+        global_x, global_y, *_ = region_tiles(tile_x, tile_y, x_in_tile, y_in_tile, width, height)
+
+        # 必要なタイルを並列に取得・デコード
+        coords = self.tile_coords()
+        if batch is None:
+            batch = self.fetcher.fetch_many(coords)
+
+        # 欠けたタイルがあると差分が不正確になるため、このチェックは失敗扱いにする
+        errors = {coord: batch.errors.get(coord, "取得されていません")
+                  for coord in coords if coord not in batch.tiles}
+        if errors:
+            return None, False, errors
+
+        changed = any(coord in batch.changed for coord in coords)
+        crop_key = (tile_x, tile_y, x_in_tile, y_in_tile, width, height)
+        if not changed and crop_key == self.last_crop_key and self.last_crop is not None:
+            return self.last_crop, False, {}
+
+        started = time.perf_counter()
+        # 監視領域が前回と同じなら、内容の変わったタイルの範囲だけを差分更新の対象にする
+        if crop_key == self.last_crop_key:
+            self.last_crop_hints = [
+                (tx * TILE_SIZE - global_x, ty * TILE_SIZE - global_y,
+                 (tx + 1) * TILE_SIZE - global_x, (ty + 1) * TILE_SIZE - global_y)
+                for tx, ty in coords if (tx, ty) in batch.changed]
+        else:
+            self.last_crop_hints = None
+        self.last_crop = assemble_region({coord: batch.tiles[coord] for coord in coords},
+                                         global_x, global_y, width, height)
+        self.last_crop_key = crop_key
+        self.metrics.observe("crop", time.perf_counter() - started)
+        return self.last_crop, True, {}
+
+    def _check_streaming(self, now, batch=None):
+        """
+        タイルを STREAM_BATCH_TILES 枚ずつ取得し、参照のうちそのタイルに重なる部分とだけ比較します。
+        タイルごとの集計を保持しておき、内容の変わったタイルだけを比較し直して合計します。
+        batch に含まれるタイルは取得し直さずにそのまま使います。
+        """
+        tile_x, tile_y, x_in_tile, y_in_tile = self.ref_pixel
+        width, height = self.reference.size
+        global_x, global_y, *_ = region_tiles(tile_x, tile_y, x_in_tile, y_in_tile, width, height)
+        crop_key = (tile_x, tile_y, x_in_tile, y_in_tile, width, height)
+        if crop_key != self.last_crop_key:
+            self._tile_counts = {}
+            self.last_crop_key = crop_key
+
+        coords = self.tile_coords()
+        errors = {}
+        updated = False
+        compare_sec = 0.0
+        for start in range(0, len(coords), STREAM_BATCH_TILES):
+            group = coords[start:start + STREAM_BATCH_TILES]
+            if batch is not None and all(coord in batch.tiles for coord in group):
+                group_batch = batch
+            else:
+                # タイルキャッシュには置かない (置くと保持するタイルがグループの枚数で収まらなくなる)
+                group_batch = self.fetcher.fetch_many(group, keep=False)
+            for coord in group:
+                tile = group_batch.tiles.get(coord)
+                if tile is None:
+                    errors[coord] = group_batch.errors.get(coord, "取得されていません")
+                    continue
+                if coord in self._tile_counts and coord not in group_batch.changed:
+                    continue
+                started = time.perf_counter()
+                overlap = tile_overlap(coord, tile.shape, global_x, global_y, width, height)
+                if overlap is None:
+                    self._tile_counts[coord] = (0, 0)
+                else:
+                    (x0, y0, _, _), tile_area = overlap
+                    self._tile_counts[coord] = self.reference.compare_rect(x0, y0, tile[tile_area])
+                compare_sec += time.perf_counter() - started
+                updated = True
+            group_batch = tile = None # 次のグループを取得する前にタイルへの参照を手放す
+
+        if errors:
+            # 取得できなかったタイルは、次に取得できたときに必ず比較し直す
+            for coord in errors:
+                self._tile_counts.pop(coord, None)
+            failed = ", ".join(f"({tx}, {ty})" for tx, ty in sorted(errors))
+            return self.error_result(now, f"タイル取得に失敗しました: {failed}", errors)
+        if updated:
+            self.metrics.observe("compare", compare_sec)
+        elif self.last_result is not None:
+            prev = self.last_result
+            return prev._replace(timestamp=now, updated=False, level=classify(prev.diff_pct, self.thresholds))
+
+        changed = sum(counts[0] for counts in self._tile_counts.values())
+        opaque = sum(counts[1] for counts in self._tile_counts.values())
+        diff_pct = (changed / opaque) * 100 if opaque else 0.0
+        self.last_result = CheckResult(now, diff_pct, changed, opaque, classify(diff_pct, self.thresholds),
+                                       True, None, None, None, {})
+        return self.last_result
+
+    def error_result(self, timestamp, error, tile_errors=None):
+        return CheckResult(timestamp, None, None, None, None, False, None, None, error, tile_errors or {})
+
+    def check(self, batch=None):
+        """
+        監視領域を1回チェックし、CheckResult を返します。
+        batch には複数領域でまとめて取得した TileBatch を渡せます。
+        """
+        now = time.time()
+        if self.reference is None or self.ref_pixel is None:
+            return self.error_result(now, SETTINGS_ERROR)
+
+        if self.streaming:
+            try:
+                return self._check_streaming(now, batch)
+            except Exception as e:
+                return self.error_result(now, f"ストリーミング比較中にエラーが発生しました: {e}")
+
+        try:
+            live, changed, tile_errors = self.fetch_region(batch)
+        except Exception as e:
+            return self.error_result(now, f"監視領域の組み立て中にエラーが発生しました: {e}")
+
+        if live is None:
+            failed = ", ".join(f"({tx}, {ty})" for tx, ty in sorted(tile_errors))
+            return self.error_result(now, f"タイル取得に失敗しました: {failed}", tile_errors)
+
+        if not changed and self.last_result is not None:
+            # タイルに変化なし: 前回の結果を再利用する
+            prev = self.last_result
+            result = prev._replace(timestamp=now, updated=False,
+                                   level=classify(prev.diff_pct, self.thresholds))
+        else:
+            with self.metrics.span("compare"):
+                if self.comparer is not None:
+                    diff = self.comparer(self, live)
+                else:
+                    # 前回のフレームから変わったブロックだけを比較し直す
+                    if self._incremental is None:
+                        self._incremental = IncrementalDiff(self.reference, visual=self.keep_images)
+                    heatmap = self.heatmaps.get(self.ref_pixel, self.reference.size) if self.heatmaps is not None else None
+                    diff, _ = self._incremental.update(live, self.last_crop_hints, heatmap)
+            heatmap_image = None
+            if self.show_heatmap and self.heatmaps is not None:
+                heatmap_image = self.heatmaps.get(self.ref_pixel, self.reference.size).render(self.reference.alpha > 0)
+            result = CheckResult(now, diff.diff_pct, diff.changed, diff.opaque,
+                                 classify(diff.diff_pct, self.thresholds), True,
+                                 self.reference.palette.to_image(live), diff.diff_visual, None, {}, heatmap_image)
+        self.last_result = result
+        return result
+
+
+def result_to_record(result, region=None):
+    """CheckResult を JSON に書き出せる辞書に変換します。"""
+    record = {
+        "time": round(result.timestamp, 3),
+        "diff_pct": None if result.diff_pct is None else round(result.diff_pct, 4),
+        "changed_pixels": result.changed_pixels,
+        "opaque_pixels": result.opaque_pixels,
+        "level": result.level["label"] if result.level else None,
+        "updated": result.updated,
+    }
+    if region is not None:
+        record["region"] = region
+    if result.error:
+        record["error"] = result.error
+        record["tile_errors"] = {f"{tx},{ty}": reason for (tx, ty), reason in result.tile_errors.items()}
+    return record
+
+
+class WatchlistScheduler:
+    """
+    複数の監視領域が必要とするタイルの和集合を求め、各タイルを1サイクルに1回だけ取得して
+    そのタイルに重なるすべての領域に配ります。リクエスト数は領域数ではなくタイル数に比例します。
+    run_due() では領域ごとの適応的な間隔 (polling.AdaptiveInterval) に従い、期限が来た領域だけをチェックします。
+    max_rps を指定すると、タイルのリクエスト数を1秒あたりその件数以下に抑えます。
+    check_executor (Executor) を渡すと、期限が来た領域のチェックを並行して行います。
+    """
+
+    def __init__(self, engines, fetcher, min_interval=DEFAULT_INTERVAL_MS / 1000,
+                 max_interval=DEFAULT_MAX_INTERVAL_SEC, max_rps=None, metrics=None, check_executor=None):
+        self.engines = list(engines)  # [(領域名, DetectionEngine), ...]
+        self.fetcher = fetcher
+        self.metrics = metrics if metrics is not None else METRICS
+        self.check_executor = check_executor
+        self.budget = RateBudget(max_rps) if max_rps else None
+        self.intervals = [AdaptiveInterval(min_interval, max_interval) for _ in self.engines]
+        # 最初のチェックも領域ごとにずらして、同じ瞬間に集中しないようにする
+        now = time.monotonic()
+        self.next_due = [now + random.uniform(0, min_interval) if len(self.engines) > 1 else now
+                         for _ in self.engines]
+
+    def tile_coords(self):
+        """まとめて取得するタイル座標を返します。ストリーミング比較の領域は自分で少しずつ取得するので含めません。"""
+        coords = set()
+        for _, engine in self.engines:
+            if not engine.streaming:
+                coords.update(engine.tile_coords())
+        return sorted(coords)
+
+    def run_cycle(self):
+        """全領域を1回ずつチェックし、[(領域名, CheckResult), ...] を返します。"""
+        batch = self.fetcher.fetch_many(self.tile_coords())
+        results = self._check_all([engine for _, engine in self.engines], batch)
+        return [(name, result) for (name, _), result in zip(self.engines, results)]
+
+    def _check_all(self, engines, batch):
+        if self.check_executor is None or len(engines) < 2:
+            return [engine.check(batch) for engine in engines]
+        return list(self.check_executor.map(lambda engine: engine.check(batch), engines))
+
+    def run_due(self, now=None):
+        """
+        期限が来た領域をチェックし、[(領域名, CheckResult), ...] を返します。
+        期限の古い順に選び、リクエスト数の上限に達したら残りは次回に回します。
+        """
+        now = time.monotonic() if now is None else now
+        due = sorted((i for i, t in enumerate(self.next_due) if t <= now), key=lambda i: self.next_due[i])
+        selected, coords = [], set()
+        for i in due:
+            engine = self.engines[i][1]
+            try:
+                needed = set(engine.tile_coords()) - coords
+            except Exception:
+                needed = set() # 設定が不完全な領域は check() がエラー結果を返す
+            if self.budget is not None and needed and not self.budget.try_take(len(needed), now):
+                break
+            selected.append(i)
+            if not engine.streaming:
+                coords |= needed
+        if not selected:
+            return []
+
+        started = time.monotonic()
+        scheduled = min(self.intervals[i].interval for i in selected)
+        batch = self.fetcher.fetch_many(sorted(coords))
+        results = []
+        checked = self._check_all([self.engines[i][1] for i in selected], batch)
+        finished = time.monotonic()
+        for i, result in zip(selected, checked):
+            self.next_due[i] = finished + jittered(self.intervals[i].observe(result))
+            results.append((self.engines[i][0], result))
+
+        elapsed = time.monotonic() - started
+        self.metrics.observe("tick", elapsed)
+        if elapsed > scheduled:
+            self.metrics.inc("tick_overruns")
+        return results
+
+    def wait_time(self, now=None):
+        """次にチェックすべき領域の期限までの秒数を返します (リクエスト数の上限による待ちも含む)。"""
+        now = time.monotonic() if now is None else now
+        wait = max(0.0, min(self.next_due, default=now) - now)
+        if self.budget is not None:
+            wait = max(wait, self.budget.wait_time(now))
+        return wait
+
+
+def run(scheduler, out, count=None, store=None, archiver=None):
+    """
+    期限が来た領域のチェックを繰り返し、結果を1行1件のJSONで out に書き出します。
+    count を指定すると、チェックを行った回数がそれに達したところで終了します。
+    store (HistoryStore) を渡すと、結果をディスクにも記録します。
+    archiver (SnapshotArchiver) を渡すと、変化のあったフレームを保存します。
+    """
+    done = 0
+    while count is None or done < count:
+        results = scheduler.run_due()
+        for region, result in results:
+            out.write(json.dumps(result_to_record(result, region), ensure_ascii=False) + "\n")
+            if store is not None:
+                store.add_result(region, result)
+            if archiver is not None:
+                archiver.add_result(region, result)
+        if results:
+            out.flush()
+            done += 1
+        if count is not None and done >= count:
+            break
+        time.sleep(scheduler.wait_time())
+
+
+def _parse_thresholds(text):
+    values = [float(v.strip()) for v in text.split(",")]
+    if len(values) != len(LEVELS_DATA):
+        raise argparse.ArgumentTypeError(f"しきい値は{len(LEVELS_DATA)}個をカンマ区切りで指定してください")
+    return values
+
+
+def _parse_ref_pixel(text):
+    quad = safe_int_quad(text, DEFAULT_REF_PIXEL)
+    if quad == "error":
+        raise argparse.ArgumentTypeError("座標はカンマ区切りの4つの整数で入力してください")
+    return quad
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="wplace 荒らし検出 (ヘッドレス版)")
+    parser.add_argument("--ref-pixel", type=_parse_ref_pixel, default=DEFAULT_REF_PIXEL,
+                        help="監視開始位置 'タイルx, タイルy, タイル内x, タイル内y'")
+    parser.add_argument("--reference", default=DEFAULT_SEAL_IMAGE_PATH, help="参照元画像のパス")
+    parser.add_argument("--interval", type=float, default=DEFAULT_INTERVAL_MS / 1000,
+                        help="最短のチェック間隔 (秒)。差分率が変わった領域はこの間隔でチェックする")
+    parser.add_argument("--max-interval", type=float, default=DEFAULT_MAX_INTERVAL_SEC,
+                        help="変化のない領域のチェック間隔の上限 (秒)。--interval と同じにすると固定間隔になる")
+    parser.add_argument("--max-rps", type=float, default=None, help="1秒あたりのタイルリクエスト数の上限")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="処理時間のメトリクスを http://127.0.0.1:<port>/metrics で公開する")
+    parser.add_argument("--thresholds", type=_parse_thresholds, default=None,
+                        help="荒らしレベルのしきい値 (%%) を大きいレベルから順にカンマ区切りで指定")
+    parser.add_argument("--output", default="-", help="出力先ファイル ('-' で標準出力)")
+    parser.add_argument("--count", type=int, default=None, help="チェック回数 (省略時は無限)")
+    parser.add_argument("--base-url", default=TILE_BASE_URL, help="タイル配信元のベースURL")
+    parser.add_argument("--tile-cache-mb", type=float, default=DEFAULT_CACHE_BYTES / (1024 * 1024),
+                        help="デコード済みタイルのキャッシュ上限 (MB)")
+    parser.add_argument("--watchlist", default=None,
+                        help="複数の監視領域を定義したJSONファイル (指定時は --ref-pixel 等より優先)")
+    parser.add_argument("--store", default=None, help="差分履歴を保存するSQLiteファイル")
+    parser.add_argument("--archive-dir", default=None, help="変化のあったフレームを保存するフォルダ")
+    parser.add_argument("--heatmap-dir", default=None, help="監視領域ごとのピクセル別の被害回数を保存するフォルダ")
+    parser.add_argument("--record", default=None, help="取得したタイルを記録するフォルダ (replay.py で再生できます)")
+    parser.add_argument("--shared-cache", nargs="?", const=DEFAULT_SHARED_CACHE_DIR, default=None,
+                        help=f"同じマシンの他の検知プロセスとデコード済みのタイルを共有するフォルダ (省略時は {DEFAULT_SHARED_CACHE_DIR})")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="PNGのデコードと比較を振り分けるプロセス数 (省略時は1プロセスで実行)")
+    parser.add_argument("--streaming", action="store_true",
+                        help=f"監視領域を組み立てず、タイル{STREAM_BATCH_TILES}枚ずつ比較する (巨大な参照画像向け)")
+    return parser
+
+
+def main(argv=None):
+    parser = build_arg_parser()
+    args = parser.parse_args(argv)
+    cache = TileCache(int(args.tile_cache_mb * 1024 * 1024))
+    recorder = TileRecorder(args.record) if args.record else None
+    try:
+        shared_cache = SharedTileCache(args.shared_cache) if args.shared_cache else None
+    except OSError as e:
+        parser.error(f"共有キャッシュのフォルダを使えません: {e}")
+    pool = None
+    if args.processes:
+        from parallel import ProcessPool
+        pool = ProcessPool(args.processes)
+        fetcher = pool.fetcher(args.base_url, max_workers=max(DEFAULT_MAX_WORKERS, pool.processes),
+                               cache=cache, recorder=recorder, shared_cache=shared_cache)
+    else:
+        fetcher = TileFetcher(args.base_url, cache=cache, recorder=recorder, shared_cache=shared_cache)
+    try:
+        if args.watchlist:
+            from watchlist import load_watchlist
+            engines = load_watchlist(args.watchlist, fetcher)
+        else:
+            reference = load_reference(args.reference, args.streaming)
+            engines = [(None, DetectionEngine(reference, args.ref_pixel, args.thresholds, fetcher, keep_images=False))]
+    except Exception as e:
+        print(f"設定の読み込み中にエラーが発生しました: {e}", file=sys.stderr)
+        fetcher.close()
+        if recorder is not None:
+            recorder.close()
+        if pool is not None:
+            pool.close()
+        return 1
+
+    heatmaps = HeatmapStore(args.heatmap_dir) if args.heatmap_dir else None
+    for name, engine in engines:
+        engine.heatmaps = heatmaps
+        if heatmaps is not None and engine.streaming:
+            print(f"{name or '監視領域'}: ストリーミング比較ではヒートマップを数えません", file=sys.stderr)
+        if pool is not None:
+            pool.attach(engine)
+    interval = max(0.0, args.interval)
+    scheduler = WatchlistScheduler(engines, fetcher, interval, max(interval, args.max_interval), args.max_rps,
+                                   check_executor=pool.check_executor if pool is not None else None)
+    store = HistoryStore(args.store) if args.store else None
+    archiver = SnapshotArchiver(args.archive_dir) if args.archive_dir else None
+    metrics_server = None
+    if args.metrics_port is not None:
+        try:
+            metrics_server = start_metrics_server(METRICS, args.metrics_port)
+        except OSError as e:
+            print(f"メトリクスのポート {args.metrics_port} を開けませんでした: {e}", file=sys.stderr)
+    out = sys.stdout if args.output == "-" else open(args.output, "a", encoding="utf-8")
+    try:
+        run(scheduler, out, args.count, store, archiver)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"タイルキャッシュ: {json.dumps(cache.stats())}", file=sys.stderr)
+        fetcher.close()
+        if pool is not None:
+            pool.close()
+        if store is not None:
+            store.close()
+        if archiver is not None:
+            archiver.close()
+        if heatmaps is not None:
+            heatmaps.close()
+        if recorder is not None:
+            recorder.close()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+            metrics_server.server_close()
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+監視領域のピクセルごとの被害回数 (ヒートマップ)。
+差分率だけでは作品のどこが繰り返し狙われているかが分からないため、
+ピクセルが「参照と一致」から「不一致」に変わった回数をピクセルごとに数えます。
+カウンタはメモリマップしたファイル (.npy) に置くので、長時間の監視でも再起動をまたいで積み上がります。
+更新は IncrementalDiff が比較し直した矩形の中だけで行うので、1回あたりのコストは変化の量にしか比例しません。
+"""
+import os
+import threading
+
+import numpy as np
+from PIL import Image
+
+HEATMAP_DTYPE = np.uint32
+
+
+def heatmap_filename(ref_pixel, size):
+    """監視領域 (位置と大きさ) ごとのファイル名を返します。"""
+    tile_x, tile_y, x_in_tile, y_in_tile = ref_pixel
+    width, height = size
+    return f"{tile_x}_{tile_y}_{x_in_tile}_{y_in_tile}_{width}x{height}.npy"
+
+
+class ChangeHeatmap:
+    """1つの監視領域のカウンタ配列。counts は (高さ, 幅) の np.memmap です。"""
+
+    def __init__(self, path, size):
+        width, height = size
+        shape = (height, width)
+        counts = None
+        if os.path.exists(path):
+            try:
+                counts = np.lib.format.open_memmap(path, mode="r+")
+            except (ValueError, OSError):
+                counts = None
+            if counts is not None and (counts.shape != shape or counts.dtype != HEATMAP_DTYPE):
+                del counts # 形の合わない古いファイルは作り直す
+                counts = None
+        if counts is None:
+            counts = np.lib.format.open_memmap(path, mode="w+", dtype=HEATMAP_DTYPE, shape=shape)
+        self.path = path
+        self.counts = counts
+
+    def add(self, area, newly_changed):
+        """area (スライスの組) のうち、新たに不一致になったピクセル (真偽値配列) に1を足します。"""
+        self.counts[area] += newly_changed
+
+    def render(self, mask=None):
+        """
+        カウンタを 黒 → 赤 → 黄 の画像にして返します。回数は対数で正規化し、最も多いピクセルが黄色になります。
+        mask (監視対象の真偽値配列) の外側は黒にします。
+        """
+        counts = np.asarray(self.counts)
+        peak = int(counts.max()) if counts.size else 0
+        rgb = np.zeros(counts.shape + (3,), dtype=np.uint8)
+        if peak == 0:
+            return Image.fromarray(rgb, "RGB")
+        level = np.log1p(counts, dtype=np.float32) / np.float32(np.log1p(peak))
+        rgb[..., 0] = np.minimum(level * 2, 1) * 255
+        rgb[..., 1] = np.clip(level * 2 - 1, 0, 1) * 255
+        if mask is not None:
+            rgb[~mask] = 0
+        return Image.fromarray(rgb, "RGB")
+
+    def flush(self):
+        self.counts.flush()
+
+
+class HeatmapStore:
+    """監視領域ごとの ChangeHeatmap を directory に置き、開いたものを使い回します。"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._heatmaps = {}
+        self._lock = threading.Lock()
+
+    def get(self, ref_pixel, size):
+        key = (tuple(ref_pixel), tuple(size))
+        with self._lock:
+            heatmap = self._heatmaps.get(key)
+            if heatmap is None:
+                path = os.path.join(self.directory, heatmap_filename(ref_pixel, size))
+                heatmap = self._heatmaps[key] = ChangeHeatmap(path, size)
+            return heatmap
+
+    def close(self):
+        with self._lock:
+            for heatmap in self._heatmaps.values():
+                heatmap.flush()
+            self._heatmaps.clear()
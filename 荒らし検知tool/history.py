@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+差分履歴を保持する固定容量のリングバッファ。
+事前に確保したNumPy配列に書き込むだけなので、追加はO(1)で再確保も発生しません。
+"""
+import numpy as np
+
+DEFAULT_HISTORY_CAPACITY = 6 * 60 * 60 # 1秒間隔で6時間分
+
+
+class RingBuffer:
+    """
+    容量固定のリングバッファ。
+    各値を配列の2か所 (i と i + capacity) に書き込んでおくことで、
+    古い順に並んだデータをコピーなしの連続したビューとして返せます。
+    """
+
+    def __init__(self, capacity, dtype=np.float64):
+        if capacity < 1:
+            raise ValueError("capacity は1以上を指定してください")
+        self.capacity = capacity
+        self._data = np.zeros(2 * capacity, dtype=dtype)
+        self._start = 0
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def append(self, value):
+        if self._len < self.capacity:
+            index = self._start + self._len
+            self._len += 1
+        else:
+            # 満杯なら最も古い値の位置に上書きし、先頭を1つ進める
+            index = self._start
+            self._start = (self._start + 1) % self.capacity
+        index %= self.capacity
+        self._data[index] = value
+        self._data[index + self.capacity] = value
+
+    def clear(self):
+        self._start = 0
+        self._len = 0
+
+    def view(self, last=None):
+        """古い順に並んだ読み取り専用ビューを返します。last を指定すると末尾の last 件だけ返します。"""
+        count = self._len if last is None else min(last, self._len)
+        end = self._start + self._len
+        view = self._data[end - count:end]
+        view.flags.writeable = False
+        return view
+
+    def last(self):
+        if self._len == 0:
+            raise IndexError("バッファが空です")
+        return self._data[self._start + self._len - 1]
+
+
+class History:
+    """時刻と差分率を対にして保持する履歴。"""
+
+    def __init__(self, capacity=DEFAULT_HISTORY_CAPACITY):
+        self.times = RingBuffer(capacity)
+        self.values = RingBuffer(capacity)
+
+    def __len__(self):
+        return len(self.times)
+
+    def append(self, timestamp, value):
+        self.times.append(timestamp)
+        self.values.append(value)
+
+    def clear(self):
+        self.times.clear()
+        self.values.clear()
+
+    def window(self, last=None):
+        """末尾 last 件の (時刻, 値) をコピーなしのビューで返します。"""
+        return self.times.view(last), self.values.view(last)
+
+    def since(self, start_time):
+        """start_time 以降の (時刻, 値) をコピーなしのビューで返します。"""
+        times = self.times.view()
+        index = int(np.searchsorted(times, start_time, side="left"))
+        return times[index:], self.values.view()[index:]
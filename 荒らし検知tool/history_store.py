@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+差分履歴をディスクに保存する追記専用の時系列ストア (SQLite)。
+全チェックの生データに加えて、1分・1時間単位の集計 (件数・合計・最小・最大) を
+書き込み時に更新しておくため、長期間のグラフも生データを読まずに取得できます。
+"""
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+DEFAULT_REGION = "default"
+ROLLUP_SECONDS = (60, 3600) # 書き込み時に集計しておくバケット幅 (秒)
+COMMIT_EVERY = 60           # この件数たまったらコミットする
+COMMIT_INTERVAL_SEC = 5.0   # 件数に満たなくても、この秒数が経ったらコミットする
+
+# start: バケットの開始時刻 (UNIX秒) / mean: バケット内の平均差分率
+Bucket = namedtuple("Bucket", ["start", "count", "min", "max", "mean"])
+
+# 領域名とレベル名は整数IDに置き換え、生データは (領域, 時刻) 順に詰めて格納する
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS regions (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS levels (id INTEGER PRIMARY KEY, label TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS samples (
+    region INTEGER NOT NULL,
+    ts REAL NOT NULL,
+    diff_pct REAL NOT NULL,
+    level INTEGER,
+    changed_pixels INTEGER,
+    PRIMARY KEY (region, ts)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rollups (
+    region INTEGER NOT NULL,
+    bucket_sec INTEGER NOT NULL,
+    bucket_start INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    sum REAL NOT NULL,
+    min REAL NOT NULL,
+    max REAL NOT NULL,
+    PRIMARY KEY (region, bucket_sec, bucket_start)
+) WITHOUT ROWID;
+"""
+
+_UPSERT_ROLLUP = """
+INSERT INTO rollups (region, bucket_sec, bucket_start, count, sum, min, max)
+VALUES (?, ?, ?, 1, ?, ?, ?)
+ON CONFLICT (region, bucket_sec, bucket_start) DO UPDATE SET
+    count = count + 1,
+    sum = sum + excluded.sum,
+    min = MIN(min, excluded.min),
+    max = MAX(max, excluded.max)
+"""
+
+
+class HistoryStore:
+    """
+    差分履歴の保存と、バケット単位に集計した範囲クエリを提供します。
+    書き込みはまとめてコミットし、複数スレッドから呼び出せます。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._last_commit = time.monotonic()
+        self._region_ids = dict(self._conn.execute("SELECT name, id FROM regions"))
+        self._level_ids = dict(self._conn.execute("SELECT label, id FROM levels"))
+
+    def _intern(self, table, column, cache, name):
+        """名前に対応する整数IDを返します。初めての名前なら登録します。"""
+        if name not in cache:
+            self._conn.execute(f"INSERT OR IGNORE INTO {table} ({column}) VALUES (?)", (name,))
+            cache[name] = self._conn.execute(f"SELECT id FROM {table} WHERE {column} = ?", (name,)).fetchone()[0]
+        return cache[name]
+
+    def add(self, region, timestamp, diff_pct, level=None, changed_pixels=None):
+        """
+        1件のチェック結果を追記し、集計テーブルを更新します。
+        同じ領域・同じ時刻の結果がすでにあれば何もしません (集計を二重に数えないため)。
+        """
+        with self._lock:
+            region_id = self._intern("regions", "name", self._region_ids, region)
+            level_id = None if level is None else self._intern("levels", "label", self._level_ids, level)
+            cursor = self._conn.execute("INSERT OR IGNORE INTO samples VALUES (?, ?, ?, ?, ?)",
+                                        (region_id, timestamp, diff_pct, level_id, changed_pixels))
+            if cursor.rowcount != 1:
+                return
+            for bucket_sec in ROLLUP_SECONDS:
+                bucket_start = int(timestamp // bucket_sec) * bucket_sec
+                self._conn.execute(_UPSERT_ROLLUP, (region_id, bucket_sec, bucket_start, diff_pct, diff_pct, diff_pct))
+            self._pending += 1
+            if self._pending >= COMMIT_EVERY or time.monotonic() - self._last_commit >= COMMIT_INTERVAL_SEC:
+                self._commit_locked()
+
+    def add_result(self, region, result):
+        """CheckResult を追記します。取得に失敗した結果は記録しません。"""
+        if result.error or result.diff_pct is None:
+            return
+        level = result.level["label"] if result.level else None
+        self.add(region or DEFAULT_REGION, result.timestamp, result.diff_pct, level, result.changed_pixels)
+
+    def _commit_locked(self):
+        self._conn.commit()
+        self._pending = 0
+        self._last_commit = time.monotonic()
+
+    def flush(self):
+        with self._lock:
+            self._commit_locked()
+
+    def close(self):
+        with self._lock:
+            self._commit_locked()
+            self._conn.close()
+
+    def regions(self):
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT name FROM regions ORDER BY id")]
+
+    def samples(self, region, start, end):
+        """[start, end) の生データを [(時刻, 差分率, レベル, 差分ピクセル数), ...] で返します。"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT s.ts, s.diff_pct, l.label, s.changed_pixels FROM samples s "
+                "JOIN regions r ON r.id = s.region LEFT JOIN levels l ON l.id = s.level "
+                "WHERE r.name = ? AND s.ts >= ? AND s.ts < ? ORDER BY s.ts",
+                (region, start, end)).fetchall()
+
+    def query(self, region, start, end, bucket_sec):
+        """
+        [start, end) を bucket_sec 秒ごとのバケットに分け、最小・最大・平均を返します。
+        bucket_sec を割り切れる最も粗い集計テーブルから読むため、長い期間でも読む行数は少なく済みます。
+        集計テーブルの境界に揃わない端のバケットは、集計テーブルの粒度で丸められます。
+        """
+        bucket_sec = int(bucket_sec)
+        if bucket_sec < 1:
+            raise ValueError("bucket_sec は1以上を指定してください")
+
+        source = max((sec for sec in ROLLUP_SECONDS if bucket_sec % sec == 0), default=None)
+        with self._lock:
+            row = self._conn.execute("SELECT id FROM regions WHERE name = ?", (region,)).fetchone()
+            if row is None:
+                return []
+            region = row[0]
+            if source is None:
+                rows = self._conn.execute(
+                    "SELECT CAST(ts / :b AS INTEGER) * :b AS bucket, COUNT(*), MIN(diff_pct), MAX(diff_pct), "
+                    "AVG(diff_pct) FROM samples WHERE region = :r AND ts >= :s AND ts < :e "
+                    "GROUP BY bucket ORDER BY bucket",
+                    {"b": bucket_sec, "r": region, "s": start, "e": end}).fetchall()
+            else:
+                rows = self._conn.execute(
+                    "SELECT (bucket_start / :b) * :b AS bucket, SUM(count), MIN(min), MAX(max), "
+                    "SUM(sum) / SUM(count) FROM rollups "
+                    "WHERE region = :r AND bucket_sec = :src AND bucket_start >= :s AND bucket_start < :e "
+                    "GROUP BY bucket ORDER BY bucket",
+                    {"b": bucket_sec, "src": source, "r": region,
+                     "s": int(start // source) * source, "e": end}).fetchall()
+        return [Bucket(*row) for row in rows]
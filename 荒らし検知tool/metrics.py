@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+処理ごとの所要時間の計測と、Prometheus形式での公開。
+チェックの各段階 (タイル取得・デコード・監視領域の組み立て・差分計算・描画など) を span() で囲むと、
+段階ごとのヒストグラムに記録されます。GUIの診断パネルとローカルのHTTPエンドポイント (/metrics) から参照できます。
+"""
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from history import RingBuffer
+
+# ヒストグラムのバケットの上限 (秒)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+RECENT_SAMPLES = 512 # 中央値・p95 の計算に使う直近の計測数
+
+# 段階名と表示名
+STAGE_LABELS = {
+    "tick": "チェック全体",
+    "fetch": "タイル取得 (1枚)",
+    "decode": "PNGデコード (1枚)",
+    "crop": "監視領域の組み立て",
+    "compare": "差分計算",
+    "status": "ステータス表示",
+    "graph": "グラフ描画",
+    "display": "画像表示",
+}
+
+COUNTER_HELP = {
+    "tick_overruns": "チェックにかかった時間がチェック間隔を超えた回数",
+}
+
+# count: 計測回数 / total: 合計秒数 / p50, p95, max: 直近の計測の中央値・95パーセンタイル・最大 (秒)
+StageSummary = namedtuple("StageSummary", ["count", "total", "p50", "p95", "max"])
+
+
+class Histogram:
+    """累積バケット形式のヒストグラム。パーセンタイル表示用に直近の値も保持します。"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # 最後は +Inf
+        self.count = 0
+        self.total = 0.0
+        self.recent = RingBuffer(RECENT_SAMPLES)
+
+    def observe(self, seconds):
+        index = next((i for i, bound in enumerate(self.buckets) if seconds <= bound), len(self.buckets))
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        self.recent.append(seconds)
+
+    def summary(self):
+        recent = self.recent.view()
+        if len(recent) == 0:
+            return StageSummary(self.count, self.total, 0.0, 0.0, 0.0)
+        p50, p95 = np.percentile(recent, [50, 95])
+        return StageSummary(self.count, self.total, float(p50), float(p95), float(recent.max()))
+
+
+class Metrics:
+    """段階ごとのヒストグラムとカウンタをまとめて管理します。複数スレッドから記録できます。"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    @contextmanager
+    def span(self, stage):
+        """with ブロックの所要時間を stage のヒストグラムに記録します。"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def inc(self, name, amount=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def counter(self, name):
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def stages(self):
+        """{段階名: StageSummary} を返します。"""
+        with self._lock:
+            return {stage: histogram.summary() for stage, histogram in self._histograms.items()}
+
+    def render_prometheus(self):
+        """Prometheusのテキスト形式 (version 0.0.4) で全メトリクスを返します。"""
+        lines = [
+            "# HELP wplace_stage_seconds チェックの各段階にかかった時間 (秒)",
+            "# TYPE wplace_stage_seconds histogram",
+        ]
+        with self._lock:
+            for stage, histogram in sorted(self._histograms.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(float(bound))
+                    lines.append(f'wplace_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+                lines.append(f'wplace_stage_seconds_sum{{stage="{stage}"}} {histogram.total!r}')
+                lines.append(f'wplace_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+            counters = dict(self._counters)
+        for name in sorted(set(counters) | set(COUNTER_HELP)):
+            lines.append(f"# HELP wplace_{name}_total {COUNTER_HELP.get(name, name)}")
+            lines.append(f"# TYPE wplace_{name}_total counter")
+            lines.append(f"wplace_{name}_total {counters.get(name, 0)}")
+        return "\n".join(lines) + "\n"
+
+
+def start_metrics_server(metrics, port, host="127.0.0.1"):
+    """
+    metrics を /metrics で公開するHTTPサーバーを別スレッドで起動し、サーバーを返します。
+    既定ではローカルからの接続だけを受け付けます。ポートが使えない場合は OSError を送出します。
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = metrics.render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
+
+
+# 取得・比較・描画の各処理が記録する既定の計測先
+METRICS = Metrics()
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+wplaceのカラーパレットと、画像をパレットのインデックス配列 (1ピクセル1バイト) に変換する処理。
+タイルと参照画像を同じパレットのインデックスで表しておけば、比較はバイトの一致判定だけで済み、
+RGBA画像と比べてメモリ使用量も1/4になります。
+タイルにパレットにない色が見つかった場合は末尾に追加します。表が満杯なら UNKNOWN (色の分からないピクセル) にします。
+参照画像の変換 (grow=False) では表を増やさず、パレット外の色はすべて UNKNOWN にして、
+比較側 (diff_engine.py) が参照画像のRGBと直接比べます。表は全体で共有するため、参照画像の色で埋まることはありません。
+アルファは「完全に透明」か「不透明」かだけを保持します (半透明は不透明として扱います)。
+"""
+import threading
+
+import numpy as np
+from PIL import Image
+
+MAX_COLORS = 256 # インデックスを uint8 で表せる上限
+TRANSPARENT = 0  # 完全に透明なピクセルのインデックス
+UNKNOWN = MAX_COLORS - 1 # 表に登録できなかった色のインデックス。どの色とも一致しない扱いにする
+UNKNOWN_RGBA = (255, 0, 255, 255) # UNKNOWN を画像に戻すときの色
+_HASH_BITS = 16  # 色 -> インデックスの引き当てに使うハッシュ表の大きさ (2^16 スロット)
+
+# wplaceのパレット (無料色 + 有料色)
+WPLACE_COLORS = [
+    (0, 0, 0), (60, 60, 60), (120, 120, 120), (210, 210, 210), (255, 255, 255),
+    (96, 0, 24), (237, 28, 36), (255, 127, 39), (246, 170, 9), (249, 221, 59),
+    (255, 250, 188), (14, 185, 104), (19, 230, 123), (135, 255, 94), (12, 129, 110),
+    (16, 174, 166), (19, 225, 190), (40, 80, 158), (64, 147, 228), (96, 247, 242),
+    (107, 80, 246), (153, 177, 251), (120, 12, 153), (170, 56, 185), (224, 159, 249),
+    (203, 0, 122), (236, 31, 128), (243, 141, 169), (104, 70, 52), (149, 104, 42),
+    (248, 178, 119),
+    (170, 170, 170), (165, 14, 30), (250, 128, 114), (228, 92, 26), (214, 181, 148),
+    (156, 132, 49), (197, 173, 49), (232, 212, 95), (74, 107, 58), (90, 148, 74),
+    (132, 197, 115), (15, 121, 159), (187, 250, 242), (125, 199, 255), (77, 49, 184),
+    (74, 66, 132), (122, 113, 196), (181, 174, 241), (219, 164, 99), (209, 128, 81),
+    (255, 197, 165), (155, 82, 73), (209, 128, 120), (250, 182, 164), (123, 99, 82),
+    (156, 132, 107), (51, 57, 65), (109, 117, 141), (179, 185, 209), (109, 100, 63),
+    (148, 140, 107), (205, 197, 158),
+]
+
+
+def _pack(rgba):
+    """
+    (..., 4) の uint8 配列を、R | G<<8 | B<<16 | A<<24 の uint32 に詰めます。
+    完全に透明な色は0に、それ以外はアルファ255にそろえます。
+    """
+    rgba = np.ascontiguousarray(rgba, dtype=np.uint8)
+    packed = rgba.view("<u4")[..., 0] | np.uint32(0xFF000000)
+    return np.where(rgba[..., 3] == 0, np.uint32(0), packed).astype(np.uint32)
+
+
+class Palette:
+    """
+    色 (RGBA) とインデックスの対応表。複数スレッドから同時に変換できます。
+    rgba[i] はインデックス i の色、canonical[i] は i と同じRGBを持つ最初のインデックスです。
+    比較は canonical どうしで行うため、アルファを無視してRGBだけを比べていた従来の判定と一致します。
+    登録できるのは UNKNOWN を除いた255色までです。
+    """
+
+    def __init__(self, colors=WPLACE_COLORS):
+        self.rgba = np.zeros((MAX_COLORS, 4), dtype=np.uint8)
+        self.canonical = np.zeros(MAX_COLORS, dtype=np.uint8)
+        self.size = 0
+        self._lock = threading.Lock()
+        self._index = {}     # 詰めたRGBA値 -> インデックス
+        self._rgb_first = {} # 詰めたRGB値 -> そのRGBを持つ最初のインデックス
+        self._table = None   # (乗数, スロット -> 色, スロット -> インデックス)
+        self.rgba[UNKNOWN] = UNKNOWN_RGBA
+        self.canonical[UNKNOWN] = UNKNOWN
+
+        self.add_colors([(0, 0, 0, 0)] + [tuple(rgb) + (255,) for rgb in colors])
+        # ここまでが既知のパレット。これ以降に追加された色は「パレット外」として扱う
+        self.base_size = self.size
+
+    def __len__(self):
+        return self.size
+
+    def add(self, color):
+        """色 (RGBAのタプルまたは詰めた値) を登録し、インデックスを返します。表が満杯なら UNKNOWN を返します。"""
+        return self.add_colors([color])[0]
+
+    def add_colors(self, colors):
+        """
+        複数の色をまとめて登録し、インデックスのリストを返します。
+        引き当て表の作り直しは、新しい色が増えたときに最後に1回だけ行います。
+        """
+        packed = [c if isinstance(c, int) else int(_pack(np.array(c, dtype=np.uint8))) for c in colors]
+        with self._lock:
+            size = self.size
+            indices = [self._add_locked(c) for c in packed]
+            if self.size != size or self._table is None:
+                self._table = self._build_table()
+        return indices
+
+    def _add_locked(self, packed):
+        if packed in self._index:
+            return self._index[packed]
+        if self.size >= UNKNOWN:
+            return UNKNOWN # 登録済みの色は変えずに、この色だけを「分からない色」にする
+        index = self.size
+        self.rgba[index] = [(packed >> shift) & 0xFF for shift in (0, 8, 16, 24)]
+        self.canonical[index] = self._rgb_first.setdefault(packed & 0xFFFFFF, index)
+        self._index[packed] = index
+        self.size += 1
+        return index
+
+    def _build_table(self):
+        """登録済みの色が衝突しない乗算ハッシュを探し、配列だけで引ける表を作ります。"""
+        keys = np.array(list(self._index), dtype=np.uint32)
+        values = np.array(list(self._index.values()), dtype=np.uint8)
+        multiplier = np.uint32(0x9E3779B1)
+        for _ in range(1000):
+            slots = (keys * multiplier) >> np.uint32(32 - _HASH_BITS)
+            if len(np.unique(slots)) == len(keys):
+                break
+            multiplier = np.uint32((int(multiplier) * 0x5851F42D + 0x14057B7F) & 0xFFFFFFFF | 1)
+        table_keys = np.ones(1 << _HASH_BITS, dtype=np.uint32) # どの色とも一致しない値 (透明は0に正規化済み)
+        table_values = np.zeros(1 << _HASH_BITS, dtype=np.uint8)
+        table_keys[slots] = keys
+        table_values[slots] = values
+        return multiplier, table_keys, table_values
+
+    def _lookup(self, packed):
+        """詰めた色の配列をインデックスに引き当てます。戻り値: (インデックス, 登録済みかどうか)"""
+        multiplier, table_keys, table_values = self._table
+        slots = (packed * multiplier) >> np.uint32(32 - _HASH_BITS)
+        found = table_keys[slots] == packed
+        return np.where(found, table_values[slots], np.uint8(UNKNOWN)), found
+
+    def is_known(self, index):
+        """インデックスの色 (RGB) が既知のパレットに含まれるかどうかを配列で返します。"""
+        return self.canonical[index] < self.base_size
+
+    def index_rgba(self, rgba, grow=True):
+        """
+        (H, W, 4) の RGBA 配列をインデックス配列 (uint8) に変換します。
+        grow=False なら未登録の色を追加せず、UNKNOWN にします。
+        """
+        packed = _pack(rgba)
+        indices, found = self._lookup(packed)
+        if grow and not found.all():
+            # 未登録の色を追加してから引き直す。入りきらなかった色は UNKNOWN のまま残る
+            self.add_colors(np.unique(packed[~found]).tolist())
+            indices, _ = self._lookup(packed)
+        return indices
+
+    def index_image(self, image, grow=True):
+        """Pillow画像をインデックス配列に変換します。Pモードの画像は画素ごとの変換を省きます。"""
+        if image.mode == "P" and image.palette is not None and image.palette.mode in ("RGB", "RGBA"):
+            entries = np.zeros((256, 4), dtype=np.uint8)
+            entries[:, 3] = 255
+            channels = len(image.palette.mode)
+            raw = np.array(image.getpalette(image.palette.mode) or [], dtype=np.uint8)
+            raw = raw[:raw.size // channels * channels].reshape(-1, channels)[:256]
+            entries[:len(raw), :channels] = raw
+            transparency = image.info.get("transparency")
+            if isinstance(transparency, int):
+                entries[transparency, 3] = 0
+            elif isinstance(transparency, bytes):
+                entries[:len(transparency), 3] = np.frombuffer(transparency, dtype=np.uint8)[:256]
+            # 実際に使われている色だけを引き当てる (使われていないエントリで表を埋めない)
+            pixels = np.asarray(image)
+            used = np.unique(pixels)
+            lut = np.full(256, UNKNOWN, dtype=np.uint8)
+            lut[used] = self.index_rgba(entries[None, used], grow)[0]
+            return lut[pixels]
+        if image.mode != "RGBA":
+            image = image.convert("RGBA")
+        return self.index_rgba(np.asarray(image), grow)
+
+    def to_rgba(self, indices):
+        """インデックス配列を (H, W, 4) の RGBA 配列に戻します。"""
+        return self.rgba[indices]
+
+    def to_image(self, indices):
+        return Image.fromarray(self.to_rgba(indices), "RGBA")
+
+
+# タイルと参照画像で共有する既定のパレット (同じ色が同じインデックスになるよう1つにまとめる)
+DEFAULT_PALETTE = Palette()
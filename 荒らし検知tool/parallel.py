@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+プロセスプールによるPNGデコードと差分計算の並列化。
+デコードも比較もCPUを使う処理のため、1プロセスではGILにより監視領域がいくつあっても1コアしか使えません。
+ProcessPool を使うと、タイルのデコードと領域ごとの比較を複数のプロセスに振り分けます。
+デコードしたタイルと比較する監視領域は共有メモリ (multiprocessing.shared_memory) で受け渡し、
+Pillow画像や配列をpickleしてプロセス間でコピーすることはしません。
+共有メモリのブロックは受け渡しの間だけ借りて使い回し、デコードしたタイルは通常の配列にコピーしてから
+キャッシュに置くので、共有メモリの量はタイルや監視領域の数ではなく同時に処理する数で決まります。
+
+パレットのインデックスはプロセスごとに食い違わないよう、親プロセスのパレットを正とします。
+子プロセスは親から受け取った色の一覧でパレットをそろえ、未知の色に出会った場合だけ
+その色を返して親に登録してもらい、インデックスを付け替えます。
+"""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from diff_engine import CompiledReference, DiffResult, compare_live, mismatch_mask
+from palette import DEFAULT_PALETTE, Palette
+from tile_client import TILE_SIZE, TileFetcher, decode_tile
+
+DEFAULT_PROCESSES = os.cpu_count() or 1
+
+# --- 子プロセス側 ---
+_references = []        # 比較に使う参照 (親の ProcessPool.references と同じ順)
+_compare_palette = None # 比較用のパレット。親の色を同じ順で追加するだけなので、インデックスは常に親と一致する
+_decode_palette = None  # デコード用のパレット。未知の色を追加して親とずれたら作り直す
+
+
+def _palette_from(extra_colors):
+    palette = Palette()
+    palette.add_colors([tuple(color) for color in extra_colors])
+    return palette
+
+
+def _catch_up(palette, extra_colors):
+    """親のパレットに後から追加された色を、同じ順でこのプロセスのパレットにも追加します。"""
+    palette.add_colors([tuple(color) for color in extra_colors[palette.size - palette.base_size:]])
+
+
+
+def _init_worker(extra_colors, images):
+    global _compare_palette, _references
+    _compare_palette = _palette_from(extra_colors)
+    _references = [CompiledReference(image, _compare_palette) for image in images]
+
+
+def _decode_task(content, shm_name, extra_colors):
+    """
+    PNGをデコードして共有メモリに書き込みます。
+    戻り値: (タイルの形, 親のパレットにない色の配列 (なければ None))。
+    未知の色のインデックスは、親のパレットの末尾から順に割り当てた仮の番号になっています。
+    """
+    global _decode_palette
+    known_size = _compare_palette.base_size + len(extra_colors)
+    if _decode_palette is None or _decode_palette.size > known_size:
+        _decode_palette = _palette_from(extra_colors)
+    else:
+        _catch_up(_decode_palette, extra_colors)
+    tile = decode_tile(content, _decode_palette)
+
+    # 子プロセスは親の resource_tracker を引き継ぐので、開いた共有メモリの解放は親の unlink に任せられる
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        if tile.size > shm.size:
+            raise ValueError(f"タイルが大きすぎます: {tile.shape}")
+        np.ndarray(tile.shape, dtype=np.uint8, buffer=shm.buf)[:] = tile
+    finally:
+        shm.close()
+    unknown = _decode_palette.rgba[known_size:_decode_palette.size].copy() if _decode_palette.size > known_size else None
+    return tile.shape, unknown
+
+
+def _compare_task(ref_index, shm_name, shape, extra_colors, with_mask=False):
+    """
+    共有メモリ上の監視領域を参照と比較し、(差分ピクセル数, 監視対象ピクセル数) を返します。
+    with_mask=True なら、監視領域を不一致のマスク (0/1) で上書きして親に返します (ヒートマップ用)。
+    """
+    _catch_up(_compare_palette, extra_colors)
+    reference = _references[ref_index]
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        live = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        if with_mask:
+            mask = mismatch_mask(reference, live)
+            live[:] = mask
+            changed, opaque = int(np.count_nonzero(mask)), reference.opaque_count
+        else:
+            diff = compare_live(reference, live, visual=False)
+            changed, opaque = diff.changed, diff.opaque
+        del live
+    finally:
+        shm.close()
+    return changed, opaque
+
+
+# --- 親プロセス側 ---
+
+class SharedBlocks:
+    """
+    共有メモリのブロックを使い回すプール。acquire() で size バイト以上のブロックを借り、release() で返します。
+    返されたブロックは max_idle 個まで残し、それを超えた分は小さいものから解放します。close() ですべて解放します。
+    """
+
+    def __init__(self, max_idle):
+        self.max_idle = max_idle
+        self._idle = []
+        self._blocks = [] # 作成したすべてのブロック (貸し出し中のものを含む)
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def acquire(self, size):
+        size = max(1, size)
+        with self._lock:
+            for i, shm in enumerate(self._idle):
+                if shm.size >= size:
+                    return self._idle.pop(i)
+            shm = shared_memory.SharedMemory(create=True, size=size)
+            self._blocks.append(shm)
+            return shm
+
+    def release(self, shm):
+        with self._lock:
+            if self._closed:
+                return
+            self._idle.append(shm)
+            if len(self._idle) > self.max_idle:
+                self._idle.sort(key=lambda block: block.size)
+                victim = self._idle.pop(0)
+                self._blocks.remove(victim)
+                self._release(victim)
+
+    @staticmethod
+    def _release(shm):
+        try:
+            shm.close()
+        except BufferError:
+            pass # まだ配列から参照されている。unlink すれば参照がなくなった時点で解放される
+        shm.unlink()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            for shm in self._blocks:
+                self._release(shm)
+            self._blocks.clear()
+            self._idle.clear()
+
+
+class ProcessPool:
+    """
+    デコードと比較を振り分けるプロセスプール。
+    使い方: fetcher() で作った TileFetcher でタイルを取得し、attach() した DetectionEngine を
+    check_executor を渡した WatchlistScheduler でチェックします。
+    子プロセスは最初の仕事を渡したときに起動し、それまでに attach() された領域の参照を受け取ります。
+    """
+
+    def __init__(self, processes=DEFAULT_PROCESSES, palette=None):
+        self.processes = max(1, processes)
+        self.palette = palette if palette is not None else DEFAULT_PALETTE
+        self.references = []
+        # 同時に子プロセスへ渡す数はプロセス数程度なので、使っていないブロックもその分だけ残す
+        self.blocks = SharedBlocks(max_idle=2 * self.processes)
+        # 子プロセスの結果を待つスレッド。領域のチェックもこのスレッドで並行に行う
+        self.check_executor = ThreadPoolExecutor(max_workers=self.processes, thread_name_prefix="check")
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _extra_colors(self):
+        """既知のパレットより後に追加された色を、登録順に返します。"""
+        return self.palette.rgba[self.palette.base_size:self.palette.size].copy()
+
+    def _submit(self, fn, *args):
+        with self._lock:
+            if self._executor is None:
+                # Windows と同じ spawn で起動し、どの環境でも同じ動きにする
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.processes, mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(self._extra_colors(), [reference.image for reference in self.references]))
+        return self._executor.submit(fn, *args)
+
+    def fetcher(self, *args, **kwargs):
+        """デコードをこのプールで行う TileFetcher を返します。"""
+        return ProcessTileFetcher(self, *args, palette=self.palette, **kwargs)
+
+    def attach(self, engine):
+        """engine の比較をこのプールで行うようにします。ストリーミング比較の領域はそのままにします。"""
+        if not isinstance(engine.reference, CompiledReference):
+            return
+        with self._lock:
+            if self._executor is not None:
+                raise RuntimeError("プロセスプールの起動後に監視領域は追加できません")
+            if all(reference is not engine.reference for reference in self.references):
+                self.references.append(engine.reference)
+        ref_index = next(i for i, reference in enumerate(self.references) if reference is engine.reference)
+        engine.comparer = lambda engine, live: self.compare(ref_index, live, engine)
+
+    def decode(self, coord, content):
+        """
+        PNGを子プロセスでデコードし、インデックス配列を返します。
+        結果は共有メモリから通常の配列にコピーするので、キャッシュに置いても共有メモリは占有しません。
+        """
+        shm = self.blocks.acquire(TILE_SIZE * TILE_SIZE)
+        try:
+            extra = self._extra_colors()
+            shape, unknown = self._submit(_decode_task, content, shm.name, extra).result()
+            tile = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf).copy()
+        finally:
+            self.blocks.release(shm)
+        if unknown is not None:
+            # 子プロセスが仮の番号を付けた色を親のパレットに登録し、インデックスを付け替える
+            remap = np.arange(256, dtype=np.uint8)
+            start = self.palette.base_size + len(extra)
+            remap[start:start + len(unknown)] = self.palette.add_colors([tuple(color) for color in unknown])
+            tile[:] = remap[tile]
+        return tile
+
+    def compare(self, ref_index, live, engine=None):
+        """
+        監視領域を共有メモリに置き、子プロセスで比較します。差分画像は作りません。
+        engine にヒートマップの保存先があれば、不一致のマスクも受け取って engine.count_heatmap() に渡します。
+        """
+        with_mask = engine is not None and engine.heatmaps is not None
+        shm = self.blocks.acquire(live.size)
+        try:
+            np.ndarray(live.shape, dtype=np.uint8, buffer=shm.buf)[:] = live
+            changed, opaque = self._submit(_compare_task, ref_index, shm.name, live.shape, self._extra_colors(),
+                                           with_mask).result()
+            mask = np.ndarray(live.shape, dtype=np.uint8, buffer=shm.buf).astype(bool) if with_mask else None
+        finally:
+            self.blocks.release(shm)
+        if mask is not None:
+            engine.count_heatmap(mask)
+        diff_pct = (changed / opaque) * 100 if opaque else 0.0
+        return DiffResult(changed, opaque, diff_pct, None)
+
+    def close(self):
+        self.check_executor.shutdown(wait=False)
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+        self.blocks.close()
+
+
+class ProcessTileFetcher(TileFetcher):
+    """PNGのデコードを ProcessPool の子プロセスで行う TileFetcher。"""
+
+    def __init__(self, pool, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = pool
+
+    def _decode(self, coord, content):
+        return self.pool.decode(coord, content)
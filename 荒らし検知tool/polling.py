@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+監視領域ごとにチェック間隔を変える適応的なポーリング。
+変化のない領域は間隔を徐々に広げ、差分率が変わったらすぐ最短間隔に戻します。
+複数領域の取得時刻が重ならないよう間隔に揺らぎを加え、
+全体のリクエスト数はトークンバケットで1秒あたりの上限に収めます。
+"""
+import random
+import threading
+import time
+
+DEFAULT_MAX_INTERVAL_SEC = 10.0 # 静かな領域でも最低この間隔ではチェックする
+BACKOFF = 1.5                   # 変化がなかったときに間隔を広げる倍率
+CHANGE_EPSILON = 0.01           # 差分率 (%) がこれ以上動いたら「変化あり」とみなす
+JITTER = 0.1                    # 間隔に加える揺らぎの割合 (±10%)
+
+
+def jittered(interval, jitter=JITTER, rng=random):
+    """interval に ±jitter の割合の揺らぎを加えた値を返します。"""
+    return interval * rng.uniform(1 - jitter, 1 + jitter)
+
+
+class AdaptiveInterval:
+    """
+    1つの監視領域のチェック間隔。
+    差分率が前回から変わったら min_interval に戻し、変わらなければ backoff 倍ずつ max_interval まで広げます。
+    """
+
+    def __init__(self, min_interval, max_interval=DEFAULT_MAX_INTERVAL_SEC, backoff=BACKOFF,
+                 epsilon=CHANGE_EPSILON):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.backoff = backoff
+        self.epsilon = epsilon
+        self.interval = min_interval
+        self.last_diff_pct = None
+
+    def set_min_interval(self, min_interval):
+        self.min_interval = min_interval
+        self.max_interval = max(self.max_interval, min_interval)
+        self.interval = min_interval
+
+    def observe(self, result):
+        """チェック結果 (CheckResult) を受け取り、次のチェックまでの間隔を返します。"""
+        diff_pct = result.diff_pct
+        if diff_pct is not None and self.last_diff_pct is not None \
+                and abs(diff_pct - self.last_diff_pct) >= self.epsilon:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval, max(self.min_interval, self.interval * self.backoff))
+        if diff_pct is not None:
+            self.last_diff_pct = diff_pct
+        return self.interval
+
+
+class RateBudget:
+    """
+    1秒あたり rate 件までのリクエストを許すトークンバケット。
+    残りが少しでもあれば一度に複数件を取れ (残高はマイナスになり得ます)、平均のリクエスト数が rate に収まります。
+    """
+
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError("rate は0より大きい値を指定してください")
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill_locked(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_take(self, count, now=None):
+        """count 件分を取れたら True を返します。"""
+        with self._lock:
+            self._refill_locked(time.monotonic() if now is None else now)
+            if self.tokens <= 0:
+                return False
+            self.tokens -= count
+            return True
+
+    def wait_time(self, now=None):
+        """次にリクエストできるようになるまでの秒数を返します。"""
+        with self._lock:
+            self._refill_locked(time.monotonic() if now is None else now)
+            return 0.0 if self.tokens > 0 else (-self.tokens + 1e-6) / self.rate
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+タイル取得の記録と再生。
+記録: TileFetcher に TileRecorder を渡すと、受け取ったタイルの生データ (PNG) を時刻付きで保存します。
+      内容が前回と同じタイルは保存せず、PNGは内容のハッシュをファイル名にして重複なく保存します。
+再生: 記録したタイルをローカルのHTTPサーバーから、実時間・早送り・最速のいずれかで配信します。
+      検知エンジンの --base-url にこのサーバーを指定すると、過去の荒らしをオフラインで再現できます。
+
+使い方:
+    python engine.py --record rec/ ...                       # 検知しながら記録する
+    python replay.py rec/ --port 8000 --speed 10             # 10倍速で再生する (max で最速)
+    python engine.py --base-url http://127.0.0.1:8000/tiles --interval 0 --max-interval 0 --count 500
+
+記録フォルダの構成:
+    index.jsonl  1行1回の取得 {"t": 取得時刻, "tiles": {"tx,ty": ハッシュ, ...}} (変化したタイルのみ)
+    tiles/       <ハッシュ>.png
+"""
+import argparse
+import bisect
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+INDEX_FILE = "index.jsonl"
+TILES_DIR = "tiles"
+
+
+class TileRecorder:
+    """TileFetcher が受け取ったタイルの生データを記録フォルダに保存します。複数スレッドから呼び出せます。"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(os.path.join(directory, TILES_DIR), exist_ok=True)
+        self._index = open(os.path.join(directory, INDEX_FILE), "a", encoding="utf-8")
+        self._lock = threading.Lock()
+        self._last = {}    # (tx, ty) -> 最後に記録したハッシュ
+        self._pending = {} # (tx, ty) -> まだ index に書いていないハッシュ
+
+    def record(self, coord, content, digest=None):
+        """1枚のタイルの生データを受け取ります。index への書き込みは commit() でまとめて行います。"""
+        name = (digest or hashlib.blake2b(content, digest_size=16).digest()).hex()
+        with self._lock:
+            if self._last.get(coord) == name:
+                self._pending.pop(coord, None)
+                return
+            self._pending[coord] = name
+        path = os.path.join(self.directory, TILES_DIR, name + ".png")
+        if not os.path.exists(path):
+            # 書き込み途中のファイルを読まれないよう、別名で書いてから置き換える
+            temp = f"{path}.{threading.get_ident()}.tmp"
+            with open(temp, "wb") as f:
+                f.write(content)
+            os.replace(temp, path)
+
+    def commit(self, timestamp=None):
+        """前回の commit() 以降に内容が変わったタイルを、1回の取得として index に追記します。"""
+        with self._lock:
+            if not self._pending:
+                return
+            tiles = {f"{tx},{ty}": name for (tx, ty), name in sorted(self._pending.items())}
+            self._last.update(self._pending)
+            self._pending = {}
+            line = json.dumps({"t": time.time() if timestamp is None else timestamp, "tiles": tiles})
+            self._index.write(line + "\n")
+            self._index.flush()
+
+    def close(self):
+        with self._lock:
+            self._index.close()
+
+
+class Recording:
+    """記録フォルダを読み込み、各時点で配信すべきタイルを引けるようにします。"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.times = []   # 取得ごとの時刻
+        self.history = {} # (tx, ty) -> ([取得番号, ...], [ハッシュ, ...])
+        with open(os.path.join(directory, INDEX_FILE), encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                frame = len(self.times)
+                self.times.append(entry["t"])
+                for key, name in entry["tiles"].items():
+                    tx, ty = (int(v) for v in key.split(","))
+                    frames, names = self.history.setdefault((tx, ty), ([], []))
+                    frames.append(frame)
+                    names.append(name)
+        if not self.times:
+            raise ValueError(f"{directory} に記録がありません")
+
+    def __len__(self):
+        return len(self.times)
+
+    @property
+    def duration(self):
+        return self.times[-1] - self.times[0]
+
+    def frame_at(self, elapsed):
+        """記録開始から elapsed 秒の時点の取得番号を返します。"""
+        return max(0, bisect.bisect_right(self.times, self.times[0] + elapsed) - 1)
+
+    def tile_name(self, coord, frame):
+        """取得番号 frame の時点でのタイルのハッシュを返します (まだ記録がなければ None)。"""
+        entry = self.history.get(coord)
+        if entry is None:
+            return None
+        frames, names = entry
+        index = bisect.bisect_right(frames, frame) - 1
+        return names[index] if index >= 0 else None
+
+    def read_tile(self, name):
+        with open(os.path.join(self.directory, TILES_DIR, name + ".png"), "rb") as f:
+            return f.read()
+
+
+class ReplayClock:
+    """
+    再生位置 (取得番号) を決める時計。
+    speed > 0: 記録時の時刻の speed 倍の速さで進みます。
+    speed = 0: 最速。同じ時点のタイルを2回要求されたら (=次のチェックが来たら) 次の取得に進みます。
+    """
+
+    def __init__(self, recording, speed=1.0):
+        self.recording = recording
+        self.speed = speed
+        self.started = time.monotonic()
+        self._frame = 0
+        self._served = set()
+        self._lock = threading.Lock()
+
+    def frame_for(self, coord):
+        with self._lock:
+            if self.speed > 0:
+                return self.recording.frame_at((time.monotonic() - self.started) * self.speed)
+            if coord in self._served and self._frame < len(self.recording) - 1:
+                self._frame += 1
+                self._served.clear()
+            self._served.add(coord)
+            return self._frame
+
+    @property
+    def finished(self):
+        with self._lock:
+            if self.speed > 0:
+                return (time.monotonic() - self.started) * self.speed >= self.recording.duration
+            return self._frame >= len(self.recording) - 1 and bool(self._served)
+
+
+def start_replay_server(recording, speed=1.0, port=0, host="127.0.0.1"):
+    """
+    記録を /tiles/<tx>/<ty>.png で配信するサーバーを別スレッドで起動し、(サーバー, 時計) を返します。
+    ETag (内容のハッシュ) による条件付きGETに 304 で応答します。
+    """
+    clock = ReplayClock(recording, speed)
+    cache = {}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            try:
+                tx, ty = self.path.split("?")[0].rstrip("/").split("/")[-2:]
+                coord = (int(tx), int(ty.split(".")[0]))
+            except ValueError:
+                self.send_error(404)
+                return
+            name = recording.tile_name(coord, clock.frame_for(coord))
+            if name is None:
+                self.send_error(404)
+                return
+            etag = f'"{name}"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            body = cache.get(name)
+            if body is None:
+                body = cache[name] = recording.read_tile(name)
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", etag)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="replay-server", daemon=True).start()
+    return server, clock
+
+
+def _parse_speed(text):
+    if text == "max":
+        return 0.0
+    speed = float(text)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("速度は0より大きい数か max を指定してください")
+    return speed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="記録したタイルをローカルのHTTPサーバーで再生します")
+    parser.add_argument("recording", help="engine.py --record で作った記録フォルダ")
+    parser.add_argument("--port", type=int, default=8000, help="待ち受けるポート")
+    parser.add_argument("--speed", type=_parse_speed, default=1.0, help="再生速度の倍率 (max で最速)")
+    parser.add_argument("--exit-at-end", action="store_true", help="最後まで再生したら終了する")
+    args = parser.parse_args(argv)
+
+    recording = Recording(args.recording)
+    server, clock = start_replay_server(recording, args.speed, args.port)
+    print(f"{len(recording)}回分 ({recording.duration:.0f}秒) の記録を "
+          f"http://127.0.0.1:{server.server_address[1]}/tiles で再生しています", file=sys.stderr)
+    try:
+        while not (args.exit_at_end and clock.finished):
+            time.sleep(0.2)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
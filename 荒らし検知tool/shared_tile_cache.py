@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+同じマシン上の複数の検知プロセスで共有する、ディスク上のタイルキャッシュ。
+デコード済みのタイルを固定レイアウトの生ファイル (ヘッダー + パレット + 1ピクセル1バイトのインデックス) として保存し、
+読む側はファイルをメモリマップするだけなので、PNGのデコードもネットワークへのリクエストも要りません。
+
+ファイルの構成 (リトルエンディアン):
+    0     ヘッダー: マジック, 幅, 高さ, パレットの色数, 最終確認時刻, 内容の更新時刻, 本文のハッシュ
+    64    ETag (UTF-8, 末尾は0埋め)
+    320   Last-Modified (同上)
+    1024  パレット (256色 x RGBA)
+    2048  ピクセル (高さ x 幅 のインデックス)
+内容の更新は一時ファイルに書いてから os.replace で置き換えるので、読む側が書きかけのファイルを見ることはありません。
+内容が変わっていないことを確認しただけのときは、最終確認時刻 (8バイト) だけをその場で書き換えます。
+
+キャッシュのファイルを書き換えられれば、他のプロセスに任意のタイルを「直前に確認済み」として読ませられるため、
+フォルダはユーザーごとに分け (XDG_RUNTIME_DIR などの下)、本人以外が所有・書き込みできるフォルダは使いません。
+"""
+import hashlib
+import mmap
+import os
+import stat
+import struct
+import tempfile
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from palette import MAX_COLORS
+
+def _default_directory():
+    """ユーザーごとのキャッシュフォルダ。XDG_RUNTIME_DIR (Windows では LOCALAPPDATA) がなければ一時フォルダにユーザーIDを付けて置く"""
+    base = os.environ.get("XDG_RUNTIME_DIR") or os.environ.get("LOCALAPPDATA")
+    if base:
+        return os.path.join(base, "wplace-tiles")
+    suffix = str(os.getuid()) if hasattr(os, "getuid") else os.environ.get("USERNAME", "user")
+    return os.path.join(tempfile.gettempdir(), f"wplace-tiles-{suffix}")
+
+
+DEFAULT_SHARED_CACHE_DIR = _default_directory()
+DEFAULT_MAX_AGE_SEC = 1.0 # 他のプロセスがこの秒数以内に確認したタイルは、取得せずにそのまま使う
+
+MAGIC = b"WPTILE1\0"
+_HEADER = struct.Struct("<8sIIIdd16s")
+_FETCHED_AT_OFFSET = 20 # ヘッダー内の最終確認時刻の位置
+_VALIDATOR_BYTES = 256
+_ETAG_OFFSET = 64
+_LAST_MODIFIED_OFFSET = _ETAG_OFFSET + _VALIDATOR_BYTES
+PALETTE_OFFSET = 1024
+PIXELS_OFFSET = PALETTE_OFFSET + MAX_COLORS * 4
+
+# tile: 読み手のパレットのインデックス配列 / digest: レスポンス本文のハッシュ
+# validators: {"ETag": ..., "Last-Modified": ...} / fetched_at: 最後に配信元で確認した時刻 / modified_at: 内容が変わった時刻
+SharedTile = namedtuple("SharedTile", ["tile", "digest", "validators", "fetched_at", "modified_at"])
+
+
+def _encode_validator(value):
+    raw = (value or "").encode("utf-8")
+    if len(raw) > _VALIDATOR_BYTES:
+        return b"" # 収まらない検証子は保存しない (条件付きGETができないだけ)
+    return raw
+
+
+def _decode_validator(raw):
+    return raw.rstrip(b"\0").decode("utf-8", errors="replace")
+
+
+def _check_private(directory):
+    """
+    フォルダが自分の所有で、他のユーザーが書き込めないことを確かめます。満たさなければ PermissionError。
+    所有者とパーミッションのない Windows では確かめません (LOCALAPPDATA はユーザーごとに分かれている)。
+    """
+    if not hasattr(os, "getuid"):
+        return
+    st = os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode):
+        raise PermissionError(f"{directory} はフォルダではありません")
+    if st.st_uid != os.getuid():
+        raise PermissionError(f"{directory} は別のユーザーが所有しています")
+    if st.st_mode & 0o022:
+        raise PermissionError(f"{directory} は他のユーザーが書き込めます (chmod 700 してください)")
+
+
+class SharedTileCache:
+    """
+    タイル座標ごとに1ファイルを置くディスクキャッシュ。複数のプロセス・スレッドから同時に読み書きできます。
+    Windows ではメモリマップしたファイルを置き換えられないため、読み込み時にピクセルをコピーしてファイルを閉じます。
+    """
+
+    def __init__(self, directory=DEFAULT_SHARED_CACHE_DIR, copy_on_read=None):
+        self.directory = directory
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        _check_private(directory)
+        self.copy_on_read = os.name == "nt" if copy_on_read is None else copy_on_read
+
+    def path(self, coord, source=""):
+        """
+        タイルのファイルパスを返します。
+        source (配信元のベースURLなど) ごとにファイル名を分け、再生サーバーのタイルが本番のタイルと混ざらないようにします。
+        """
+        tx, ty = coord
+        prefix = hashlib.blake2b(source.encode("utf-8"), digest_size=4).hexdigest() + "_" if source else ""
+        return os.path.join(self.directory, f"{prefix}{tx}_{ty}.tile")
+
+    def read(self, coord, palette, source=""):
+        """
+        タイルを読み込み、palette のインデックスに合わせた SharedTile を返します。ファイルがない・壊れている場合は None。
+        書き手と読み手のパレットが一致していれば、ピクセルはコピーせずメモリマップをそのまま返します。
+        """
+        try:
+            with open(self.path(coord, source), "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        if len(mapped) < PIXELS_OFFSET:
+            return None
+        magic, width, height, palette_size, fetched_at, modified_at, digest = _HEADER.unpack_from(mapped, 0)
+        if magic != MAGIC or len(mapped) < PIXELS_OFFSET + width * height or not 0 < palette_size <= MAX_COLORS:
+            return None
+        validators = {}
+        for name, offset in (("ETag", _ETAG_OFFSET), ("Last-Modified", _LAST_MODIFIED_OFFSET)):
+            value = _decode_validator(mapped[offset:offset + _VALIDATOR_BYTES])
+            if value:
+                validators[name] = value
+
+        file_palette = np.frombuffer(mapped, dtype=np.uint8, count=palette_size * 4, offset=PALETTE_OFFSET)
+        pixels = np.frombuffer(mapped, dtype=np.uint8, count=width * height, offset=PIXELS_OFFSET).reshape(height, width)
+        # 書き手のインデックスを読み手のパレットのインデックスに対応付ける (ほとんどの場合は恒等写像)
+        lut = np.arange(MAX_COLORS, dtype=np.uint8)
+        lut[:palette_size] = palette.index_rgba(file_palette.reshape(1, palette_size, 4))[0]
+        if not np.array_equal(lut[:palette_size], np.arange(palette_size)):
+            tile = lut[pixels]
+        elif self.copy_on_read:
+            tile = pixels.copy()
+        else:
+            tile = pixels
+        return SharedTile(tile, digest, validators, fetched_at, modified_at)
+
+    def write(self, coord, tile, palette, digest, validators=None, source="", fetched_at=None):
+        """タイルの内容を書き込みます。一時ファイルに書いてから置き換えるので、読み手には常に完全なファイルが見えます。"""
+        now = time.time() if fetched_at is None else fetched_at
+        validators = validators or {}
+        height, width = tile.shape
+        header = bytearray(PIXELS_OFFSET)
+        _HEADER.pack_into(header, 0, MAGIC, width, height, palette.size, now, now, digest)
+        for name, offset in (("ETag", _ETAG_OFFSET), ("Last-Modified", _LAST_MODIFIED_OFFSET)):
+            raw = _encode_validator(validators.get(name))
+            header[offset:offset + len(raw)] = raw
+        header[PALETTE_OFFSET:PIXELS_OFFSET] = palette.rgba.tobytes()
+
+        path = self.path(coord, source)
+        fd, temp = tempfile.mkstemp(prefix=os.path.basename(path), suffix=".tmp", dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(header)
+                f.write(np.ascontiguousarray(tile, dtype=np.uint8).tobytes())
+            os.replace(temp, path)
+        except OSError:
+            # Windows で他のプロセスが開いている間は置き換えられない。次の更新で書き直す
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+
+    def touch(self, coord, source="", fetched_at=None):
+        """内容が変わっていないことを確認した時刻だけを書き換えます。"""
+        try:
+            with open(self.path(coord, source), "r+b") as f:
+                f.seek(_FETCHED_AT_OFFSET)
+                f.write(struct.pack("<d", time.time() if fetched_at is None else fetched_at))
+        except OSError:
+            pass
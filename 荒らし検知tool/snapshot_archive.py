@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+監視領域のスナップショットを保存するアーカイブ。
+前回と内容が変わったフレームだけを追記します。各フレームはパレットのインデックス (1ピクセル1バイト) に
+変換し、定期的なキーフレーム以外は前フレームとのXOR差分をzlibで圧縮して保存するため、
+荒らしの多い領域でも1日分が数MB程度に収まります。
+
+ファイル形式: 先頭に MAGIC、その後にレコードが続きます。
+    レコード = ヘッダ (種別, 時刻, 幅, 高さ, 追加色数, 本文長) + zlib圧縮した本文
+    本文 = 追加色 (RGBA × 追加色数) + インデックス配列 (キーフレーム) / 前フレームとのXOR (差分)
+パレットはキーフレームごとにリセットされ、差分フレームで新しい色が出たら追記されます。
+"""
+import os
+import re
+import struct
+import threading
+import zlib
+
+import numpy as np
+from PIL import Image
+
+MAGIC = b"WPSNAP1\n"
+KEYFRAME_INTERVAL = 300 # 保存したフレームこの数ごとにキーフレームを入れる
+MAX_PALETTE = 256
+
+KIND_KEY = 0   # パレットのインデックス配列
+KIND_DELTA = 1 # 前フレームとのXOR
+KIND_RAW = 2   # 色数が多すぎてパレット化できないフレーム (RGBAそのまま)
+
+_HEADER = struct.Struct("<BdIIHI")
+
+
+def _pack_rgba(rgba):
+    """(H, W, 4) の uint8 配列を、1ピクセル1要素の uint32 に詰めます。"""
+    return np.ascontiguousarray(rgba).view(np.uint32).reshape(rgba.shape[:2])
+
+
+class SnapshotArchive:
+    """1つの監視領域のスナップショットを1ファイルに追記・復元します。"""
+
+    def __init__(self, path, keyframe_interval=KEYFRAME_INTERVAL):
+        self.path = path
+        self.keyframe_interval = keyframe_interval
+        self._lock = threading.Lock()
+        self._index = [] # [(ファイル内オフセット, 時刻, 種別), ...]
+
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            self._scan()
+        else:
+            with open(path, "wb") as f:
+                f.write(MAGIC)
+        self._file = open(path, "ab")
+
+        # 書き込み側の状態 (再起動後は次のフレームをキーフレームにする)
+        self._palette = {}   # 詰めたRGBA値 -> インデックス
+        self._prev_packed = None
+        self._prev_indices = None
+        self._since_key = None
+
+    def _scan(self):
+        with open(self.path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{self.path} はスナップショットアーカイブではありません")
+            offset = len(MAGIC)
+            while True:
+                header = f.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    break
+                kind, ts, _, _, _, length = _HEADER.unpack(header)
+                if len(f.read(length)) < length:
+                    break # 書き込み途中で終了したレコードは無視する
+                self._index.append((offset, ts, kind))
+                offset += _HEADER.size + length
+
+    def __len__(self):
+        return len(self._index)
+
+    def timestamps(self):
+        return [ts for _, ts, _ in self._index]
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    # --- 書き込み ---
+
+    def add(self, image, timestamp):
+        """
+        前回と内容が異なる場合だけフレームを追記します。
+        戻り値: 保存した場合は True、前回と同じで保存しなかった場合は False
+        """
+        rgba = np.asarray(image if image.mode == "RGBA" else image.convert("RGBA"))
+        packed = _pack_rgba(rgba)
+        with self._lock:
+            if self._prev_packed is not None and packed.shape == self._prev_packed.shape \
+                    and np.array_equal(packed, self._prev_packed):
+                return False
+
+            h, w = packed.shape
+            colors, inverse = np.unique(packed.ravel(), return_inverse=True)
+            need_key = (self._prev_indices is None or packed.shape != self._prev_packed.shape
+                        or self._since_key >= self.keyframe_interval)
+            new_colors = [] if need_key else [c for c in colors.tolist() if c not in self._palette]
+            if not need_key and len(self._palette) + len(new_colors) > MAX_PALETTE:
+                need_key = True
+
+            if need_key and len(colors) > MAX_PALETTE:
+                # パレットに収まらないフレームはそのまま保存し、次のフレームをキーフレームにする
+                self._write(KIND_RAW, timestamp, w, h, 0, rgba.tobytes())
+                self._prev_packed = packed
+                self._prev_indices = None
+                return True
+
+            if need_key:
+                self._palette = {c: i for i, c in enumerate(colors.tolist())}
+                indices = inverse.reshape(h, w).astype(np.uint8)
+                palette_bytes = colors.astype(np.uint32).tobytes()
+                self._write(KIND_KEY, timestamp, w, h, len(colors), palette_bytes + indices.tobytes())
+                self._since_key = 0
+            else:
+                for c in new_colors:
+                    self._palette[c] = len(self._palette)
+                lut = np.array([self._palette[c] for c in colors.tolist()], dtype=np.uint8)
+                indices = lut[inverse].reshape(h, w)
+                xor = np.bitwise_xor(indices, self._prev_indices)
+                palette_bytes = np.array(new_colors, dtype=np.uint32).tobytes()
+                self._write(KIND_DELTA, timestamp, w, h, len(new_colors), palette_bytes + xor.tobytes())
+                self._since_key += 1
+
+            self._prev_packed = packed
+            self._prev_indices = indices
+            return True
+
+    def _write(self, kind, timestamp, w, h, added_colors, body):
+        payload = zlib.compress(body, 6)
+        offset = self._file.tell()
+        self._file.write(_HEADER.pack(kind, timestamp, w, h, added_colors, len(payload)) + payload)
+        self._file.flush()
+        self._index.append((offset, timestamp, kind))
+
+    # --- 読み出し ---
+
+    def _read_record(self, f, offset):
+        f.seek(offset)
+        kind, ts, w, h, added_colors, length = _HEADER.unpack(f.read(_HEADER.size))
+        body = zlib.decompress(f.read(length))
+        split = added_colors * 4
+        palette = np.frombuffer(body[:split], dtype=np.uint32)
+        return kind, ts, w, h, palette, body[split:]
+
+    def read_frame(self, number):
+        """number 番目 (0始まり) のフレームを直前のキーフレームから復元し、RGBA画像で返します。"""
+        with self._lock:
+            self._file.flush()
+            if not -len(self._index) <= number < len(self._index):
+                raise IndexError("フレーム番号が範囲外です")
+            number %= len(self._index)
+            start = number
+            while self._index[start][2] == KIND_DELTA:
+                start -= 1
+            records = [self._index[i][0] for i in range(start, number + 1)]
+
+        with open(self.path, "rb") as f:
+            palette = np.zeros(0, dtype=np.uint32)
+            indices = None
+            for offset in records:
+                kind, _, w, h, added, data = self._read_record(f, offset)
+                if kind == KIND_RAW:
+                    rgba = np.frombuffer(data, dtype=np.uint8).reshape(h, w, 4)
+                    continue
+                frame = np.frombuffer(data, dtype=np.uint8).reshape(h, w)
+                if kind == KIND_KEY:
+                    palette, indices = added, frame
+                else:
+                    palette = np.concatenate([palette, added])
+                    indices = np.bitwise_xor(indices, frame)
+                rgba = palette[indices].view(np.uint8).reshape(h, w, 4)
+        return Image.fromarray(np.ascontiguousarray(rgba), "RGBA")
+
+    def frame_at(self, timestamp):
+        """timestamp の時点で表示されていたフレームを返します (それ以前のフレームがなければ None)。"""
+        with self._lock:
+            times = [ts for _, ts, _ in self._index]
+        number = int(np.searchsorted(times, timestamp, side="right")) - 1
+        return None if number < 0 else self.read_frame(number)
+
+
+class SnapshotArchiver:
+    """監視領域ごとのアーカイブを1つのフォルダで管理します。"""
+
+    def __init__(self, directory, keyframe_interval=KEYFRAME_INTERVAL):
+        self.directory = directory
+        self.keyframe_interval = keyframe_interval
+        self._archives = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def archive(self, region):
+        region = region or "default"
+        with self._lock:
+            if region not in self._archives:
+                filename = re.sub(r'[\\/:*?"<>|]', "_", region) + ".wpsnap"
+                self._archives[region] = SnapshotArchive(os.path.join(self.directory, filename),
+                                                         self.keyframe_interval)
+            return self._archives[region]
+
+    def add_result(self, region, result):
+        """比較し直した CheckResult のリアルタイム画像を保存します。"""
+        if result.error or not result.updated or result.live_image is None:
+            return False
+        return self.archive(region).add(result.live_image, result.timestamp)
+
+    def close(self):
+        with self._lock:
+            for archive in self._archives.values():
+                archive.close()
+            self._archives.clear()
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+diff_engine のテスト。
+Pillow の getdata() をループしていた従来の compare_images を基準 (オラクル) として残し、
+配列ベースの差分エンジンが同じ差分ピクセル数・差分率・差分画像を返すことを確かめます。
+実行: python -m pytest -q
+"""
+import numpy as np
+import pytest
+from PIL import Image, ImageChops
+
+from diff_engine import (CompiledReference, IncrementalDiff, TiledReference, compare_images, compare_live,
+                         diff_images, dirty_rects)
+from palette import UNKNOWN, WPLACE_COLORS, Palette
+
+PALETTE_RGBA = np.array([c + (255,) for c in WPLACE_COLORS], dtype=np.uint8)
+
+# オラクルは従来のコードをそのまま残すため、新しい Pillow での getdata() の非推奨警告は無視する
+pytestmark = pytest.mark.filterwarnings("ignore:Image.Image.getdata:DeprecationWarning")
+
+
+def oracle_compare(img1, img2):
+    """従来の compare_images。戻り値: (差分ピクセル数, 監視対象ピクセル数, 差分率 %, 差分画像)"""
+    if img1.size != img2.size:
+        w = min(img1.width, img2.width)
+        h = min(img1.height, img2.height)
+        img1 = img1.crop((0, 0, w, h))
+        img2 = img2.crop((0, 0, w, h))
+
+    alpha_mask = img1.getchannel('A')
+    opaque_pixels_count = sum(1 for p in alpha_mask.getdata() if p > 0)
+    if opaque_pixels_count == 0:
+        return 0, 0, 0.0, Image.new("RGB", img1.size, (0, 0, 0))
+
+    diff = ImageChops.difference(img1.convert("RGB"), img2.convert("RGB"))
+    diff_visual = Image.composite(diff, Image.new("RGB", diff.size, (0, 0, 0)), alpha_mask)
+    nz = sum(1 for pixel in diff_visual.getdata() if pixel != (0, 0, 0))
+    return nz, opaque_pixels_count, (nz / opaque_pixels_count) * 100, diff_visual
+
+
+def random_reference(rng, h, w, extra_colors=8):
+    """パレットの色とパレット外の色を混ぜ、透明・半透明・不透明のピクセルを含む参照画像を作ります。"""
+    extra = rng.integers(0, 256, (extra_colors, 4), dtype=np.uint8)
+    extra[:, 3] = 255
+    colors = np.concatenate([PALETTE_RGBA, extra])
+    rgba = colors[rng.integers(0, len(colors), (h, w))]
+    rgba[..., 3] = rng.choice([0, 255, 255, 128, 3], (h, w))
+    return rgba
+
+
+def random_live(rng, reference, change_ratio=0.2):
+    """
+    参照画像の一部を書き換えたリアルタイム画像を作ります。
+    デコードしたタイルと同じく、透明なピクセルのRGBは0です。
+    """
+    live = reference.copy()
+    live[..., 3] = 255
+    changed = rng.random(live.shape[:2]) < change_ratio
+    live[changed] = PALETTE_RGBA[rng.integers(0, len(PALETTE_RGBA), int(changed.sum()))]
+    transparent = rng.random(live.shape[:2]) < 0.05
+    live[transparent] = 0
+    return live
+
+
+def assert_same(result, expected):
+    changed, opaque, diff_pct, visual = expected
+    assert (result.changed, result.opaque) == (changed, opaque)
+    assert result.diff_pct == pytest.approx(diff_pct)
+    assert np.array_equal(np.asarray(result.diff_visual), np.asarray(visual))
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_diff_images_matches_oracle(seed):
+    rng = np.random.default_rng(seed)
+    h, w = rng.integers(1, 80, 2)
+    ref = Image.fromarray(random_reference(rng, h, w), "RGBA")
+    live_rgba = rng.integers(0, 256, (h, w, 4), dtype=np.uint8)
+    live = Image.fromarray(live_rgba, "RGBA")
+    assert_same(diff_images(ref, live), oracle_compare(ref, live))
+
+    diff_pct, visual = compare_images(ref, live)
+    expected = oracle_compare(ref, live)
+    assert diff_pct == pytest.approx(expected[2])
+    assert np.array_equal(np.asarray(visual), np.asarray(expected[3]))
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_compare_live_matches_oracle(seed):
+    rng = np.random.default_rng(seed)
+    palette = Palette()
+    h, w = rng.integers(1, 80, 2)
+    ref_rgba = random_reference(rng, h, w)
+    live_rgba = random_live(rng, ref_rgba)
+    ref, live = Image.fromarray(ref_rgba, "RGBA"), Image.fromarray(live_rgba, "RGBA")
+    reference = CompiledReference(ref, palette)
+    expected = oracle_compare(ref, live)
+
+    assert_same(compare_live(reference, live), expected)
+    indices = palette.index_image(live)
+    assert_same(compare_live(reference, indices), expected)
+    assert compare_live(reference, indices, visual=False)[:3] == compare_live(reference, indices)[:3]
+
+
+def test_compare_live_size_mismatch():
+    rng = np.random.default_rng(0)
+    ref_rgba = random_reference(rng, 40, 50)
+    ref = Image.fromarray(ref_rgba, "RGBA")
+    live = Image.fromarray(random_live(rng, ref_rgba)[:30, :45], "RGBA")
+    reference = CompiledReference(ref, Palette())
+    assert_same(compare_live(reference, live), oracle_compare(ref, live))
+    assert_same(diff_images(ref, live), oracle_compare(ref, live))
+
+
+def test_no_opaque_pixels():
+    rgba = np.zeros((20, 30, 4), dtype=np.uint8)
+    rgba[..., :3] = 200
+    ref = Image.fromarray(rgba, "RGBA")
+    live = Image.new("RGBA", (30, 20), (1, 2, 3, 255))
+    expected = oracle_compare(ref, live)
+    assert expected[:3] == (0, 0, 0.0)
+    assert_same(diff_images(ref, live), expected)
+    assert_same(compare_live(CompiledReference(ref, Palette()), live), expected)
+
+
+def test_off_palette_reference_does_not_grow_the_palette():
+    rng = np.random.default_rng(1)
+    palette = Palette()
+    for _ in range(3):
+        # 300色のパレット外の色を使った参照画像 (写真やアンチエイリアスのかかった画像に相当)
+        ref_rgba = random_reference(rng, 60, 70, extra_colors=300)
+        ref = Image.fromarray(ref_rgba, "RGBA")
+        reference = CompiledReference(ref, palette)
+        assert palette.size == palette.base_size
+        assert reference.off_palette_count > 0
+
+        # リアルタイム画像がパレットの色だけなら、パレット外の参照ピクセルもRGBで正しく比べられる
+        live = Image.fromarray(random_live(rng, ref_rgba, change_ratio=1.0), "RGBA")
+        assert_same(compare_live(reference, live), oracle_compare(ref, live))
+
+
+def test_palette_add_and_index_rgba_agree():
+    palette = Palette()
+    colors = np.array([[[10, 20, 30, 255], [10, 20, 30, 0], [60, 60, 60, 255], [1, 2, 3, 128]]], dtype=np.uint8)
+    first = palette.add((7, 8, 9, 255))
+    assert first == palette.base_size and palette.add((7, 8, 9, 255)) == first
+    indices = palette.index_rgba(colors)
+    assert palette.size == palette.base_size + 3
+    assert indices.tolist() == [[palette.add((10, 20, 30, 255)), 0, 2, palette.add((1, 2, 3, 255))]]
+    assert palette.add_colors([(7, 8, 9, 255), (4, 5, 6, 255)]) == [first, palette.base_size + 3]
+    assert palette.index_rgba(np.array([[[4, 5, 6, 255]]], dtype=np.uint8), grow=False).tolist() == [[first + 3]]
+
+
+def test_full_palette_maps_new_tile_colors_to_unknown():
+    palette = Palette()
+    colors = np.zeros((1, 300, 4), dtype=np.uint8)
+    colors[0, :, 0] = np.arange(300) % 256
+    colors[0, :, 1] = np.arange(300) // 256 + 1
+    colors[..., 3] = 255
+    indices = palette.index_rgba(colors)
+    assert palette.size == UNKNOWN
+    assert np.count_nonzero(indices == UNKNOWN) == 300 - (UNKNOWN - palette.base_size)
+
+    # 満杯になった後も参照画像は読み込め、色の分からないピクセルは常に差分になる
+    ref = Image.fromarray(colors[:, :10].repeat(5, axis=0), "RGBA")
+    reference = CompiledReference(ref, palette)
+    live = np.full((5, 10), UNKNOWN, dtype=np.uint8)
+    assert compare_live(reference, live).changed == 50
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_tiled_reference_matches_compiled(seed):
+    rng = np.random.default_rng(seed)
+    palette = Palette()
+    h, w = rng.integers(20, 120, 2)
+    ref_rgba = random_reference(rng, h, w, extra_colors=20)
+    ref = Image.fromarray(ref_rgba, "RGBA")
+    live = palette.index_rgba(random_live(rng, ref_rgba))
+    expected = compare_live(CompiledReference(ref, palette), live, visual=False)
+
+    tiled = TiledReference(ref, palette)
+    assert tiled.opaque_count == expected.opaque
+    assert tiled.off_palette_colors == CompiledReference(ref, palette).off_palette_colors
+    step = 16
+    total_changed = total_opaque = 0
+    for y0 in range(0, h, step):
+        for x0 in range(0, w, step):
+            changed, opaque = tiled.compare_rect(x0, y0, live[y0:y0 + step, x0:x0 + step])
+            total_changed += changed
+            total_opaque += opaque
+    assert (total_changed, total_opaque) == (expected.changed, expected.opaque)
+
+
+@pytest.mark.parametrize("visual", [True, False])
+def test_incremental_diff_matches_full_compare(visual):
+    rng = np.random.default_rng(2)
+    palette = Palette()
+    for _ in range(10):
+        h, w = rng.integers(1, 200, 2)
+        ref_rgba = random_reference(rng, h, w)
+        reference = CompiledReference(Image.fromarray(ref_rgba, "RGBA"), palette)
+        incremental = IncrementalDiff(reference, visual=visual)
+        live = palette.index_rgba(random_live(rng, ref_rgba))
+        for step in range(12):
+            n = int(rng.integers(0, 50))
+            ys, xs = rng.integers(0, h, n), rng.integers(0, w, n)
+            live = live.copy()
+            live[ys, xs] = rng.integers(0, palette.size, n)
+            hints = None
+            if step % 3 == 1:
+                # 変化を含む範囲だけを渡す (画像からはみ出した矩形も含む)
+                hints = [(int(xs.min()), int(ys.min()), w + 5, h + 5)] if n else []
+            expected = compare_live(reference, live, visual=visual)
+            result, _ = incremental.update(live, hints)
+            assert result[:3] == expected[:3]
+            if visual:
+                assert np.array_equal(np.asarray(result.diff_visual), np.asarray(expected.diff_visual))
+
+
+def test_dirty_rects_cover_changed_pixels():
+    rng = np.random.default_rng(3)
+    changed = rng.random((150, 230)) < 0.002
+    covered = np.zeros_like(changed)
+    for x0, y0, x1, y1 in dirty_rects(changed, block=16):
+        assert not covered[y0:y1, x0:x1].any() # 矩形どうしは重ならない
+        covered[y0:y1, x0:x1] = True
+    assert not (changed & ~covered).any()
+    assert dirty_rects(np.zeros((0, 5), dtype=bool)) == []
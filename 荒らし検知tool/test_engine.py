@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+engine のテスト。複数のタイルにまたがる監視領域で、ストリーミング比較 (TiledReference) と
+監視領域を組み立てる比較 (CompiledReference) が同じ結果になることを確かめます。
+実行: python -m pytest -q
+"""
+import numpy as np
+from PIL import Image
+
+from diff_engine import CompiledReference, TiledReference
+from engine import STREAM_BATCH_TILES, DetectionEngine
+from palette import WPLACE_COLORS, Palette
+from tile_client import TILE_SIZE, TileBatch
+
+REF_PIXEL = (4, 7, 700, 600) # タイル (4, 7) の (700, 600) から 1500x900 = 3x2 タイル
+
+
+class FakeFetcher:
+    """tiles (共有の辞書) から TileBatch を返す TileFetcher の代わり。前回返した内容と比べて変化を報告します。"""
+
+    def __init__(self, tiles):
+        self.tiles = tiles
+        self.served = {}
+        self.calls = [] # (座標のリスト, keep)
+
+    def fetch_many(self, coords, keep=True):
+        self.calls.append((list(coords), keep))
+        changed = {coord for coord in coords if self.served.get(coord) is not self.tiles[coord]}
+        self.served.update((coord, self.tiles[coord]) for coord in coords)
+        return TileBatch({coord: self.tiles[coord] for coord in coords}, {}, changed)
+
+
+def test_streaming_matches_whole_region():
+    rng = np.random.default_rng(0)
+    palette = Palette()
+    colors = np.array([c + (255,) for c in WPLACE_COLORS], dtype=np.uint8)
+    ref_rgba = colors[rng.integers(0, len(colors), (900, 1500))]
+    ref_rgba[..., 3] = rng.choice([0, 255, 255, 128], (900, 1500))
+    ref = Image.fromarray(ref_rgba, "RGBA")
+
+    tiles = {(tx, ty): rng.integers(0, palette.size, (TILE_SIZE, TILE_SIZE)).astype(np.uint8)
+             for tx in range(4, 7) for ty in range(7, 9)}
+    streaming_fetcher, whole_fetcher = FakeFetcher(tiles), FakeFetcher(tiles)
+    streaming = DetectionEngine(TiledReference(ref, palette), REF_PIXEL, fetcher=streaming_fetcher, keep_images=False)
+    whole = DetectionEngine(CompiledReference(ref, palette), REF_PIXEL, fetcher=whole_fetcher, keep_images=False)
+    assert streaming.streaming and not whole.streaming
+
+    for step in range(4):
+        if step:
+            # 一部のタイルだけを書き換える
+            coord = list(tiles)[int(rng.integers(0, len(tiles)))]
+            tile = tiles[coord].copy()
+            tile[rng.integers(0, TILE_SIZE, 5000), rng.integers(0, TILE_SIZE, 5000)] = 0
+            tiles[coord] = tile
+        a, b = streaming.check(), whole.check()
+        assert a.error is None and b.error is None
+        assert (a.changed_pixels, a.opaque_pixels) == (b.changed_pixels, b.opaque_pixels)
+        assert a.diff_pct == b.diff_pct
+
+    # ストリーミング比較はタイルキャッシュを使わず、一度に STREAM_BATCH_TILES 枚までしか取得しない
+    assert all(not keep and len(coords) <= STREAM_BATCH_TILES for coords, keep in streaming_fetcher.calls)
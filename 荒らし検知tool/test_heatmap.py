@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+heatmap のテスト。DetectionEngine が新たに不一致になったピクセルだけを数えることと、
+比較をプロセスプールで行っても同じ回数になることを確かめます。
+実行: python -m pytest -q
+"""
+import numpy as np
+import pytest
+from PIL import Image
+
+from diff_engine import CompiledReference
+from engine import DetectionEngine
+from heatmap import HeatmapStore
+from palette import WPLACE_COLORS, Palette
+from tile_client import TileBatch, TileFetcher
+
+REF_PIXEL = (0, 0, 10, 20) # タイル (0, 0) の (10, 20) から
+SIZE = (60, 40)
+
+
+def frames(rng, reference, count):
+    """参照と一致する状態から、一部のピクセルが荒らされたり直されたりするタイルの列を作ります。"""
+    tile = np.zeros((100, 100), dtype=np.uint8)
+    x, y = REF_PIXEL[2:]
+    tile[y:y + SIZE[1], x:x + SIZE[0]] = reference.indices
+    result = [tile.copy()]
+    for _ in range(count):
+        ys, xs = rng.integers(0, 100, 30), rng.integers(0, 100, 30)
+        if rng.random() < 0.5:
+            tile[ys, xs] = rng.integers(1, len(WPLACE_COLORS) + 1, 30)
+        else:
+            tile[ys, xs] = result[0][ys, xs]
+        result.append(tile.copy())
+    return result
+
+
+def run_engine(engine, tiles):
+    for i, tile in enumerate(tiles):
+        result = engine.check(TileBatch({(0, 0): tile}, {}, {(0, 0)} if i else set()))
+        assert result.error is None
+    return result
+
+
+@pytest.fixture
+def reference():
+    rng = np.random.default_rng(0)
+    colors = np.array([c + (255,) for c in WPLACE_COLORS], dtype=np.uint8)
+    rgba = colors[rng.integers(0, len(colors), (SIZE[1], SIZE[0]))]
+    rgba[:5, :5, 3] = 0 # 監視対象外のピクセル
+    return CompiledReference(Image.fromarray(rgba, "RGBA"), Palette())
+
+
+def test_counts_newly_changed_pixels(tmp_path, reference):
+    store = HeatmapStore(str(tmp_path))
+    fetcher = TileFetcher(palette=reference.palette)
+    engine = DetectionEngine(reference, REF_PIXEL, fetcher=fetcher, keep_images=False, heatmaps=store)
+    x, y = REF_PIXEL[2:]
+    clean = np.zeros((100, 100), dtype=np.uint8)
+    clean[y:y + SIZE[1], x:x + SIZE[0]] = reference.indices
+    griefed = clean.copy()
+    griefed[y + 10, x + 30] = 0 if reference.indices[10, 30] else 1
+
+    run_engine(engine, [clean, griefed, griefed, clean, griefed])
+    counts = store.get(REF_PIXEL, SIZE).counts
+    assert counts[10, 30] == 2 and counts.sum() == 2 # 不一致のままの間は数えない
+
+    engine.show_heatmap = True
+    result = engine.check(TileBatch({(0, 0): clean}, {}, {(0, 0)}))
+    assert result.heatmap_image.size == SIZE
+    fetcher.close()
+    store.close()
+
+
+def test_process_pool_counts_like_in_process(tmp_path, reference):
+    from parallel import ProcessPool
+
+    tiles = frames(np.random.default_rng(1), reference, 12)
+    counts = []
+    for name in ("thread", "pool"):
+        store = HeatmapStore(str(tmp_path / name))
+        fetcher = TileFetcher(palette=reference.palette)
+        engine = DetectionEngine(reference, REF_PIXEL, fetcher=fetcher, keep_images=False, heatmaps=store)
+        pool = None
+        if name == "pool":
+            pool = ProcessPool(1, palette=reference.palette)
+            pool.attach(engine)
+        try:
+            run_engine(engine, tiles)
+        finally:
+            if pool is not None:
+                pool.close()
+            fetcher.close()
+        counts.append(np.array(store.get(REF_PIXEL, SIZE).counts))
+        store.close()
+    assert counts[0].sum() > 0
+    assert np.array_equal(counts[0], counts[1])
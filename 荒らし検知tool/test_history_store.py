@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+history_store のテスト。集計テーブルから読んだバケットが生データから計算した値と一致することを確かめます。
+実行: python -m pytest -q
+"""
+import numpy as np
+import pytest
+
+from history_store import HistoryStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = HistoryStore(str(tmp_path / "history.sqlite3"))
+    yield store
+    store.close()
+
+
+def expected_buckets(samples, bucket_sec):
+    buckets = {}
+    for ts, diff_pct in samples:
+        buckets.setdefault(int(ts // bucket_sec) * bucket_sec, []).append(diff_pct)
+    return [(start, len(values), min(values), max(values), pytest.approx(sum(values) / len(values)))
+            for start, values in sorted(buckets.items())]
+
+
+def test_rollups_match_samples(store):
+    rng = np.random.default_rng(0)
+    samples = [(1_000_000.0 + t, float(rng.uniform(0, 100))) for t in np.sort(rng.uniform(0, 3 * 3600, 500))]
+    for ts, diff_pct in samples:
+        store.add("a", ts, diff_pct, "注意")
+    for bucket_sec in (60, 600, 3600, 7):
+        rows = store.query("a", 1_000_000, 1_000_000 + 3 * 3600, bucket_sec)
+        assert [tuple(row) for row in rows] == expected_buckets(samples, bucket_sec)
+    assert store.query("b", 0, 2_000_000, 60) == []
+
+
+def test_duplicate_timestamp_is_counted_once(store):
+    store.add("a", 120.0, 10.0)
+    store.add("a", 120.0, 90.0) # ワーカーの再送などで同じ時刻の結果が届いても集計は変わらない
+    store.add("b", 120.0, 50.0)
+    assert [tuple(row) for row in store.query("a", 0, 3600, 60)] == [(120, 1, 10.0, 10.0, 10.0)]
+    assert [tuple(row) for row in store.query("a", 0, 3600, 3600)] == [(0, 1, 10.0, 10.0, 10.0)]
+    assert store.samples("a", 0, 3600) == [(120.0, 10.0, None, None)]
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+parallel のテスト。子プロセスでのデコードと比較が、同じプロセスで行った結果と一致することを確かめます。
+
+実行: python -m pytest -q
+"""
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from diff_engine import CompiledReference, compare_live
+from palette import WPLACE_COLORS, Palette
+from parallel import ProcessPool, SharedBlocks
+from tile_client import decode_tile
+
+PALETTE_RGBA = np.array([c + (255,) for c in WPLACE_COLORS], dtype=np.uint8)
+
+
+def png(rgba):
+    buf = io.BytesIO()
+    Image.fromarray(rgba, "RGBA").save(buf, "PNG")
+    return buf.getvalue()
+
+
+def random_tile(rng, h=120, w=150, extra_colors=0):
+    """パレットの色と透明のピクセルに、パレットにない色を extra_colors 色だけ混ぜたタイルを作ります。"""
+    extra = rng.integers(0, 256, (extra_colors, 4), dtype=np.uint8)
+    extra[:, 3] = 255
+    colors = np.concatenate([PALETTE_RGBA, extra, np.zeros((1, 4), dtype=np.uint8)])
+    return colors[rng.integers(0, len(colors), (h, w))]
+
+
+@pytest.fixture
+def pool():
+    pool = ProcessPool(2, palette=Palette())
+    yield pool
+    pool.close()
+
+
+def test_decode_matches_in_process(pool):
+    rng = np.random.default_rng(0)
+    # タイルごとに違うパレット外の色を含め、子プロセスが仮の番号を付けた色の付け替えを確かめる
+    tiles = [random_tile(rng, extra_colors=n) for n in (0, 5, 3, 5)]
+    for coord, rgba in enumerate(tiles):
+        indices = pool.decode((coord, 0), png(rgba))
+        assert np.array_equal(pool.palette.to_rgba(indices), pool.palette.to_rgba(pool.palette.index_rgba(rgba)))
+        assert np.array_equal(indices, decode_tile(png(rgba), pool.palette))
+    assert pool.palette.size == pool.palette.base_size + 13
+
+
+def test_compare_matches_in_process(pool):
+    rng = np.random.default_rng(1)
+    references = []
+    for _ in range(3):
+        rgba = random_tile(rng, extra_colors=4)
+        rgba[..., 3] = rng.choice([0, 255, 255, 128], rgba.shape[:2])
+        references.append(CompiledReference(Image.fromarray(rgba, "RGBA"), pool.palette))
+    for reference in references:
+        pool.references.append(reference)
+
+    for _ in range(3):
+        for ref_index, reference in enumerate(references):
+            live = pool.palette.index_rgba(random_tile(rng, extra_colors=2)) # 比較の途中で増えた色も子に伝わる
+            expected = compare_live(reference, live, visual=False)
+            result = pool.compare(ref_index, live)
+            assert result[:3] == expected[:3]
+
+
+def test_shared_blocks_are_reused():
+    blocks = SharedBlocks(max_idle=2)
+    held = [blocks.acquire(100) for _ in range(4)]
+    for shm in held:
+        blocks.release(shm)
+    assert len(blocks._blocks) == 2 # 使っていないブロックは max_idle 個まで
+    again = blocks.acquire(50)
+    assert again in held and again.size >= 50
+    blocks.release(again)
+    larger = blocks.acquire(10_000)
+    assert larger.size >= 10_000
+    blocks.release(larger)
+    blocks.close()
+    assert blocks._blocks == [] and blocks._idle == []
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+replay のテスト。TileRecorder で記録したタイルを再生サーバーから TileFetcher で取得し直し、
+記録した順に同じ内容が返ることを確かめます。
+実行: python -m pytest -q
+"""
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from palette import Palette
+from replay import Recording, TileRecorder, start_replay_server
+from tile_client import TileFetcher
+
+COORDS = [(1, 1), (2, 1)]
+
+
+def tile_png(seed, size=10):
+    rng = np.random.default_rng(seed)
+    gray = np.array([0, 60, 120, 210, 255], dtype=np.uint8)[rng.integers(0, 5, (size, size))]
+    rgba = np.stack([gray, gray, gray, np.full_like(gray, 255)], axis=-1)
+    buf = io.BytesIO()
+    Image.fromarray(rgba, "RGBA").save(buf, "PNG")
+    return buf.getvalue()
+
+
+@pytest.fixture
+def recorded(tmp_path):
+    """(1, 1) は毎回、(2, 1) は2回に1回だけ内容が変わる5回分の取得を記録します。戻り値: 取得ごとの {座標: PNG}"""
+    recorder = TileRecorder(str(tmp_path))
+    frames = []
+    for i in range(5):
+        frame = {(1, 1): tile_png(i), (2, 1): tile_png(100 + i // 2)}
+        for coord, content in frame.items():
+            recorder.record(coord, content)
+        recorder.commit(1000.0 + i)
+        frames.append(frame)
+    recorder.commit(1010.0) # 変化がなければ何も書かない
+    recorder.close()
+    return str(tmp_path), frames
+
+
+def test_recording_stores_only_changes(recorded):
+    directory, frames = recorded
+    recording = Recording(directory)
+    assert len(recording) == 5 and recording.duration == 4.0
+    assert recording.frame_at(2.5) == 2
+    for number, frame in enumerate(frames):
+        for coord, content in frame.items():
+            assert recording.read_tile(recording.tile_name(coord, number)) == content
+    assert len(recording.history[(2, 1)][0]) == 3 # 変化したときだけ記録される
+    assert recording.tile_name((9, 9), 0) is None
+
+
+def test_replay_serves_frames_in_order(recorded):
+    directory, frames = recorded
+    server, clock = start_replay_server(Recording(directory), speed=0)
+    url = f"http://127.0.0.1:{server.server_address[1]}/tiles"
+    fetcher = TileFetcher(url, palette=Palette())
+    try:
+        for number, frame in enumerate(frames):
+            batch = fetcher.fetch_many(COORDS)
+            assert not batch.errors
+            for coord in COORDS:
+                expected = np.asarray(Image.open(io.BytesIO(frame[coord])).convert("RGBA"))
+                assert np.array_equal(fetcher.palette.to_rgba(batch.tiles[coord]), expected)
+            # (2, 1) は内容が変わらなかった回は 304 で「変化なし」になる
+            assert ((2, 1) in batch.changed) == (number % 2 == 0)
+        assert clock.finished
+        assert not fetcher.fetch_many([(9, 9)]).tiles[(9, 9)].any() # 記録にないタイルは 404 (透明)
+    finally:
+        fetcher.close()
+        server.shutdown()
+        server.server_close()
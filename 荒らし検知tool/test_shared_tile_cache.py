@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+shared_tile_cache のテスト。書いたタイルが読み手のパレットのインデックスで読み出せることと、
+他のユーザーが書き換えられるフォルダを使わないことを確かめます。
+実行: python -m pytest -q
+"""
+import os
+
+import numpy as np
+import pytest
+
+from palette import Palette
+from shared_tile_cache import SharedTileCache
+
+posix_only = pytest.mark.skipif(not hasattr(os, "getuid"), reason="所有者とパーミッションのない環境")
+
+
+def test_round_trip_between_palettes(tmp_path):
+    writer, reader = Palette(), Palette()
+    reader.add((1, 1, 1, 255)) # 読み手のパレットだけ色の順番がずれている
+    tile = np.array([[0, 5], [writer.add((9, 9, 9, 255)), 2]], dtype=np.uint8)
+    cache = SharedTileCache(str(tmp_path / "tiles"))
+    cache.write((3, 4), tile, writer, b"d" * 16, {"ETag": '"abc"'}, source="http://a", fetched_at=100.0)
+
+    shared = cache.read((3, 4), reader, source="http://a")
+    assert np.array_equal(reader.to_rgba(shared.tile), writer.to_rgba(tile))
+    assert (shared.digest, shared.validators, shared.fetched_at) == (b"d" * 16, {"ETag": '"abc"'}, 100.0)
+    assert cache.read((3, 4), reader, source="http://b") is None # 配信元ごとに分かれる
+
+    cache.touch((3, 4), source="http://a", fetched_at=200.0)
+    assert cache.read((3, 4), reader, source="http://a").fetched_at == 200.0
+
+
+@posix_only
+def test_new_directory_is_private(tmp_path):
+    directory = tmp_path / "tiles"
+    SharedTileCache(str(directory))
+    assert directory.stat().st_mode & 0o077 == 0
+
+
+@posix_only
+def test_refuses_writable_directory(tmp_path):
+    directory = tmp_path / "tiles"
+    directory.mkdir()
+    directory.chmod(0o777)
+    with pytest.raises(PermissionError):
+        SharedTileCache(str(directory))
+
+
+@posix_only
+def test_refuses_symlink(tmp_path):
+    (tmp_path / "real").mkdir(mode=0o700)
+    (tmp_path / "tiles").symlink_to(tmp_path / "real")
+    with pytest.raises(PermissionError):
+        SharedTileCache(str(tmp_path / "tiles"))
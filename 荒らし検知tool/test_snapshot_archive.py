@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+snapshot_archive のテスト。保存したフレームがキーフレーム・差分フレーム・パレット化できないフレームの
+どれであっても、読み出すと元の画像とピクセル単位で一致することを確かめます。
+実行: python -m pytest -q
+"""
+from collections import namedtuple
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from snapshot_archive import KIND_DELTA, KIND_KEY, KIND_RAW, SnapshotArchive, SnapshotArchiver
+
+
+def random_frames(rng, count, h=60, w=80, colors=40):
+    """少しずつ書き換わっていくフレームの列を作ります。途中に色数の多いフレームと同じ内容の連続を含めます。"""
+    palette = rng.integers(0, 256, (colors, 4), dtype=np.uint8)
+    palette[:, 3] = 255
+    palette[0] = 0
+    indices = rng.integers(0, colors, (h, w))
+    frames = []
+    for i in range(count):
+        if i % 7 != 3: # 7フレームに1回は前回と同じ内容
+            n = int(rng.integers(1, 40))
+            indices[rng.integers(0, h, n), rng.integers(0, w, n)] = rng.integers(0, colors, n)
+        if i == count // 2:
+            frames.append(rng.integers(0, 256, (h, w, 4), dtype=np.uint8)) # 256色を超えるフレーム
+        else:
+            frames.append(palette[indices])
+    return frames
+
+
+@pytest.fixture
+def archive_path(tmp_path):
+    return str(tmp_path / "region.wpsnap")
+
+
+def test_round_trip(archive_path):
+    rng = np.random.default_rng(0)
+    archive = SnapshotArchive(archive_path, keyframe_interval=10)
+    saved, times = [], []
+    for i, frame in enumerate(random_frames(rng, 60)):
+        if archive.add(Image.fromarray(frame, "RGBA"), 1000.0 + i):
+            saved.append(frame)
+            times.append(1000.0 + i)
+        else:
+            assert np.array_equal(frame, saved[-1]) # 保存しないのは前回と同じ内容のときだけ
+
+    assert len(archive) == len(saved)
+    assert {kind for _, _, kind in archive._index} == {KIND_KEY, KIND_DELTA, KIND_RAW}
+    for number, frame in enumerate(saved):
+        assert np.array_equal(np.asarray(archive.read_frame(number)), frame), number
+    assert np.array_equal(np.asarray(archive.read_frame(-1)), saved[-1])
+    with pytest.raises(IndexError):
+        archive.read_frame(len(saved))
+
+    assert archive.frame_at(times[0] - 1) is None
+    assert np.array_equal(np.asarray(archive.frame_at(times[5] + 0.5)), saved[5])
+    archive.close()
+
+
+def test_reopen_continues_the_archive(archive_path):
+    rng = np.random.default_rng(1)
+    frames = random_frames(rng, 20)
+    archive = SnapshotArchive(archive_path, keyframe_interval=5)
+    for i, frame in enumerate(frames[:10]):
+        archive.add(Image.fromarray(frame, "RGBA"), float(i))
+    count = len(archive)
+    archive.close()
+
+    # 再起動後は既存のレコードを読み込み、次のフレームをキーフレームとして追記する
+    archive = SnapshotArchive(archive_path, keyframe_interval=5)
+    assert len(archive) == count
+    assert np.array_equal(np.asarray(archive.read_frame(count - 1)), frames[9])
+    for i, frame in enumerate(frames[10:], start=10):
+        archive.add(Image.fromarray(frame, "RGBA"), float(i))
+    assert np.array_equal(np.asarray(archive.read_frame(-1)), frames[-1])
+    assert np.array_equal(np.asarray(archive.frame_at(9.5)), frames[9])
+    archive.close()
+
+
+def test_truncated_record_is_ignored(archive_path):
+    rng = np.random.default_rng(2)
+    frames = random_frames(rng, 5)
+    archive = SnapshotArchive(archive_path)
+    for i, frame in enumerate(frames):
+        archive.add(Image.fromarray(frame, "RGBA"), float(i))
+    count = len(archive)
+    archive.close()
+    with open(archive_path, "r+b") as f:
+        f.truncate(f.seek(0, 2) - 3) # 最後のレコードを書き込み途中の状態にする
+
+    archive = SnapshotArchive(archive_path)
+    assert len(archive) == count - 1
+    assert np.array_equal(np.asarray(archive.read_frame(-1)), frames[count - 2])
+    archive.close()
+
+
+def test_archiver_skips_unchanged_results(tmp_path):
+    Result = namedtuple("Result", ["timestamp", "error", "updated", "live_image"])
+    image = Image.new("RGBA", (4, 3), (1, 2, 3, 255))
+    archiver = SnapshotArchiver(str(tmp_path))
+    assert archiver.add_result("a/b", Result(1.0, None, True, image))
+    assert not archiver.add_result("a/b", Result(2.0, None, False, image))
+    assert not archiver.add_result("a/b", Result(3.0, "取得失敗", True, image))
+    assert len(archiver.archive("a/b")) == 1
+    archiver.close()
+    assert (tmp_path / "a_b.wpsnap").exists()
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+tile_client のテスト。http.server で立てた配信元の代わりに対して TileFetcher を動かし、
+条件付きGET (304 / ETag)、404 の透明タイル、タイルごとのエラー報告、並列取得を確かめます。
+監視領域の組み立て (assemble_region) は、タイルを並べた大きな配列からの切り出しと比べます。
+実行: python -m pytest -q
+"""
+import hashlib
+import io
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from palette import TRANSPARENT, Palette
+from replay import Recording, TileRecorder
+from shared_tile_cache import SharedTileCache
+from tile_client import TILE_SIZE, TileFetcher, assemble_region, empty_tile, region_tiles
+
+
+def tile_png(seed, size=10):
+    """パレットの色 (黒・灰色・白) だけでできた小さなタイルのPNGを作ります。"""
+    rng = np.random.default_rng(seed)
+    gray = np.array([0, 60, 120, 210, 255], dtype=np.uint8)[rng.integers(0, 5, (size, size))]
+    rgba = np.stack([gray, gray, gray, np.full_like(gray, 255)], axis=-1)
+    buf = io.BytesIO()
+    Image.fromarray(rgba, "RGBA").save(buf, "PNG")
+    return buf.getvalue()
+
+
+class TileServer:
+    """配信元の代わり。tiles にないタイルは 404、errors にあるタイルはそのステータスを返します。"""
+
+    def __init__(self):
+        self.tiles = {}      # (tx, ty) -> PNGのバイト列
+        self.errors = {}     # (tx, ty) -> ステータスコード
+        self.send_etag = True
+        self.delay = 0.0
+        self.requests = []   # (座標, リクエストヘッダー)
+        self.active = self.max_active = 0
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                tx, ty = self.path.rsplit(".", 1)[0].split("/")[-2:]
+                server.handle(self, (int(tx), int(ty)))
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/tiles"
+        threading.Thread(target=self.httpd.serve_forever, args=(0.05,), daemon=True).start()
+
+    def handle(self, handler, coord):
+        with self._lock:
+            self.requests.append((coord, dict(handler.headers)))
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            time.sleep(self.delay)
+            if coord in self.errors:
+                handler.send_response(self.errors[coord])
+                handler.end_headers()
+                return
+            body = self.tiles.get(coord)
+            if body is None:
+                handler.send_response(404)
+                handler.end_headers()
+                return
+            etag = '"%s"' % hashlib.md5(body).hexdigest()
+            if self.send_etag and handler.headers.get("If-None-Match") == etag:
+                handler.send_response(304)
+                handler.end_headers()
+                return
+            handler.send_response(200)
+            if self.send_etag:
+                handler.send_header("ETag", etag)
+            handler.send_header("Content-Length", str(len(body)))
+            handler.end_headers()
+            handler.wfile.write(body)
+        finally:
+            with self._lock:
+                self.active -= 1
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def server():
+    server = TileServer()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def make_fetcher(server):
+    fetchers = []
+
+    def make(**kwargs):
+        kwargs.setdefault("palette", Palette())
+        fetcher = TileFetcher(server.url, **kwargs)
+        fetchers.append(fetcher)
+        return fetcher
+
+    yield make
+    for fetcher in fetchers:
+        fetcher.close()
+
+
+def test_conditional_get_reuses_the_cached_tile(server, make_fetcher):
+    server.tiles[(1, 2)] = tile_png(0)
+    fetcher = make_fetcher()
+    tile, changed = fetcher.fetch_tile((1, 2))
+    assert changed and tile.shape == (10, 10)
+
+    again, changed = fetcher.fetch_tile((1, 2))
+    assert not changed and again is tile # 304: デコードせずにキャッシュのタイルを返す
+    assert "If-None-Match" in server.requests[-1][1]
+
+    server.tiles[(1, 2)] = tile_png(1)
+    updated, changed = fetcher.fetch_tile((1, 2))
+    assert changed and not np.array_equal(updated, tile)
+
+
+def test_identical_body_without_validators_is_unchanged(server, make_fetcher):
+    server.send_etag = False
+    server.tiles[(0, 0)] = tile_png(0)
+    fetcher = make_fetcher()
+    tile, _ = fetcher.fetch_tile((0, 0))
+    again, changed = fetcher.fetch_tile((0, 0))
+    assert not changed and again is tile
+    assert "If-None-Match" not in server.requests[-1][1]
+
+
+def test_missing_tile_is_transparent(server, make_fetcher):
+    fetcher = make_fetcher()
+    tile, changed = fetcher.fetch_tile((5, 5))
+    assert changed and np.array_equal(tile, empty_tile()) and (tile == TRANSPARENT).all()
+    assert not fetcher.fetch_tile((5, 5))[1] # 描かれるまでは「変化なし」
+
+    server.tiles[(5, 5)] = tile_png(2)
+    tile, changed = fetcher.fetch_tile((5, 5))
+    assert changed and tile.shape == (10, 10)
+
+
+def test_errors_are_reported_per_tile(server, make_fetcher):
+    server.tiles[(0, 0)] = server.tiles[(1, 0)] = tile_png(0)
+    server.errors[(1, 0)] = 500
+    batch = make_fetcher().fetch_many([(0, 0), (1, 0), (2, 0)])
+    assert set(batch.tiles) == {(0, 0), (2, 0)}
+    assert set(batch.errors) == {(1, 0)} and "500" in batch.errors[(1, 0)]
+    assert batch.changed == {(0, 0), (2, 0)}
+
+
+def test_tiles_are_fetched_concurrently(server, make_fetcher):
+    coords = [(x, 0) for x in range(4)]
+    for x, coord in enumerate(coords):
+        server.tiles[coord] = tile_png(x)
+    server.delay = 0.2
+    batch = make_fetcher(max_workers=4).fetch_many(coords)
+    assert set(batch.tiles) == set(coords) and not batch.errors
+    assert server.max_active > 1
+
+
+def test_fresh_shared_tile_is_used_without_fetching(server, make_fetcher, tmp_path):
+    server.tiles[(3, 3)] = tile_png(0)
+    shared_cache = SharedTileCache(str(tmp_path / "shared"))
+    first = make_fetcher(shared_cache=shared_cache)
+    tile, _ = first.fetch_tile((3, 3))
+
+    # 別のプロセスに相当する fetcher は、確認されたばかりのタイルを取得せずに使う
+    second = make_fetcher(shared_cache=shared_cache, shared_max_age=60)
+    shared, changed = second.fetch_tile((3, 3))
+    assert changed and np.array_equal(second.palette.to_rgba(shared), first.palette.to_rgba(tile))
+    assert len(server.requests) == 1
+
+    # 古くなった共有タイルは、その検証子で条件付きGETをする
+    third = make_fetcher(shared_cache=shared_cache, shared_max_age=0)
+    third.fetch_tile((3, 3))
+    assert len(server.requests) == 2 and "If-None-Match" in server.requests[-1][1]
+
+
+def test_recording_ignores_shared_tiles(server, make_fetcher, tmp_path):
+    server.tiles[(3, 3)] = tile_png(0)
+    shared_cache = SharedTileCache(str(tmp_path / "shared"))
+    make_fetcher(shared_cache=shared_cache).fetch_tile((3, 3))
+
+    recorder = TileRecorder(str(tmp_path / "record"))
+    recording = make_fetcher(shared_cache=shared_cache, shared_max_age=60, recorder=recorder)
+    batch = recording.fetch_many([(3, 3)])
+    recorder.close()
+    assert not batch.errors
+    # 共有キャッシュのタイルで 304 を受けると記録できないので、検証子を付けずに取得して記録する
+    assert "If-None-Match" not in server.requests[-1][1]
+    played = Recording(str(tmp_path / "record"))
+    assert played.read_tile(played.tile_name((3, 3), 0)) == server.tiles[(3, 3)]
+
+
+def test_fetch_without_keeping_tiles(server, make_fetcher):
+    server.tiles[(0, 0)] = tile_png(0)
+    fetcher = make_fetcher()
+    batch = fetcher.fetch_many([(0, 0)], keep=False)
+    assert batch.changed == {(0, 0)} and len(fetcher.cache) == 0
+    # タイルを持っていなくても、本文のハッシュで変化がないことは分かる
+    batch = fetcher.fetch_many([(0, 0)], keep=False)
+    assert not batch.changed and batch.tiles[(0, 0)].shape == (10, 10)
+    assert len(fetcher.cache) == 0
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_assemble_region_matches_stitched_tiles(seed):
+    rng = np.random.default_rng(seed)
+    tiles = {(tx, ty): rng.integers(1, 60, (TILE_SIZE, TILE_SIZE)).astype(np.uint8)
+             for tx in range(3, 6) for ty in range(7, 9)}
+    stitched = np.zeros((2 * TILE_SIZE, 3 * TILE_SIZE), dtype=np.uint8)
+    for (tx, ty), tile in tiles.items():
+        stitched[(ty - 7) * TILE_SIZE:(ty - 6) * TILE_SIZE, (tx - 3) * TILE_SIZE:(tx - 2) * TILE_SIZE] = tile
+    missing = list(tiles)[int(rng.integers(0, len(tiles)))]
+    tx, ty = missing # ないタイルの部分は透明のまま残る
+    stitched[(ty - 7) * TILE_SIZE:(ty - 6) * TILE_SIZE, (tx - 3) * TILE_SIZE:(tx - 2) * TILE_SIZE] = TRANSPARENT
+    del tiles[missing]
+
+    x, y = int(rng.integers(0, 2 * TILE_SIZE)), int(rng.integers(0, TILE_SIZE))
+    w, h = int(rng.integers(1, 3 * TILE_SIZE - x + 1)), int(rng.integers(1, 2 * TILE_SIZE - y + 1))
+    region = assemble_region(tiles, 3 * TILE_SIZE + x, 7 * TILE_SIZE + y, w, h)
+    assert np.array_equal(region, stitched[y:y + h, x:x + w])
+
+    # 監視領域のタイル範囲は region_tiles と一致する
+    _, _, start_x, start_y, end_x, end_y = region_tiles(3, 7, x, y, w, h)
+    assert (start_x, start_y) == (3 + x // TILE_SIZE, 7 + y // TILE_SIZE)
+    assert (end_x, end_y) == (3 + (x + w - 1) // TILE_SIZE, 7 + (y + h - 1) // TILE_SIZE)
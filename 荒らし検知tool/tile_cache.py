@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+デコード済みタイルのLRUキャッシュ。
+(tx, ty) をキーに、メモリ使用量の上限 (バイト数) を超えないよう古いものから破棄します。
+"""
+import threading
+from collections import OrderedDict
+
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024 # 1000x1000 のインデックス配列のタイルで64枚分
+
+
+def _size_of(value):
+    """キャッシュする値のおおよそのバイト数を返します (NumPy配列 / Pillow画像)。"""
+    nbytes = getattr(value, "nbytes", None)
+    if nbytes is not None:
+        return int(nbytes)
+    return value.width * value.height * len(value.getbands())
+
+
+class TileCache:
+    """スレッドセーフなLRUキャッシュ。ヒット・ミス・破棄の回数を数えます。"""
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict() # (tx, ty) -> (値, バイト数)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, coord):
+        return coord in self._entries
+
+    def get(self, coord):
+        """キャッシュされた値を返します。なければ None。"""
+        with self._lock:
+            entry = self._entries.get(coord)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(coord)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, coord, value):
+        """値を登録し、上限を超えた分を古いものから破棄します。"""
+        size = _size_of(value)
+        with self._lock:
+            old = self._entries.pop(coord, None)
+            if old is not None:
+                self.current_bytes -= old[1]
+            if size > self.max_bytes:
+                return # 1枚で上限を超えるものはキャッシュしない
+            self._entries[coord] = (value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+    def discard(self, coord):
+        with self._lock:
+            old = self._entries.pop(coord, None)
+            if old is not None:
+                self.current_bytes -= old[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+wplaceのタイル取得処理。
+監視領域が複数タイルにまたがる場合でも、各タイルのダウンロードとPNGデコードを
+スレッドプールで並列に行い、1回のチェックの待ち時間を最も遅いタイル1枚分に抑えます。
+接続は Session で使い回し、ETag / Last-Modified による条件付きGETで
+変化のないタイルの再ダウンロード・再デコードを省きます。
+さらにレスポンス本文のハッシュを記録し、内容が前回と同一なら再デコードせず
+「変化なし」として報告します。
+デコードしたタイルはパレットのインデックス配列 (1ピクセル1バイト) として保持します。
+まだ誰も描いていないタイルには配信元が 404 を返すので、全面透明のタイルとして扱います。
+"""
+import hashlib
+import io
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from PIL import Image
+
+from metrics import METRICS
+from palette import DEFAULT_PALETTE, TRANSPARENT
+from shared_tile_cache import DEFAULT_MAX_AGE_SEC
+from tile_cache import TileCache
+
+TILE_BASE_URL = "https://backend.wplace.live/files/s0/tiles"
+TILE_SIZE = 1000 # wplaceのタイルのサイズは1000x1000ピクセル
+DEFAULT_TIMEOUT_SEC = 5
+DEFAULT_MAX_WORKERS = 4
+EMPTY_TILE_DIGEST = hashlib.blake2b(b"", digest_size=16).digest() # 404 (未描画のタイル) の本文のハッシュとして扱う値
+
+# tiles: {(tx, ty): パレットのインデックス配列 (uint8)} / errors: {(tx, ty): エラーメッセージ}
+# changed: 前回の取得から内容が変わった（または初めて取得した）タイル座標の集合
+TileBatch = namedtuple("TileBatch", ["tiles", "errors", "changed"])
+
+
+def region_tiles(tile_x, tile_y, x_in_tile, y_in_tile, width, height):
+    """
+    監視領域のグローバル座標と、領域がカバーするタイル範囲を返します。
+    戻り値: (global_x, global_y, start_tile_x, start_tile_y, end_tile_x, end_tile_y)
+    """
+    global_x = tile_x * TILE_SIZE + x_in_tile
+    global_y = tile_y * TILE_SIZE + y_in_tile
+    start_tile_x = global_x // TILE_SIZE
+    start_tile_y = global_y // TILE_SIZE
+    end_tile_x = (global_x + width - 1) // TILE_SIZE
+    end_tile_y = (global_y + height - 1) // TILE_SIZE
+    return global_x, global_y, start_tile_x, start_tile_y, end_tile_x, end_tile_y
+
+
+def tile_overlap(coord, tile_shape, global_x, global_y, width, height):
+    """
+    タイルと監視領域の重なりを返します。重ならなければ None。
+    戻り値: ((監視領域内の x0, y0, x1, y1), (タイル内の行のスライス, 列のスライス))
+    """
+    tx, ty = coord
+    left = max(global_x, tx * TILE_SIZE)
+    top = max(global_y, ty * TILE_SIZE)
+    right = min(global_x + width, tx * TILE_SIZE + tile_shape[1])
+    bottom = min(global_y + height, ty * TILE_SIZE + tile_shape[0])
+    if left >= right or top >= bottom:
+        return None
+    rect = (left - global_x, top - global_y, right - global_x, bottom - global_y)
+    return rect, (slice(top - ty * TILE_SIZE, bottom - ty * TILE_SIZE),
+                  slice(left - tx * TILE_SIZE, right - tx * TILE_SIZE))
+
+
+def assemble_region(tiles, global_x, global_y, width, height, out=None):
+    """
+    タイルを結合せずに、監視領域 (グローバル座標 global_x, global_y から width x height) を組み立てます。
+    各タイルと監視領域が重なる部分だけを出力配列に直接コピーするので、
+    使うメモリとコピー量はタイル数ではなく監視領域の大きさで決まります。
+    tiles: {(tx, ty): インデックス配列}。ない部分は透明のインデックス0のままになります。
+    """
+    if out is None:
+        out = np.zeros((height, width), dtype=np.uint8)
+    for coord, tile in tiles.items():
+        overlap = tile_overlap(coord, tile.shape, global_x, global_y, width, height)
+        if overlap is None:
+            continue
+        (x0, y0, x1, y1), tile_area = overlap
+        out[y0:y1, x0:x1] = tile[tile_area]
+    return out
+
+
+def decode_tile(content, palette=DEFAULT_PALETTE):
+    """PNGのバイト列をデコードし、パレットのインデックス配列 (uint8) に変換します。"""
+    return palette.index_image(Image.open(io.BytesIO(content)))
+
+
+def empty_tile():
+    """まだ誰も描いていない (全面透明の) タイルを返します。"""
+    return np.full((TILE_SIZE, TILE_SIZE), TRANSPARENT, dtype=np.uint8)
+
+
+class TileFetcher:
+    """
+    上限付きのスレッドプールで複数タイルを並列に取得します。
+    タイルごとに検証子 (ETag / Last-Modified) を保持し、デコード済みのタイルは TileCache に置きます。
+    304 Not Modified が返った場合はキャッシュのタイルをそのまま返します。
+    キャッシュから追い出されたタイルは、条件付きでない通常のGETで取り直します。
+    recorder (replay.TileRecorder) を渡すと、受け取ったタイルの生データを取得ごとに記録します。
+    shared_cache (shared_tile_cache.SharedTileCache) を渡すと、同じマシンの他のプロセスとデコード済みのタイルを共有し、
+    他のプロセスが shared_max_age 秒以内に確認したタイルは取得もデコードもせずに使います。
+    """
+
+    def __init__(self, base_url=TILE_BASE_URL, max_workers=DEFAULT_MAX_WORKERS, timeout=DEFAULT_TIMEOUT_SEC,
+                 cache=None, palette=None, metrics=None, recorder=None, shared_cache=None,
+                 shared_max_age=DEFAULT_MAX_AGE_SEC):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.cache = cache if cache is not None else TileCache()
+        self.palette = palette if palette is not None else DEFAULT_PALETTE
+        self.metrics = metrics if metrics is not None else METRICS
+        self.recorder = recorder
+        self.shared_cache = shared_cache
+        self.shared_max_age = shared_max_age
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tile-fetch")
+
+        # 並列取得数と同じだけの接続をプールしておく
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._lock = threading.Lock()
+        self._validators = {}  # (tx, ty) -> {"ETag": ..., "Last-Modified": ...}
+        self._digests = {}     # (tx, ty) -> レスポンス本文のハッシュ
+
+    def tile_url(self, tx, ty):
+        return f"{self.base_url}/{tx}/{ty}.png"
+
+    def set_base_url(self, base_url):
+        """
+        タイル配信元を切り替えます。
+        前の配信元の検証子とハッシュは使えないので捨て、次の取得ではすべてのタイルを「変化あり」として取り直します。
+        """
+        with self._lock:
+            self.base_url = base_url.rstrip("/")
+            self._validators.clear()
+            self._digests.clear()
+        self.cache.clear()
+
+    def fetch_tile(self, coord, keep=True):
+        """
+        1枚のタイルを条件付きGETで取得します。404 は全面透明のタイルとし、それ以外の失敗時は例外を送出します。
+        keep=False なら取得したタイルを TileCache に置きません (検証子とハッシュは保持するので、変化の有無は分かります)。
+        戻り値: (インデックス配列, 前回から内容が変わったかどうか)
+        """
+        cached = self.cache.get(coord)
+        with self._lock:
+            validators = self._validators.get(coord, {})
+            digest = self._digests.get(coord)
+        # base: 手元にあるタイルと、その検証子・本文のハッシュ
+        base, base_validators, base_digest = cached, validators, digest
+
+        shared = None
+        if self.shared_cache is not None:
+            shared = self.shared_cache.read(coord, self.palette, self.base_url)
+            # 記録中は共有キャッシュのタイルを元にしない。304 が返ると、このプロセスが一度も受け取っていない
+            # タイルの生データを記録できなくなるため (共有キャッシュへの書き込みは続ける)
+            if shared is not None and self.recorder is None:
+                if 0 <= time.time() - shared.fetched_at <= self.shared_max_age:
+                    # 他のプロセスが確認したばかりのタイルを、取得もデコードもせずに使う
+                    return self._adopt(coord, shared.tile if shared.digest != digest or cached is None else cached,
+                                       shared.validators, shared.digest, digest, cached, keep)
+                if cached is None or shared.digest != digest:
+                    # 手元にないか古い場合は、共有キャッシュのタイルを元に条件付きGETをする
+                    base, base_validators, base_digest = shared.tile, shared.validators, shared.digest
+
+        headers = {}
+        if base is not None:
+            if "ETag" in base_validators:
+                headers["If-None-Match"] = base_validators["ETag"]
+            if "Last-Modified" in base_validators:
+                headers["If-Modified-Since"] = base_validators["Last-Modified"]
+
+        with self.metrics.span("fetch"):
+            resp = self.session.get(self.tile_url(*coord), headers=headers, timeout=self.timeout)
+        if resp.status_code == 304 and base is not None:
+            self._publish(coord, base, base_validators, base_digest, shared)
+            return self._adopt(coord, base, base_validators, base_digest, digest, cached, keep)
+        if resp.status_code == 404:
+            # 未描画のタイル。描かれるまで毎回「変化なし」になるよう、決まったハッシュを使う
+            content, new_validators, new_digest = None, {}, EMPTY_TILE_DIGEST
+        else:
+            resp.raise_for_status()
+            content = resp.content
+            new_validators = {k: resp.headers[k] for k in ("ETag", "Last-Modified") if k in resp.headers}
+            new_digest = hashlib.blake2b(content, digest_size=16).digest()
+            if self.recorder is not None:
+                self.recorder.record(coord, content, new_digest)
+        if base is not None and new_digest == base_digest:
+            # 検証子を返さないサーバーでも、本文が同一ならデコードを省く
+            self._publish(coord, base, new_validators, new_digest, shared)
+            return self._adopt(coord, base, new_validators, new_digest, digest, cached, keep)
+
+        # キャッシュから追い出されていた場合でも、内容が同じなら「変化なし」と報告する
+        if content is None:
+            tile = empty_tile()
+        else:
+            with self.metrics.span("decode"):
+                tile = self._decode(coord, content)
+        self._publish(coord, tile, new_validators, new_digest, shared)
+        return self._adopt(coord, tile, new_validators, new_digest, digest, cached, keep)
+
+    def _adopt(self, coord, tile, validators, new_digest, digest, cached, keep=True):
+        """tile を現在の内容として記録し、(タイル, 前回から内容が変わったかどうか) を返します。"""
+        if tile is not cached and keep:
+            self.cache.put(coord, tile)
+        with self._lock:
+            self._validators[coord] = validators
+            self._digests[coord] = new_digest
+        return tile, new_digest != digest
+
+    def _publish(self, coord, tile, validators, new_digest, shared):
+        """共有キャッシュを更新します。内容が同じなら確認時刻だけを書き換えます。"""
+        if self.shared_cache is None:
+            return
+        if shared is not None and shared.digest == new_digest:
+            self.shared_cache.touch(coord, self.base_url)
+        else:
+            self.shared_cache.write(coord, tile, self.palette, new_digest, validators, self.base_url)
+
+    def _decode(self, coord, content):
+        """取得したPNGをデコードします。別プロセスでデコードするサブクラス (parallel.py) が置き換えます。"""
+        return decode_tile(content, self.palette)
+
+    def fetch_many(self, coords, keep=True):
+        """
+        指定されたタイル座標をすべて並列に取得します。
+        失敗したタイルは例外を握りつぶさず、errors にタイルごとの理由を記録します。
+        keep=False なら取得したタイルをキャッシュに置かず、返した TileBatch だけがタイルを保持します。
+        """
+        futures = {coord: self._executor.submit(self.fetch_tile, coord, keep) for coord in coords}
+        tiles, errors, changed = {}, {}, set()
+        for coord, future in futures.items():
+            try:
+                tiles[coord], tile_changed = future.result()
+            except Exception as e:
+                errors[coord] = str(e)
+                continue
+            if tile_changed:
+                changed.add(coord)
+        if self.recorder is not None:
+            self.recorder.commit()
+        return TileBatch(tiles, errors, changed)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self.session.close()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+複数の監視領域（ウォッチリスト）の読み込み。
+JSONファイルの形式:
+    {
+      "regions": [
+        {"name": "菊の紋章", "ref_pixel": "1818, 806, 989, 359", "reference": "kiku.png",
+         "thresholds": [36.0, 27.0, 15.0, 6.1]}
+      ]
+    }
+ref_pixel は4つの整数のリストでも構いません。thresholds は省略するとデフォルト値になります。
+reference の相対パスはウォッチリストファイルのフォルダを基準に解決します。
+"streaming": true を指定した領域は、タイルごとのストリーミング比較で監視します (巨大な参照画像向け)。
+"""
+import json
+import os
+
+from engine import LEVELS_DATA, DEFAULT_REF_PIXEL, DetectionEngine, load_reference, safe_int_quad
+
+
+def _parse_entry(entry, index):
+    name = entry.get("name") or f"region-{index}"
+
+    ref_pixel = entry.get("ref_pixel")
+    if isinstance(ref_pixel, (list, tuple)):
+        ref_pixel = ",".join(str(v) for v in ref_pixel)
+    quad = safe_int_quad(ref_pixel if isinstance(ref_pixel, str) else "", DEFAULT_REF_PIXEL)
+    if quad == "error":
+        raise ValueError(f"{name}: ref_pixel はカンマ区切りの4つの整数で指定してください")
+
+    if not entry.get("reference"):
+        raise ValueError(f"{name}: reference (参照画像のパス) がありません")
+
+    thresholds = entry.get("thresholds")
+    if thresholds is not None:
+        if len(thresholds) != len(LEVELS_DATA):
+            raise ValueError(f"{name}: thresholds は{len(LEVELS_DATA)}個指定してください")
+        thresholds = [float(v) for v in thresholds]
+
+    return name, quad, entry["reference"], thresholds
+
+
+def load_watchlist(path, fetcher):
+    """
+    ウォッチリストを読み込み、[(領域名, DetectionEngine), ...] を返します。
+    同じ参照画像を使う領域どうしでは、事前計算した参照を共有します。
+    """
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+
+    base_dir = os.path.dirname(os.path.abspath(path))
+    references = {}
+    engines = []
+    for index, entry in enumerate(data.get("regions", [])):
+        name, quad, ref_path, thresholds = _parse_entry(entry, index)
+        candidate = os.path.join(base_dir, ref_path)
+        if os.path.exists(candidate):
+            ref_path = candidate
+        key = (ref_path, bool(entry.get("streaming")))
+        if key not in references:
+            references[key] = load_reference(*key)
+        engines.append((name, DetectionEngine(references[key], quad, thresholds, fetcher, keep_images=False)))
+
+    if not engines:
+        raise ValueError("ウォッチリストに監視領域がありません")
+    return engines
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+バックグラウンドで検知エンジンを回すワーカースレッド。
+タイル取得・デコード・比較はすべてこのスレッドで行い、結果 (CheckResult) を
+スレッドセーフなキューでGUIに渡します。GUIスレッドは描画だけを担当します。
+"""
+import queue
+import threading
+import time
+
+from metrics import METRICS
+from polling import DEFAULT_MAX_INTERVAL_SEC, AdaptiveInterval
+
+MIN_INTERVAL_SEC = 0.5
+
+
+class DetectionWorker:
+    """
+    DetectionEngine を定期的に実行し、結果を results キューに入れます。
+    設定の変更は configure() で受け付け、次のチェックの直前にワーカースレッド上で反映します。
+    store (HistoryStore) / archiver (SnapshotArchiver) を渡すと、結果の保存もワーカースレッドで行います。
+    チェック間隔は interval_sec を最短として、差分率に変化がない間は max_interval_sec まで広げます。
+    """
+
+    def __init__(self, engine, results=None, interval_sec=1.0, store=None, region=None, archiver=None,
+                 max_interval_sec=DEFAULT_MAX_INTERVAL_SEC, metrics=None):
+        self.engine = engine
+        self.results = results if results is not None else queue.Queue()
+        self.store = store
+        self.archiver = archiver
+        self.region = region
+        self.pacer = AdaptiveInterval(max(MIN_INTERVAL_SEC, interval_sec), max_interval_sec)
+        self.metrics = metrics if metrics is not None else METRICS
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="detection-worker", daemon=True)
+
+    def configure(self, **settings):
+        """
+        ref_pixel / thresholds / interval_sec / reference / base_url / show_heatmap を更新します。
+        GUIスレッドから呼んでも、エンジンへの反映はワーカースレッドで行われます。
+        """
+        with self._lock:
+            self._pending.update(settings)
+
+    def check_now(self):
+        """待機中のチェックを前倒しして、すぐに次のチェックを行います。"""
+        self._wake.set()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+
+    def _apply_pending(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        # 監視対象やチェック間隔が変わったら、静かな状態で広げた間隔を引き継がない
+        reset = False
+        if "reference" in pending:
+            self.engine.set_reference(pending["reference"])
+            reset = True
+        if "ref_pixel" in pending:
+            reset = reset or pending["ref_pixel"] != self.engine.ref_pixel
+            self.engine.ref_pixel = pending["ref_pixel"]
+        if "thresholds" in pending:
+            self.engine.thresholds = pending["thresholds"]
+        if "show_heatmap" in pending and pending["show_heatmap"] != self.engine.show_heatmap:
+            self.engine.show_heatmap = pending["show_heatmap"]
+            self.engine.last_result = None # 表示を切り替えたらタイルに変化がなくても結果を作り直す
+        if "base_url" in pending and pending["base_url"].rstrip("/") != self.engine.fetcher.base_url:
+            self.engine.fetcher.set_base_url(pending["base_url"])
+            reset = True
+        interval_sec = max(MIN_INTERVAL_SEC, pending.get("interval_sec", self.pacer.min_interval))
+        if reset or interval_sec != self.pacer.min_interval:
+            self.pacer.set_min_interval(interval_sec)
+
+    def _run(self):
+        while not self._stop.is_set():
+            started = time.monotonic()
+            self._apply_pending()
+            try:
+                result = self.engine.check()
+            except Exception as e:
+                result = self.engine.error_result(time.time(), f"チェック中にエラーが発生しました: {e}")
+            elapsed = time.monotonic() - started
+            self.metrics.observe("tick", elapsed)
+            if elapsed > self.pacer.interval:
+                self.metrics.inc("tick_overruns")
+            self.results.put(result)
+            if self.store is not None:
+                try:
+                    self.store.add_result(self.region, result)
+                except Exception as e:
+                    print(f"履歴の保存中にエラーが発生しました: {e}")
+            if self.archiver is not None:
+                try:
+                    self.archiver.add_result(self.region, result)
+                except Exception as e:
+                    print(f"スナップショットの保存中にエラーが発生しました: {e}")
+
+            remaining = self.pacer.observe(result) - (time.monotonic() - started)
+            if remaining > 0:
+                self._wake.wait(remaining)
+            self._wake.clear()
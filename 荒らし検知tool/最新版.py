@@ -2,30 +2,40 @@
 # -*- coding: utf-8 -*-
 import tkinter as tk
 from tkinter import ttk, messagebox
-from PIL import Image, ImageTk, ImageChops
-import requests, io, time, os
+from PIL import Image, ImageTk
+import time, os, queue
 import matplotlib
 matplotlib.use("TkAgg")
 import matplotlib.pyplot as plt
 import matplotlib.font_manager as fm
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+from matplotlib.patches import Wedge
 import math 
 
+from diff_engine import CompiledReference
+from engine import (DEFAULT_INTERVAL_MS, DEFAULT_REF_PIXEL, DEFAULT_SEAL_IMAGE_PATH, LEVELS_DATA,
+                    SETTINGS_ERROR, DetectionEngine, classify, safe_int_quad)
+from heatmap import HeatmapStore
+from history import History
+from history_store import HistoryStore
+from metrics import METRICS, STAGE_LABELS, start_metrics_server
+from polling import DEFAULT_MAX_INTERVAL_SEC
+from snapshot_archive import SnapshotArchiver
+from shared_tile_cache import SharedTileCache
+from tile_client import TILE_BASE_URL, TileFetcher
+from worker import DetectionWorker
+
 # --- 定数設定 ---
-# 監視開始位置: (タイルのx, タイルのy, タイル内のx, タイル内のy)
-DEFAULT_REF_PIXEL = (1818, 806, 989, 359)
-DEFAULT_SEAL_IMAGE_PATH = "kiku.png"
-DEFAULT_INTERVAL_MS = 1000
 WINDOW_GEOMETRY = "1200x800"
-TILE_SIZE = 1000 # wplaceのタイルのサイズは1000x1000ピクセル
-
-# 荒らしレベルと色の定義 (しきい値は変数で管理)
-LEVELS_DATA = [
-    {"label": "超大規模荒らし", "color": "#ff4d4f", "graph_color": "#c0392b", "default_limit": 36.0},
-    {"label": "大規模荒らし", "color": "#ff7a45", "graph_color": "#d35400", "default_limit": 27.0},
-    {"label": "中規模荒らし", "color": "#ffa940", "graph_color": "#f39c12", "default_limit": 15.0},
-    {"label": "小規模荒らし", "color": "#40c057", "graph_color": "#27ae60", "default_limit": 6.1},
-]
+RESULT_POLL_MS = 100 # ワーカーの結果を取り出す間隔
+GRAPH_X_MARGIN_SEC = 30 # 折れ線グラフの時間軸の余白。これを使い切るまでは背景を描き直さない
+HISTORY_DB_PATH = "history.sqlite3" # 差分履歴の保存先 (スクリプトのフォルダ基準)
+SNAPSHOT_DIR = "snapshots" # 変化のあったフレームの保存先 (スクリプトのフォルダ基準)
+HEATMAP_DIR = "heatmaps" # ピクセルごとの被害回数の保存先 (スクリプトのフォルダ基準)
+METRICS_PORT = 9464 # 処理時間のメトリクスを http://127.0.0.1:9464/metrics で公開する
+SHARED_TILE_CACHE = False # True にすると、同じマシンの他の検知プロセスとデコード済みのタイルを共有する
+DIAGNOSTICS_REFRESH_MS = 1000 # 診断パネルの更新間隔
+RESIZE_DEBOUNCE_MS = 50 # ウィンドウのリサイズ中は、この時間イベントが途切れてから画像を描き直す
 NORMAL_COLOR = "#e0e0e0"
 NORMAL_GRAPH_COLOR = "#2ecc71"
 
@@ -41,20 +51,52 @@ class VandalismDetectorApp:
         self.start_time = time.time()
         self.current_cropped_image = None
         self.current_diff_image = None
+        self.current_heatmap_image = None
+        self.frame_serial = 0 # 表示する画像 (または参照のマスク) が変わるたびに増やす
+        self.masked_frame = None # (frame_serial, マスク適用済みのリアルタイム画像)
+        self.display_key = None # 最後に表示した (frame_serial, 表示サイズ)
+        self.realtime_tk = None
+        self.diff_tk = None
+        self.heatmap_tk = None
+        self.resize_after_id = None
         self.after_id = None
-        self.diff_history = []
-        self.time_history = []
-        self.max_history_points = 100 
+        self.history = History() # 数時間分を保持するリングバッファ
+        self.max_history_points = 100 # グラフに表示する点数
         self.seal_image = None
+        self.reference = None
         self.original_image_width = 0
         self.original_image_height = 0
         self.monitor_size = (0, 0)
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        self.heatmaps = HeatmapStore(os.path.join(script_dir, HEATMAP_DIR))
+        # 同じマシンで動いている他の検知プロセスと、デコード済みのタイルを共有する (フォルダを使えなければ共有しない)
+        shared_cache = None
+        if SHARED_TILE_CACHE:
+            try:
+                shared_cache = SharedTileCache()
+            except OSError as e:
+                print(f"デバッグ情報: 共有キャッシュのフォルダを使えません: {e}")
+        self.engine = DetectionEngine(fetcher=TileFetcher(shared_cache=shared_cache), heatmaps=self.heatmaps)
+        self.results = queue.Queue()
+        self.history_store = HistoryStore(os.path.join(script_dir, HISTORY_DB_PATH))
+        self.archiver = SnapshotArchiver(os.path.join(script_dir, SNAPSHOT_DIR))
+        self.worker = DetectionWorker(self.engine, self.results, store=self.history_store, archiver=self.archiver)
+        self.metrics = METRICS
+        try:
+            self.metrics_server = start_metrics_server(self.metrics, METRICS_PORT)
+        except OSError as e:
+            print(f"デバッグ情報: メトリクスのポート {METRICS_PORT} を開けませんでした: {e}")
+            self.metrics_server = None
+        self.diagnostics_window = None
 
         # --- Tkinter変数 ---
         self.realtime_ref_pixel_var = tk.StringVar(value=f"{DEFAULT_REF_PIXEL[0]}, {DEFAULT_REF_PIXEL[1]}, {DEFAULT_REF_PIXEL[2]}, {DEFAULT_REF_PIXEL[3]}")
         self.interval_sec_var = tk.IntVar(value=max(1, DEFAULT_INTERVAL_MS // 1000))
         self.reference_image_path_var = tk.StringVar(value=DEFAULT_SEAL_IMAGE_PATH)
+        self.base_url_var = tk.StringVar(value=TILE_BASE_URL)
+        self.base_url = TILE_BASE_URL # 入力途中のURLで取得しないよう、適用ボタンを押したときだけ更新する
         self.status_var = tk.StringVar(value="初期化中...")
+        self.show_heatmap_var = tk.BooleanVar(value=False)
         
         # 閾値用のTkinter変数
         self.threshold_vars = [tk.DoubleVar(value=d['default_limit']) for d in LEVELS_DATA]
@@ -66,10 +108,15 @@ class VandalismDetectorApp:
         
         # --- 初期設定の適用 ---
         self._apply_settings(initial_load=True)
+        if self.seal_image is None:
+            return # 読み込みに失敗してウィンドウは閉じられている
         
         # --- 定期処理の開始 ---
-        self._tick_check()
+        # 取得・比較はワーカースレッドで行い、GUIスレッドは結果の描画だけを行う
+        self.worker.start()
+        self._poll_results()
         self.root.bind("<Configure>", self._on_resize)
+        self.root.protocol("WM_DELETE_WINDOW", self._on_close)
 
     def _setup_styles(self):
         """UIのスタイルを一括で設定します。"""
@@ -160,10 +207,13 @@ class VandalismDetectorApp:
         self.line_canvas_widget.configure(bg=self.CARD_BG)
         self.line_canvas_widget.grid(row=0, column=1, padx=10, pady=5, sticky="nsew")
         
+        self._init_graph_artists()
         self._update_graph(0)
+        for var in self.threshold_vars:
+            var.trace_add("write", self._on_threshold_changed)
         
         # 画像表示エリアをgridで分割
-        image_area = ttk.Frame(frame)
+        image_area = self.image_area = ttk.Frame(frame)
         image_area.pack(expand=True, fill="both")
         image_area.columnconfigure(0, weight=1)
         image_area.columnconfigure(1, weight=1)
@@ -179,9 +229,19 @@ class VandalismDetectorApp:
         # 差分画像コンテナ
         diff_container = ttk.Frame(image_area, borderwidth=1, relief="solid")
         diff_container.grid(row=0, column=1, sticky="nsew", padx=(10, 0))
-        ttk.Label(diff_container, text="差分", style="SubHeader.TLabel").pack(anchor="w", padx=5, pady=5)
+        diff_header = ttk.Frame(diff_container)
+        diff_header.pack(fill="x")
+        ttk.Label(diff_header, text="差分", style="SubHeader.TLabel").pack(side="left", padx=5, pady=5)
+        ttk.Checkbutton(diff_header, text="ヒートマップを表示", variable=self.show_heatmap_var,
+                        command=self._toggle_heatmap).pack(side="right", padx=5, pady=5)
         self.diff_image_label = ttk.Label(diff_container)
         self.diff_image_label.pack(expand=True, padx=5, pady=5)
+
+        # ヒートマップコンテナ (チェックボックスで表示したときだけ並べる)
+        self.heatmap_container = ttk.Frame(image_area, borderwidth=1, relief="solid")
+        ttk.Label(self.heatmap_container, text="ヒートマップ (荒らされた回数)", style="SubHeader.TLabel").pack(anchor="w", padx=5, pady=5)
+        self.heatmap_image_label = ttk.Label(self.heatmap_container)
+        self.heatmap_image_label.pack(expand=True, padx=5, pady=5)
         
         return frame
 
@@ -193,11 +253,15 @@ class VandalismDetectorApp:
         ttk.Label(frame, text="リアルタイム参照ピクセル\n(タイルx, タイルy, タイル内x, タイル内y)", style="Card.TLabel").pack(anchor="w", pady=(10, 2))
         ttk.Entry(frame, textvariable=self.realtime_ref_pixel_var).pack(fill="x")
 
-        ttk.Label(frame, text="更新間隔 (秒)", style="Card.TLabel").pack(anchor="w", pady=(10, 2))
+        ttk.Label(frame, text=f"更新間隔 (秒)\n(変化がない間は最大{DEFAULT_MAX_INTERVAL_SEC:g}秒まで延長)",
+                  style="Card.TLabel").pack(anchor="w", pady=(10, 2))
         ttk.Entry(frame, textvariable=self.interval_sec_var).pack(fill="x")
         
         ttk.Label(frame, text="参照元画像パス", style="Card.TLabel").pack(anchor="w", pady=(10, 2))
         ttk.Entry(frame, textvariable=self.reference_image_path_var).pack(fill="x")
+
+        ttk.Label(frame, text="タイル配信元URL\n(replay.py の再生サーバーも指定可)", style="Card.TLabel").pack(anchor="w", pady=(10, 2))
+        ttk.Entry(frame, textvariable=self.base_url_var).pack(fill="x")
         
         ttk.Label(frame, text="荒らしレベルの閾値 (%)", style="SubHeader.TLabel", background=self.CARD_BG).pack(anchor="w", pady=(20, 5))
         for var, data in zip(self.threshold_vars, LEVELS_DATA):
@@ -214,6 +278,7 @@ class VandalismDetectorApp:
 
         ttk.Button(button_frame, text="デフォルトに戻す", command=self._reset_settings).grid(row=0, column=0, sticky="ew", padx=(0, 5))
         ttk.Button(button_frame, text="適用", command=self._apply_settings).grid(row=0, column=1, sticky="ew", padx=(5, 0))
+        ttk.Button(button_frame, text="診断情報", command=self._open_diagnostics).grid(row=1, column=0, columnspan=2, sticky="ew", pady=(10, 0))
         
         return frame
     
@@ -226,13 +291,10 @@ class VandalismDetectorApp:
             if initial_load: self.root.destroy()
             return
         
-        self.seal_image = self._load_reference()
+        self.base_url = self.base_url_var.get().strip() or TILE_BASE_URL
+        seal_image = self._load_reference()
         
-        if self.seal_image:
-            self.monitor_size = self.seal_image.size
-            self.original_image_width = self.monitor_size[0]
-            self.original_image_height = self.monitor_size[1]
-            
+        if seal_image and self._compile_reference(seal_image):
             self._update_images_display()
 
             if not initial_load:
@@ -245,17 +307,16 @@ class VandalismDetectorApp:
         self.realtime_ref_pixel_var.set(f"{DEFAULT_REF_PIXEL[0]}, {DEFAULT_REF_PIXEL[1]}, {DEFAULT_REF_PIXEL[2]}, {DEFAULT_REF_PIXEL[3]}")
         self.interval_sec_var.set(max(1, DEFAULT_INTERVAL_MS // 1000))
         self.reference_image_path_var.set(DEFAULT_SEAL_IMAGE_PATH)
+        self.base_url_var.set(TILE_BASE_URL)
+        self.base_url = TILE_BASE_URL
 
         for var, data in zip(self.threshold_vars, LEVELS_DATA):
             var.set(data['default_limit'])
             
         # 参照画像を再読み込み
-        self.seal_image = self._load_reference()
+        seal_image = self._load_reference()
         
-        if self.seal_image:
-            self.monitor_size = self.seal_image.size
-            self.original_image_width = self.monitor_size[0]
-            self.original_image_height = self.monitor_size[1]
+        if seal_image and self._compile_reference(seal_image):
             self._update_images_display()
             messagebox.showinfo("設定リセット", "設定がデフォルト値に戻されました。")
         else:
@@ -273,175 +334,313 @@ class VandalismDetectorApp:
         
         try:
             full_ref_img = Image.open(abs_path).convert("RGBA")
-            
-            alpha_data = full_ref_img.getchannel('A').getdata()
-            opaque_pixels_count = sum(1 for p in alpha_data if p > 0)
-            total_pixels = full_ref_img.width * full_ref_img.height
-            print(f"デバッグ情報: 参照元画像が読み込まれました。")
-            print(f"  全体のピクセル数: {total_pixels}")
-            print(f"  透過していない（監視対象）ピクセル数: {opaque_pixels_count}")
-            
             return full_ref_img
         except Exception as e:
             messagebox.showerror("参照画像エラー", f"参照画像の読み込み中にエラーが発生しました: {e}")
             return None
 
-    def _fetch_tiles_and_crop(self, tile_x, tile_y, x_in_tile, y_in_tile, width, height):
+    def _compile_reference(self, seal_image):
         """
-        指定されたタイル座標とタイル内座標、サイズに基づいて
-        必要なタイルを結合し、監視領域をクロップして返します。
+        読み込んだ参照画像から比較・表示用のデータを一度だけ準備します。
+        失敗した場合はエラーを表示して False を返し、それまでの参照画像で監視を続けます。
         """
         try:
-            base_url = "https://backend.wplace.live/files/s0/tiles"
-            
-            # --- TILE_SIZE に基づくグローバル座標の計算 ---
-            global_x = tile_x * TILE_SIZE + x_in_tile
-            global_y = tile_y * TILE_SIZE + y_in_tile
-            
-            # 監視領域がカバーするタイルの範囲を計算
-            start_tile_x = global_x // TILE_SIZE
-            start_tile_y = global_y // TILE_SIZE
-            end_tile_x = (global_x + width - 1) // TILE_SIZE
-            end_tile_y = (global_y + height - 1) // TILE_SIZE
-            
-            tile_images = {}
-            for tx in range(start_tile_x, end_tile_x + 1):
-                for ty in range(start_tile_y, end_tile_y + 1):
-                    url = f"{base_url}/{tx}/{ty}.png"
-                    img = get_image_from_url(url)
-                    if img:
-                        tile_images[(tx, ty)] = img.convert("RGBA")
-            
-            if not tile_images:
-                print("デバッグ情報: タイルの取得に失敗しました。")
-                return None
-
-            # 結合画像のサイズを計算
-            combined_width = (end_tile_x - start_tile_x + 1) * TILE_SIZE
-            combined_height = (end_tile_y - start_tile_y + 1) * TILE_SIZE
-            combined_img = Image.new("RGBA", (combined_width, combined_height))
-
-            # タイルを結合
-            for (tx, ty), img in tile_images.items():
-                paste_x = (tx - start_tile_x) * TILE_SIZE
-                paste_y = (ty - start_tile_y) * TILE_SIZE
-                combined_img.paste(img, (paste_x, paste_y))
-            
-            # 結合された画像から監視領域をクロップ
-            crop_x1 = global_x - start_tile_x * TILE_SIZE
-            crop_y1 = global_y - start_tile_y * TILE_SIZE
-            crop_x2 = crop_x1 + width
-            crop_y2 = crop_y1 + height
-            
-            cropped_live_img = combined_img.crop((crop_x1, crop_y1, crop_x2, crop_y2))
-            
-            return cropped_live_img
-                
+            reference = CompiledReference(seal_image)
         except Exception as e:
-            print(f"タイル結合・クロップ中にエラーが発生しました: {e}")
-            messagebox.showerror("エラー", f"画像の取得・処理中にエラーが発生しました: {e}")
-            return None
+            messagebox.showerror("参照画像エラー", f"参照画像の準備中にエラーが発生しました: {e}")
+            return False
+        self.seal_image = seal_image
+        self.reference = reference
+        self.monitor_size = self.reference.size
+        self.original_image_width = self.monitor_size[0]
+        self.original_image_height = self.monitor_size[1]
+        self.frame_serial += 1 # マスクが変わるので表示を作り直す
+
+        # 新しい参照と設定をワーカーに渡し、待たずに比較し直させる
+        self.worker.configure(reference=self.reference)
+        self._push_settings()
+        self.worker.check_now()
+
+        print(f"デバッグ情報: 参照元画像が読み込まれました。")
+        print(f"  全体のピクセル数: {self.reference.total_pixels}")
+        print(f"  透過していない（監視対象）ピクセル数: {self.reference.opaque_count}")
+        warning = self.reference.off_palette_message()
+        if warning:
+            print(f"  警告: {warning}")
+        return True
+
+    def _current_thresholds(self):
+        """閾値の取得を安全に行います。不正な入力は0として扱います。"""
+        thresholds = []
+        for var in self.threshold_vars:
+            try:
+                thresholds.append(float(var.get()))
+            except (tk.TclError, ValueError):
+                thresholds.append(0.0)
+        return thresholds
 
-    def _tick_check(self):
+    def _push_settings(self):
+        """Tk変数の現在値をワーカーに渡します。Tk変数はGUIスレッドからしか読めないため、ここで読み取ります。"""
         ref_pixel_quad = safe_int_quad(self.realtime_ref_pixel_var.get(), DEFAULT_REF_PIXEL)
+        valid = not (ref_pixel_quad == "error" or self.seal_image is None or self.monitor_size == (0, 0))
+        try:
+            interval_sec = self.interval_sec_var.get()
+        except (tk.TclError, ValueError):
+            interval_sec = DEFAULT_INTERVAL_MS / 1000
+        self.worker.configure(ref_pixel=ref_pixel_quad if valid else None,
+                              thresholds=self._current_thresholds(),
+                              interval_sec=interval_sec,
+                              base_url=self.base_url,
+                              show_heatmap=self.show_heatmap_var.get())
+
+    def _toggle_heatmap(self):
+        """ヒートマップの表示を切り替えます。表示中だけワーカーが画像を作ります。"""
+        if self.show_heatmap_var.get():
+            self.image_area.columnconfigure(2, weight=1)
+            self.heatmap_container.grid(row=0, column=2, sticky="nsew", padx=(20, 0))
+        else:
+            self.heatmap_container.grid_remove()
+            self.image_area.columnconfigure(2, weight=0)
+            self.current_heatmap_image = None
+        self._push_settings()
+        self.worker.check_now() # 次のチェックを待たずにヒートマップ付きの結果を作らせる
+        self.frame_serial += 1 # 画像の表示幅が変わるので描き直す
+        self._update_images_display()
+
+    def _poll_results(self):
+        """ワーカーから届いた結果を取り出して描画します。重い処理はワーカー側で済んでいます。"""
+        self._push_settings()
+
+        results = []
+        while True:
+            try:
+                results.append(self.results.get_nowait())
+            except queue.Empty:
+                break
 
-        if ref_pixel_quad == "error" or self.seal_image is None or self.monitor_size == (0, 0):
-            self.status_var.set("エラー: 設定を確認してください")
-            interval_ms = max(500, self.interval_sec_var.get() * 1000)
-            self.after_id = self.root.after(interval_ms, self._tick_check)
-            return
-
-        # リアルタイム画像のタイルを結合して取得
-        tile_x, tile_y, x_in_tile, y_in_tile = ref_pixel_quad
-        cropped_live_img = self._fetch_tiles_and_crop(tile_x, tile_y, x_in_tile, y_in_tile, self.monitor_size[0], self.monitor_size[1])
-        
-        if cropped_live_img:
-            diff_pct, diff_img = compare_images(self.seal_image, cropped_live_img)
+        # 溜まった結果は履歴にだけ反映し、画像とグラフの描画は最新の1件だけ行う
+        last_updated = max((i for i, r in enumerate(results) if r.updated), default=None)
+        for i, result in enumerate(results):
+            self._handle_result(result, render=(i == last_updated))
+
+        self.after_id = self.root.after(RESULT_POLL_MS, self._poll_results)
+
+    def _handle_result(self, result, render):
+        if result.error == SETTINGS_ERROR:
+            self.status_var.set(f"エラー: {SETTINGS_ERROR}")
+        elif result.error:
+            print(f"デバッグ情報: {result.error}")
+            for (tx, ty), reason in result.tile_errors.items():
+                print(f"デバッグ情報: タイル ({tx}, {ty}) の取得に失敗しました: {reason}")
+            self.status_var.set(result.error if result.tile_errors else "画像取得に失敗しました...")
+        elif not result.updated or not render:
+            # タイルに変化なし (または後続の結果で上書きされる): 履歴点を追加し、
+            # 直前の取得エラーの表示が残らないようステータスだけ更新する
+            self.diff_pct = result.diff_pct
+            self._append_history(self.diff_pct)
+            self._update_status(self.diff_pct)
+            with self.metrics.span("graph"):
+                self._update_line_graph(self.diff_pct)
+        else:
+            diff_pct = result.diff_pct
             self.diff_pct = diff_pct
-            self.current_cropped_image = cropped_live_img
-            self.current_diff_image = diff_img
+            self.current_cropped_image = result.live_image
+            self.current_diff_image = result.diff_image
+            self.current_heatmap_image = result.heatmap_image
+            self.frame_serial += 1
+
+            with self.metrics.span("display"):
+                self._update_images_display()
+            with self.metrics.span("status"):
+                self._update_status(diff_pct)
+            with self.metrics.span("graph"):
+                self._update_graph(diff_pct)
+
+    def _open_diagnostics(self):
+        """段階ごとの処理時間を表示する診断パネルを開きます (開いている間は定期的に更新)。"""
+        if self.diagnostics_window is not None and self.diagnostics_window.winfo_exists():
+            self.diagnostics_window.lift()
+            return
 
-            self._update_images_display()
-            self._update_status(diff_pct)
-            self._update_graph(diff_pct)
-        else:
-            self.status_var.set("画像取得に失敗しました...")
+        window = tk.Toplevel(self.root)
+        window.title("診断情報")
+        window.configure(bg=self.CARD_BG)
+        columns = ("count", "p50", "p95", "max", "total")
+        headings = ("回数", "中央値 (ms)", "p95 (ms)", "最大 (ms)", "合計 (秒)")
+        tree = ttk.Treeview(window, columns=columns, height=len(STAGE_LABELS))
+        tree.heading("#0", text="処理")
+        tree.column("#0", width=160)
+        for column, heading in zip(columns, headings):
+            tree.heading(column, text=heading)
+            tree.column(column, width=90, anchor="e")
+        tree.pack(fill="both", expand=True, padx=10, pady=(10, 5))
+
+        info_var = tk.StringVar()
+        ttk.Label(window, textvariable=info_var, style="Card.TLabel").pack(anchor="w", padx=10, pady=(0, 10))
+
+        def refresh():
+            if not window.winfo_exists():
+                return
+            stages = self.metrics.stages()
+            tree.delete(*tree.get_children())
+            for stage in list(STAGE_LABELS) + sorted(set(stages) - set(STAGE_LABELS)):
+                s = stages.get(stage)
+                if s is None:
+                    continue
+                tree.insert("", "end", text=STAGE_LABELS.get(stage, stage),
+                            values=(s.count, f"{s.p50 * 1000:.1f}", f"{s.p95 * 1000:.1f}",
+                                    f"{s.max * 1000:.1f}", f"{s.total:.2f}"))
+            endpoint = (f"http://127.0.0.1:{METRICS_PORT}/metrics" if self.metrics_server is not None
+                        else "メトリクスのエンドポイントは無効です")
+            info_var.set(f"チェック間隔の超過: {self.metrics.counter('tick_overruns')} 回 / "
+                         f"現在のチェック間隔: {self.worker.pacer.interval:.1f} 秒\n{endpoint}")
+            window.after(DIAGNOSTICS_REFRESH_MS, refresh)
+
+        self.diagnostics_window = window
+        refresh()
+
+    def _on_close(self):
+        self.worker.stop(timeout=1)
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+        self.engine.fetcher.close()
+        self.history_store.close()
+        self.archiver.close()
+        self.heatmaps.close()
+        self.root.destroy()
+
+    def _append_history(self, diff_pct):
+        """差分の履歴に現在時刻の点を追加します。"""
+        self.history.append(time.time() - self.start_time, diff_pct)
+
+    def _init_graph_artists(self):
+        """
+        グラフの軸・閾値線・ラベル・ドーナツの各要素を一度だけ作成します。
+        以降の更新ではデータだけを差し替え、背景をキャッシュしたブリットで再描画します。
+        """
+        self._blit_backgrounds = {}
+        self._threshold_cache = None
+
+        # --- 折れ線グラフ ---
+        ax = self.line_ax
+        ax.set_ylim(0, 100)
+        ax.set_xlim(0, GRAPH_X_MARGIN_SEC)
+        ax.set_xlabel("時間 (秒)", color=self.FG_COLOR)
+        ax.set_ylabel("差分 (%)", color=self.FG_COLOR)
+        ax.tick_params(colors=self.FG_COLOR)
+        ax.grid(color=self.BORDER_COLOR, linestyle=':', linewidth=0.5)
+        ax.set_title("差分パーセンテージの推移", color=self.FG_COLOR, fontsize=12)
+        self.history_line, = ax.plot([], [], color=NORMAL_GRAPH_COLOR, lw=2, animated=True)
+        # 閾値線とラベルは背景の一部として描画し、閾値が変わったときだけ動かす
+        self.threshold_artists = []
+        for data in LEVELS_DATA:
+            line = ax.axhline(y=data["default_limit"], color=data["color"], linestyle='--', lw=1, zorder=0)
+            label = ax.text(1.0, data["default_limit"], f' {data["label"]}', transform=ax.get_yaxis_transform(),
+                            ha='right', va='bottom', color=self.FG_COLOR, fontsize=8, backgroundcolor=self.CARD_BG)
+            self.threshold_artists.append((line, label))
+
+        # --- ドーナツグラフ ---
+        ax = self.pie_ax
+        ax.set(frame_on=False, xticks=[], yticks=[], xlim=(-1.25, 1.25), ylim=(-1.25, 1.25))
+        ax.set_aspect('equal')
+        ax.set_title("現在の差分", color=self.FG_COLOR, fontsize=12, pad=10)
+        self.diff_wedge = Wedge((0, 0), 1, 90, 90, width=0.4, color=NORMAL_GRAPH_COLOR, animated=True)
+        self.rest_wedge = Wedge((0, 0), 1, -270, 90, width=0.4, color='#333333', animated=True)
+        ax.add_patch(self.diff_wedge)
+        ax.add_patch(self.rest_wedge)
+        self.diff_wedge_label = ax.text(0, 0, '差分', va='center', color='white', animated=True)
+        self.rest_wedge_label = ax.text(0, 0, '残り', va='center', color='white', animated=True)
+        self.pie_center_text = ax.text(0, 0, '', ha='center', va='center', color=self.FG_COLOR,
+                                       fontweight='bold', fontsize=18, backgroundcolor=self.CARD_BG, animated=True)
+
+        self._blit_artists = {
+            self.line_canvas: (self.line_ax, [self.history_line]),
+            self.pie_canvas: (self.pie_ax, [self.diff_wedge, self.rest_wedge, self.diff_wedge_label,
+                                            self.rest_wedge_label, self.pie_center_text]),
+        }
+        for canvas in self._blit_artists:
+            canvas.mpl_connect('draw_event', lambda event, c=canvas: self._on_graph_draw(c))
+
+    def _on_graph_draw(self, canvas):
+        """全体の再描画が終わったら背景を保存し、動的な要素を上に描きます。"""
+        ax, artists = self._blit_artists[canvas]
+        self._blit_backgrounds[canvas] = canvas.copy_from_bbox(ax.bbox)
+        for artist in artists:
+            ax.draw_artist(artist)
+
+    def _blit(self, canvas, full_redraw=False):
+        """保存済みの背景に動的な要素だけを描き直して転送します。背景が無効なら全体を再描画します。"""
+        background = self._blit_backgrounds.get(canvas)
+        if full_redraw or background is None:
+            canvas.draw_idle()
+            return
+        ax, artists = self._blit_artists[canvas]
+        canvas.restore_region(background)
+        for artist in artists:
+            ax.draw_artist(artist)
+        canvas.blit(ax.bbox)
+
+    def _sync_threshold_artists(self, thresholds):
+        """閾値が変わったときだけ閾値線とラベルを移動します。移動した場合は True を返します。"""
+        key = tuple(thresholds)
+        if key == self._threshold_cache:
+            return False
+        self._threshold_cache = key
+        for (line, label), limit in zip(self.threshold_artists, thresholds):
+            line.set_ydata([limit, limit])
+            label.set_y(limit)
+        return True
+
+    @staticmethod
+    def _place_wedge_label(label, theta1, theta2):
+        # ax.pie と同じく、扇形の中央の角度で半径1.1の位置に置く
+        angle = math.radians((theta1 + theta2) / 2)
+        x, y = 1.1 * math.cos(angle), 1.1 * math.sin(angle)
+        label.set_position((x, y))
+        label.set_horizontalalignment('left' if x >= 0 else 'right')
+
+    def _on_threshold_changed(self, *args):
+        """閾値の入力が変わったら、次の結果を待たずに閾値線とラベルを動かします。"""
+        if self._sync_threshold_artists(self._current_thresholds()):
+            self._blit(self.line_canvas, full_redraw=True)
+
+    def _update_line_graph(self, diff_pct):
+        """
+        折れ線グラフを履歴の最新の点まで描き直し、線の色を返します。結果が届くたびに呼びます。
+        データだけ差し替え、閾値線が動いたときと時間軸が足りなくなったときだけ全体を再描画します。
+        """
+        thresholds = self._current_thresholds()
+        level_info = classify(diff_pct, thresholds)
+        graph_color = level_info["graph_color"] if level_info else NORMAL_GRAPH_COLOR
+
+        full_redraw = self._sync_threshold_artists(thresholds)
+        times, values = self.history.window(self.max_history_points)
+        self.history_line.set_data(times, values)
+        self.history_line.set_color(graph_color)
+        if len(times) and times[-1] > self.line_ax.get_xlim()[1]:
+            self.line_ax.set_xlim(times[0], times[-1] + GRAPH_X_MARGIN_SEC)
+            full_redraw = True
+        self._blit(self.line_canvas, full_redraw)
+        return graph_color
 
-        interval_ms = max(500, self.interval_sec_var.get() * 1000)
-        self.after_id = self.root.after(interval_ms, self._tick_check)
-        
     def _update_graph(self, diff_pct):
         """グラフ（折れ線グラフ）と円グラフを更新します。"""
-        self.diff_history.append(diff_pct)
-        self.time_history.append(time.time() - self.start_time)
-        
-        if len(self.diff_history) > self.max_history_points:
-            self.diff_history.pop(0)
-            self.time_history.pop(0)
-        
-        # 閾値の取得を安全に行う
-        safe_thresholds = []
-        for var, data in zip(self.threshold_vars, LEVELS_DATA):
-            try:
-                limit = float(var.get())
-            except (tk.TclError, ValueError):
-                limit = 0.0
-            safe_thresholds.append((limit, data))
-
-        sorted_thresholds = sorted(safe_thresholds, key=lambda x: x[0], reverse=True)
-        
-        self.line_ax.clear()
-        self.line_ax.set_facecolor(self.CARD_BG)
-        level_info = None
-        graph_color = NORMAL_GRAPH_COLOR
-        for limit, data in sorted_thresholds:
-            if diff_pct >= limit:
-                level_info = data
-                graph_color = data["graph_color"]
-                break
-        self.line_ax.plot(self.time_history, self.diff_history, color=graph_color, lw=2)
-        for limit, data in sorted_thresholds:
-            self.line_ax.axhline(y=limit, color=data["color"], linestyle='--', lw=1, zorder=0)
-            self.line_ax.text(self.time_history[-1] if self.time_history else 0, limit, f' {data["label"]}',
-                         ha='right', va='bottom', color=self.FG_COLOR, fontsize=8, backgroundcolor=self.CARD_BG)
-        self.line_ax.set_ylim(0, 100)
-        self.line_ax.set_xlabel("時間 (秒)", color=self.FG_COLOR)
-        self.line_ax.set_ylabel("差分 (%)", color=self.FG_COLOR)
-        self.line_ax.tick_params(colors=self.FG_COLOR)
-        self.line_ax.grid(color=self.BORDER_COLOR, linestyle=':', linewidth=0.5)
-        self.line_ax.set_title("差分パーセンテージの推移", color=self.FG_COLOR, fontsize=12)
-        self.line_canvas.draw_idle()
-
-        self.pie_ax.clear()
-        self.pie_ax.set_facecolor(self.CARD_BG)
-        labels = ['差分', '残り']
-        sizes = [diff_pct, max(0, 100 - diff_pct)]
-        colors = [graph_color, '#333333']
-        self.pie_ax.pie(sizes, labels=labels, colors=colors, startangle=90, counterclock=False, 
-                        wedgeprops=dict(width=0.4), pctdistance=0.85, textprops={'color': 'white'})
-        self.pie_ax.text(0, 0, f'{diff_pct:.2f}%', ha='center', va='center', color=self.FG_COLOR, 
-                         fontweight='bold', fontsize=18, backgroundcolor=self.CARD_BG)
-        self.pie_ax.set_title("現在の差分", color=self.FG_COLOR, fontsize=12, pad=10)
-        self.pie_ax.axis('equal')
-        self.pie_canvas.draw_idle()
+        self._append_history(diff_pct)
+        graph_color = self._update_line_graph(diff_pct)
+
+        # ドーナツ: startangle=90, 時計回りで扇形の角度だけを更新する
+        pct = min(max(diff_pct, 0.0), 100.0)
+        split = 90 - 3.6 * pct
+        self.diff_wedge.set(theta1=split, theta2=90, color=graph_color)
+        self.rest_wedge.set(theta1=-270, theta2=split)
+        self._place_wedge_label(self.diff_wedge_label, split, 90)
+        self._place_wedge_label(self.rest_wedge_label, -270, split)
+        self.pie_center_text.set_text(f'{diff_pct:.2f}%')
+        self._blit(self.pie_canvas)
 
     def _update_status(self, diff_pct):
-        # 閾値の取得を安全に行う
-        safe_thresholds = []
-        for var, data in zip(self.threshold_vars, LEVELS_DATA):
-            try:
-                limit = float(var.get())
-            except (tk.TclError, ValueError):
-                limit = 0.0
-            safe_thresholds.append((limit, data))
-
-        sorted_thresholds = sorted(safe_thresholds, key=lambda x: x[0], reverse=True)
-        
-        level_info = None
-        for limit, data in sorted_thresholds:
-            if diff_pct >= limit:
-                level_info = data
-                break
+        level_info = classify(diff_pct, self._current_thresholds())
         
         if level_info:
             self.status_label.configure(foreground=level_info["color"])
@@ -451,8 +650,35 @@ class VandalismDetectorApp:
             self.status_var.set(f"監視中... (差分: {diff_pct:.2f}%)")
 
     def _on_resize(self, event):
-        # ウィンドウサイズが変更されたら、画像を再描画する
-        self.root.after_idle(self._update_images_display)
+        # 子ウィジェットの <Configure> も届くので、ウィンドウ自体のサイズ変更だけを扱う。
+        # ドラッグ中の連続したイベントはまとめ、途切れてから1回だけ描き直す
+        if event.widget is not self.root:
+            return
+        if self.resize_after_id is not None:
+            self.root.after_cancel(self.resize_after_id)
+        self.resize_after_id = self.root.after(RESIZE_DEBOUNCE_MS, self._on_resize_settled)
+
+    def _on_resize_settled(self):
+        self.resize_after_id = None
+        self._update_images_display()
+
+    def _masked_realtime_image(self):
+        """透過部分を消したリアルタイム画像を返します。同じフレームでは作り直しません。"""
+        if self.masked_frame is None or self.masked_frame[0] != self.frame_serial:
+            realtime_with_mask = Image.new("RGBA", self.current_cropped_image.size, (0, 0, 0, 0))
+            realtime_with_mask.paste(self.current_cropped_image, mask=self.reference.mask)
+            self.masked_frame = (self.frame_serial, realtime_with_mask)
+        return self.masked_frame[1]
+
+    @staticmethod
+    def _show_image(label, photo, image):
+        """既存の PhotoImage と同じサイズなら paste で中身だけ差し替え、違うサイズなら作り直します。"""
+        if photo is not None and (photo.width(), photo.height()) == image.size:
+            photo.paste(image)
+            return photo
+        photo = ImageTk.PhotoImage(image)
+        label.configure(image=photo)
+        return photo
 
     def _update_images_display(self):
         if self.current_cropped_image is None or self.current_diff_image is None:
@@ -482,77 +708,30 @@ class VandalismDetectorApp:
         # 新しいサイズが0以下にならないようにする
         if new_w < 1 or new_h < 1:
             return
+
+        # フレームも表示サイズも前回と同じなら何もしない
+        display_key = (self.frame_serial, (new_w, new_h))
+        if display_key == self.display_key:
+            return
             
         try:
             # リアルタイム画像
             # 透過部分を考慮したリアルタイム画像の表示
-            alpha_mask = self.seal_image.getchannel('A')
-            realtime_with_mask = Image.new("RGBA", self.current_cropped_image.size, (0, 0, 0, 0))
-            realtime_with_mask.paste(self.current_cropped_image, mask=alpha_mask)
-            
-            resized_rt = realtime_with_mask.resize((new_w, new_h), Image.Resampling.NEAREST)
-            self.realtime_tk = ImageTk.PhotoImage(resized_rt)
-            self.realtime_image_label.configure(image=self.realtime_tk)
+            resized_rt = self._masked_realtime_image().resize((new_w, new_h), Image.Resampling.NEAREST)
+            self.realtime_tk = self._show_image(self.realtime_image_label, self.realtime_tk, resized_rt)
             
             # 差分画像
             resized_df = self.current_diff_image.resize((new_w, new_h), Image.Resampling.NEAREST)
-            self.diff_tk = ImageTk.PhotoImage(resized_df)
-            self.diff_image_label.configure(image=self.diff_tk)
+            self.diff_tk = self._show_image(self.diff_image_label, self.diff_tk, resized_df)
+
+            # ヒートマップ
+            if self.show_heatmap_var.get() and self.current_heatmap_image is not None:
+                resized_hm = self.current_heatmap_image.resize((new_w, new_h), Image.Resampling.NEAREST)
+                self.heatmap_tk = self._show_image(self.heatmap_image_label, self.heatmap_tk, resized_hm)
+            self.display_key = display_key
         except Exception as e:
             print(f"画像表示の更新中にエラーが発生しました: {e}")
 
-
-def get_image_from_url(url: str):
-    try:
-        resp = requests.get(url, timeout=5)
-        resp.raise_for_status()
-        return Image.open(io.BytesIO(resp.content))
-    except requests.RequestException as e:
-        print(f"画像取得失敗: {e}")
-        return None
-
-def compare_images(img1, img2):
-    """
-    透過ピクセルを無視して画像を比較し、透過部分を黒く塗りつぶした差分画像を返します。
-    img1: 参照画像 (透過情報あり, RGBA)
-    img2: リアルタイム画像 (透過情報あり, RGBA)
-    """
-    if img1.size != img2.size:
-        w = min(img1.width, img2.width)
-        h = min(img1.height, img2.height)
-        img1 = img1.crop((0, 0, w, h))
-        img2 = img2.crop((0, 0, w, h))
-
-    alpha_mask = img1.getchannel('A')
-    
-    # 監視対象（透過していない）ピクセルの数をカウント
-    opaque_pixels_count = sum(1 for p in alpha_mask.getdata() if p > 0)
-
-    if opaque_pixels_count == 0:
-        return 0.0, Image.new("RGB", img1.size, (0, 0, 0))
-        
-    # RGBチャンネルのみで差分を計算
-    diff = ImageChops.difference(img1.convert("RGB"), img2.convert("RGB"))
-    
-    # 差分画像と真っ黒な画像をアルファマスクで合成
-    # 透過部分（アルファ値が0）は黒に、不透明部分（アルファ値 > 0）は差分画像の色になる
-    diff_visual = Image.composite(diff, Image.new("RGB", diff.size, (0, 0, 0)), alpha_mask)
-    
-    # 差分のあるピクセル数をカウント
-    nz = sum(1 for pixel in diff_visual.getdata() if pixel != (0, 0, 0))
-
-    diff_pct = (nz / opaque_pixels_count) * 100
-    
-    return diff_pct, diff_visual
-
-def safe_int_quad(text, default):
-    """カンマ区切りの4つの整数をパースし、不正な場合は'error'を返します。"""
-    try:
-        parts = [int(v.strip()) for v in text.split(",")]
-        return tuple(parts) if len(parts) == 4 else "error"
-    except (ValueError, TypeError):
-        return "error"
-
 def main():
     try:
         from ctypes import windll